@@ -1 +1 @@
-from . import calib, io, model
+from . import calib, io, model, resa2
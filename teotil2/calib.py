@@ -1,12 +1,21 @@
+import hashlib
+import multiprocessing as mp
 import os
-from collections import defaultdict
+import shutil
+import sys
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.util import Finalize
 
 import networkx as nx
 import numpy as np
 import pandas as pd
 
+from . import io, model
 
-def build_calib_network(data, calib_node_set):
+
+def build_calib_network(data, calib_node_set, cache_dir=None, return_members=False):
     """Build an unattributed network for the "calibration catchments" in 'calib_node_set'.
        Designed to help when calibrating the model (e.g. after adding a new component or
        parameter).
@@ -15,10 +24,16 @@ def build_calib_network(data, calib_node_set):
         data:           Dataframe or raw str to model input file. Must include a contingency table
                         with columns 'regine' and 'regine_ned' describing network links.
         calib_node_set: Set of catchment IDs for which calibration data are available.
+        cache_dir:      Str. Optional. Folder in which to cache the compiled regine network.
+                        See model.get_network()
+        return_members: Bool. Default False. Whether to also return the set of catchments
+                        upstream of each node in calib_node_set
 
     Returns:
         (g, nd_list). Tuple. g is a NetworkX graph object for the sub-network upstream of
-        catchments in calib_node_set. nd_list is a topologically sorted list of nodes.
+        catchments in calib_node_set. nd_list is a topologically sorted list of nodes. If
+        'return_members' is True, (g, nd_list, members), where 'members' is a dict
+        {node: set of IDs upstream of (and including) node}.
     """
     # Parse input
     if isinstance(data, pd.DataFrame):
@@ -30,40 +45,31 @@ def build_calib_network(data, calib_node_set):
     else:
         raise ValueError('"data" must be either a "raw" string or a Pandas dataframe.')
 
-    # Check required cols are present
-    req_cols = ["regine", "regine_ned"]
-    for col in req_cols:
-        assert col in df.columns, f"'data' must contain a column named '{col}'."
-
-    # Build graph
-    g = nx.DiGraph()
-
-    # Add nodes
-    for idx, row in df.iterrows():
-        nd = row["regine"]
-        g.add_node(nd, local={}, accum={})
-
-    # Add edges
-    for idx, row in df.iterrows():
-        fr_nd = row["regine"]
-        to_nd = row["regine_ned"]
-        g.add_edge(fr_nd, to_nd)
+    # Get compiled (and validated) network
+    net = model.get_network(df, cache_dir=cache_dir)
 
-    # Check directed tree
-    assert nx.is_tree(g), "g is not a valid tree."
-    assert nx.is_directed_acyclic_graph(g), "g is not a valid DAG."
+    # Get nodes upstream of all sites with data in a single pass
+    calib_node_list = list(calib_node_set)
+    in_sub = net.upstream_mask(calib_node_list)
+    nds = np.flatnonzero(in_sub)
 
-    # Get nodes upstream of each site with data
-    nd_set = set()
-    for nd in calib_node_set:
-        nds = nx.dfs_tree(g.reverse(), nd).nodes()
-        nd_set.update(nds)
+    # Build subgraph. Links are only included where both nodes are in the sub-network
+    links = nds[(net.parent[nds] >= 0) & in_sub[np.maximum(net.parent[nds], 0)]]
+    g = nx.DiGraph()
+    g.add_nodes_from((nd, {"local": {}, "accum": {}}) for nd in net.regine[nds])
+    g.add_edges_from(zip(net.regine[links], net.regine_ned[links]))
 
-    # Get subgraph
-    g = g.subgraph(nd_set).copy()
+    # Compiled sub-network for use by CalibModel
+    g.graph["network"] = net.prune(calib_node_list)
 
     # Get topo node list
-    nd_list = list(nx.topological_sort(g))
+    nd_list = list(net.regine[nds])
+
+    if return_members:
+        members = {
+            nd: set(net.regine[net.upstream_nodes(nd)]) for nd in calib_node_list
+        }
+        return (g, nd_list, members)
 
     return (g, nd_list)
 
@@ -77,7 +83,7 @@ def update_and_accumulate(g, nd_list, year, data_dict, cal_pars, par_list, reg_s
                    and 'accum' (empty dict).
         nd_list:   List. Topologically sorted list of nodes of g
         year:      Int. Year of interest
-        data_dict: Dict. data_dict['node', year]['quantity]
+        data_dict: PackedInputs or dict. data_dict['node', year]['quantity]
         cal_pars:  Dict. Calibration parameters
         par_list:  List of parameters in the input file
         reg_set:  List of regine ID of interest
@@ -168,80 +174,117 @@ def update_and_accumulate(g, nd_list, year, data_dict, cal_pars, par_list, reg_s
     return df
 
 
-def read_obs_data(cal_prop, seed=1):
+# Default folder containing the observed and annual input data used for calibration. Can
+# be overridden using the 'data_root' argument of read_obs_data() and build_input_dict()
+DATA_ROOT = r"C:\Data\James_Work\Staff\Oeyvind_K\Elveovervakingsprogrammet"
+
+
+def read_obs_data(cal_prop, seed=1, data_root=None, cache_dir=None):
     """Reads observed data file for 155 RID sites from 1990 to 2016. Joins in basic station
        properties and splits into calibration and validation datasets.
 
     Args:
-        cal_prop: Float. Between 0 and 1. Fraction of dataset to use for
-                  calibration. The rest is for validation.
-        seed:     Int. For repeatability
+        cal_prop:  Float. Between 0 and 1. Fraction of dataset to use for
+                   calibration. The rest is for validation.
+        seed:      Int. For repeatability
+        data_root: Str. Optional. Folder containing the 'NOPE' and 'Data' folders.
+                   Default is DATA_ROOT
+        cache_dir: Str. Optional. Folder in which to cache the joined dataset. The cache
+                   is updated whenever the source files change. See io.cached_frame()
 
     Returns:
         Tuple (obs_df, cal_df, val_df). obs_df is the entire dataset
     """
-
-    # Read obs data
-    in_csv = (
-        r"C:\Data\James_Work\Staff\Oeyvind_K\Elveovervakingsprogrammet"
-        r"\NOPE\NOPE_RID_Calibration_Data\rid_all_obs_loads_flows_1990_2016.csv"
+    data_root = DATA_ROOT if data_root is None else data_root
+    in_csv = os.path.join(
+        data_root,
+        "NOPE",
+        "NOPE_RID_Calibration_Data",
+        "rid_all_obs_loads_flows_1990_2016.csv",
     )
-    obs_df = pd.read_csv(in_csv)
+    in_xlsx = os.path.join(data_root, "Data", "RID_Sites_List.xlsx")
 
-    # Drop NaN
-    obs_df.dropna(how="any", inplace=True)
+    def read_data():
+        # Read obs data
+        obs_df = pd.read_csv(in_csv)
 
-    # Read station data
-    in_xlsx = (
-        r"C:\Data\James_Work\Staff\Oeyvind_K\Elveovervakingsprogrammet"
-        r"\Data\RID_Sites_List.xlsx"
-    )
-    stn_df = pd.read_excel(in_xlsx, sheet_name="RID_All")
-    stn_df = stn_df[["station_id", "nve_vassdrag_nr", "rid_group"]]
+        # Drop NaN
+        obs_df.dropna(how="any", inplace=True)
+
+        # Read station data
+        stn_df = pd.read_excel(in_xlsx, sheet_name="RID_All")
+        stn_df = stn_df[["station_id", "nve_vassdrag_nr", "rid_group"]]
+
+        # Join vassdrag nrs
+        return pd.merge(obs_df, stn_df, how="left", on="station_id")
 
-    # Join vassdrag nrs
-    obs_df = pd.merge(obs_df, stn_df, how="left", on="station_id")
+    key = io.source_key([in_csv, in_xlsx])
+    obs_df = io.cached_frame("obs_data", key, read_data, cache_dir=cache_dir)
 
     # Split cal and val
-    # NB: obs_df.sample randomises the rows, then np.split()
-    # divides data into chunks at the desired split points
-    cal_df, val_df = np.split(
-        obs_df.sample(frac=1, random_state=seed),
-        [
-            int(cal_prop * len(obs_df)),
-        ],
-    )
+    # NB: obs_df.sample randomises the rows, which are then divided at the desired split
+    # point. np.split() returns arrays rather than dataframes in recent versions of numpy
+    shuffled = obs_df.sample(frac=1, random_state=seed)
+    n_cal = int(cal_prop * len(obs_df))
+    cal_df, val_df = shuffled.iloc[:n_cal], shuffled.iloc[n_cal:]
 
     return (obs_df, cal_df, val_df)
 
 
-def build_input_dict(st_yr, end_yr, par_list):
-    """Build a dictionary of input data for running TEOTIL2 in calibration mode. Designed
+def build_input_dict(st_yr, end_yr, par_list, data_root=None, cache_dir=None):
+    """Build a packed array of input data for running TEOTIL2 in calibration mode. Designed
        to improve performance compared to looping over dataframes.
 
     Args:
-        st_yr:    Int. Start year of interest
-        end_yr:   Int. Start year of interest
-        par_list: List. Parameters of interest
+        st_yr:     Int. Start year of interest
+        end_yr:    Int. Start year of interest
+        par_list:  List. Parameters of interest
+        data_root: Str. Optional. Folder containing the 'NOPE' folder. Default is
+                   DATA_ROOT
+        cache_dir: Str. Optional. Folder in which to cache the packed data. The cache is
+                   updated whenever the source files change. Cached data are
+                   memory-mapped, so several processes can share them. See
+                   PackedInputs.load()
 
     Returns:
-        Dict with keys ('regine', year) => {'variable':value}
+        PackedInputs object. A read-only mapping supporting
+        in_data[('regine', year)]['variable'] => value, as for the dict returned by
+        previous versions of this function.
     """
-
     # Annual input folder
-    core_fold = (
-        r"C:\Data\James_Work\Staff\Oeyvind_K\Elveovervakingsprogrammet"
-        r"\NOPE\NOPE_Annual_Inputs"
+    data_root = DATA_ROOT if data_root is None else data_root
+    core_fold = os.path.join(data_root, "NOPE", "NOPE_Annual_Inputs")
+    years = list(range(st_yr, end_yr + 1))
+    csv_list = [
+        os.path.join(core_fold, "nope_input_data_%s.csv" % year) for year in years
+    ]
+
+    # Use cached data if available
+    if cache_dir is not None:
+        key = io.source_key(csv_list, years, list(par_list))
+        cache_path = os.path.join(cache_dir, "input_data_%s" % key)
+        if os.path.isdir(cache_path):
+            return PackedInputs.load(cache_path, mmap_mode="r")
+
+    # Only read cols of interest
+    usecols = (
+        ["regine", "q_reg_m3/s"]
+        + ["trans_%s" % par for par in par_list]
+        + ["all_point_%s_tonnes" % par for par in par_list]
+        + [
+            "%s_diff_%s_tonnes" % (src, par)
+            for par in par_list
+            for src in ["nat", "anth"]
+        ]
     )
 
     # Container for output
     df_list = []
 
     # Loop over CSV
-    for year in range(st_yr, end_yr + 1):
+    for year, in_csv in zip(years, csv_list):
         # Read data
-        in_csv = os.path.join(core_fold, "nope_input_data_%s.csv" % year)
-        df = pd.read_csv(in_csv)
+        df = pd.read_csv(in_csv, usecols=usecols)
 
         # Add year
         df["year"] = year
@@ -258,19 +301,219 @@ def build_input_dict(st_yr, end_yr, par_list):
             df["nat_diff_%s_tonnes" % par] + df["anth_diff_%s_tonnes" % par]
         )
 
-    # Get cols of interest
+    # Pack cols of interest
+    in_data = _pack_input_df(df, years, par_list)
+
+    # Add to cache. Write to a temporary folder first, so other processes never see
+    # partial data
+    if cache_dir is not None:
+        tmp_path = "%s.%s.tmp" % (cache_path, os.getpid())
+        in_data.save(tmp_path)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Already added by another process
+            shutil.rmtree(tmp_path)
+        in_data = PackedInputs.load(cache_path, mmap_mode="r")
+
+    return in_data
+
+
+def _input_fields(par_list):
+    """Names of the fields required to run TEOTIL2 in calibration mode."""
     par_cols = ["trans_%s", "all_point_%s_tonnes", "all_diff_%s_tonnes"]
-    cols = [
-        "regine",
-        "year",
-        "q_reg_m3/s",
-    ] + [i % j for i in par_cols for j in par_list]
-    df = df[cols]
 
-    # Convert to dict for speed later
-    in_data = df.set_index(["regine", "year"]).T.to_dict()
+    return ["q_reg_m3/s"] + [i % j for i in par_cols for j in par_list]
 
-    return in_data
+
+def _pack_input_df(df, years, par_list):
+    """Pack a "long" dataframe of input data with columns 'regine', 'year' and the fields
+    given by _input_fields() into a PackedInputs object.
+    """
+    fields = _input_fields(par_list)
+    regine = pd.unique(df["regine"])
+    rows = pd.Index(regine).get_indexer(df["regine"])
+    yr_idx = pd.Index(years).get_indexer(df["year"])
+    assert (yr_idx >= 0).all(), "'df' contains years not in 'years'."
+
+    # (regine, year) pairs not in 'df' are NaN
+    values = np.full((len(regine), len(years), len(fields)), np.nan)
+    values[rows, yr_idx] = df[fields].to_numpy(dtype=float)
+
+    return PackedInputs(regine, years, fields, values)
+
+
+class NodeData(Mapping):
+    """Read-only, dict-like view of one row of columnar data, so that values are not
+       copied into a separate dict for each row. Used by PackedInputs.
+
+    Args:
+        cols: Dict. {name: array} shared by all nodes
+        row:  Int. Position of this node in each array
+    """
+
+    __slots__ = ("_cols", "_row")
+
+    def __init__(self, cols, row):
+        self._cols = cols
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._cols[key][self._row]
+
+    def __iter__(self):
+        return iter(self._cols)
+
+    def __len__(self):
+        return len(self._cols)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class PackedInputs(Mapping):
+    """Input data for running TEOTIL2 in calibration mode, packed into a single array with
+       shape (n_nodes, n_years, n_fields). Returned by build_input_dict(). Also a read-only
+       mapping with the same keys as the dict previously returned by build_input_dict()
+       i.e. in_data[(regine, year)][field], where each value is a lightweight view of one
+       row. (regine, year) pairs missing from the input files are stored as NaN, but are
+       not keys of the mapping.
+
+    Attributes:
+        regine: Array of str. Regine IDs
+        years:  List of int. Years
+        fields: List of str. Field names e.g. 'q_reg_m3/s' or 'trans_{par}'
+        data:   Array with shape (n_nodes, n_years, n_fields). May be a memory-mapped
+                array (see load())
+    """
+
+    def __init__(self, regine, years, fields, data):
+        self.regine = np.asarray(regine, dtype=object)
+        self.years = [int(year) for year in years]
+        self.fields = [str(field) for field in fields]
+        self.data = data
+        self.index = pd.Index(self.regine)
+        self._yr_idx = {year: idx for idx, year in enumerate(self.years)}
+        self._field_views = {
+            field: data[:, :, idx] for idx, field in enumerate(self.fields)
+        }
+        self._present = None
+
+    @property
+    def present(self):
+        """Array of bool with shape (n_nodes, n_years). Whether each (regine, year) pair
+        has data i.e. is not entirely NaN.
+        """
+        if self._present is None:
+            self._present = ~np.isnan(self.data).all(axis=2)
+
+        return self._present
+
+    def __len__(self):
+        return int(self.present.sum())
+
+    def __repr__(self):
+        return "PackedInputs(n_nodes=%s, years=%s-%s, n_fields=%s)" % (
+            len(self.regine),
+            self.years[0],
+            self.years[-1],
+            len(self.fields),
+        )
+
+    def __iter__(self):
+        """(regine, year) keys, ordered by year and then by regine."""
+        yr_idx, rows = np.nonzero(self.present.T)
+        for row, idx in zip(rows, yr_idx):
+            yield (self.regine[row], self.years[idx])
+
+    def __contains__(self, key):
+        try:
+            self._locate(key)
+        except KeyError:
+            return False
+
+        return True
+
+    def __getitem__(self, key):
+        """Fields for 'key' = (regine, year) as a read-only, dict-like view."""
+        return NodeData(self._field_views, self._locate(key))
+
+    def _locate(self, key):
+        """Position of 'key' = (regine, year) in 'data'. Raises KeyError if absent."""
+        try:
+            nd, year = key
+            row = (self.index.get_loc(nd), self._yr_idx[year])
+        except (KeyError, TypeError, ValueError):
+            raise KeyError(key) from None
+        if not self.present[row]:
+            raise KeyError(key)
+
+        return row
+
+    def select(self, regine, years):
+        """Values for the nodes in 'regine' and years in 'years'.
+
+        Args:
+            regine: List of str. Regine IDs
+            years:  List of int. Years
+
+        Returns:
+            Array with shape (len(regine), len(years), n_fields).
+        """
+        rows = self.index.get_indexer(regine)
+        assert (rows >= 0).all(), "Some regine IDs are not in the input data."
+        yr_idx = [self._yr_idx[year] for year in years]
+
+        return self.data[rows[:, np.newaxis], yr_idx]
+
+    def save(self, path):
+        """Save the packed inputs. If 'path' ends with '.npz', a single (uncompressed)
+        .npz file is written. Otherwise, 'path' is treated as a folder and each array is
+        saved as a separate .npy file, which allows the data to be memory-mapped by
+        load().
+        """
+        arrays = {
+            "regine": self.regine.astype(str),
+            "years": np.array(self.years),
+            "fields": np.array(self.fields),
+            "values": self.data,
+        }
+        if path.endswith(".npz"):
+            np.savez(path, **arrays)
+        else:
+            os.makedirs(path, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(os.path.join(path, "%s.npy" % name), arr)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Load packed inputs saved using PackedInputs.save().
+
+        Args:
+            path:      Str. Path to .npz file or folder
+            mmap_mode: Str. Optional. E.g. 'r'. Memory-map the data array, so that
+                       several processes can share the data without each reading it
+                       into memory. Only supported for folders
+
+        Returns:
+            PackedInputs object.
+        """
+        if path.endswith(".npz"):
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+        else:
+            arrays = {
+                name: np.load(
+                    os.path.join(path, "%s.npy" % name),
+                    mmap_mode=mmap_mode if name == "values" else None,
+                    allow_pickle=False,
+                )
+                for name in ["regine", "years", "fields", "values"]
+            }
+
+        return cls(
+            arrays["regine"], arrays["years"], arrays["fields"], arrays["values"]
+        )
 
 
 def run_model_multi_year(
@@ -285,7 +528,9 @@ def run_model_multi_year(
         nd_list:   List. Topologically sorted list of nodes of g
         st_yr:     Int. Start year of interest
         end_yr:    Int. End year of interest
-        in_data    Dict. All data required to run model
+        in_data    PackedInputs or dict. All data required to run model. If 'in_data' is a
+                   PackedInputs and 'g' was created by build_calib_network(), the model is
+                   run using CalibModel and the node attributes of 'g' are not updated
         par_list:  List of parameters in the input file
         reg_set:   List of regine IDs of interest
         cal_pars:  Dict. Calibration parameters
@@ -294,12 +539,15 @@ def run_model_multi_year(
         Dataframe of annual accumulated loads for IDs in reg_set.
     """
     # Build cal_par dict if necessary
-    if cal_pars is None:
-        cal_pars = {}
-        for par in par_list:
-            for coef in ["b_r", "b_p", "b_d"]:
-                # Set defaults to 1
-                cal_pars["%s_%s" % (coef, par)] = 1
+    cal_pars = _get_cal_pars(cal_pars, par_list)
+
+    if isinstance(in_data, PackedInputs) and ("network" in g.graph):
+        # Use array-based engine. Index matches the result of the loop below
+        cm = CalibModel(g, st_yr, end_yr, in_data, par_list, reg_set)
+        df = cm.run(cal_pars)
+        df.index = np.tile(np.arange(len(reg_set)), len(cm.years))
+
+        return df
 
     # Container for output
     df_list = []
@@ -320,3 +568,861 @@ def run_model_multi_year(
     df = df[cols]
 
     return df
+
+
+def _get_cal_pars(cal_pars, par_list):
+    """Default calibration parameters (all equal to 1) if 'cal_pars' is None."""
+    if cal_pars is None:
+        cal_pars = {}
+        for par in par_list:
+            for coef in ["b_r", "b_p", "b_d"]:
+                # Set defaults to 1
+                cal_pars["%s_%s" % (coef, par)] = 1
+
+    return cal_pars
+
+
+def _get_b_r_pars(cal_pars, par_list):
+    """Default calibration parameters (all equal to 1), updated with any retention
+    multipliers ('b_r_{par}') in 'cal_pars'. Other values in 'cal_pars' are ignored.
+    """
+    b_r_pars = {k: v for k, v in (cal_pars or {}).items() if k.startswith("b_r_")}
+
+    return {**_get_cal_pars(None, par_list), **b_r_pars}
+
+
+def pack_input_dict(in_data, nd_list, years, par_list):
+    """Pack a dict of input data with keys ('regine', year) => {'variable':value}, as
+       returned by previous versions of build_input_dict(), into a PackedInputs object.
+
+    Args:
+        in_data:  Dict. All data required to run model
+        nd_list:  List. Regine IDs of interest
+        years:    List of int. Years of interest
+        par_list: List. Parameters of interest
+
+    Returns:
+        PackedInputs object.
+    """
+    fields = _input_fields(par_list)
+    values = np.array(
+        [
+            [[in_data[(nd, year)][field] for field in fields] for year in years]
+            for nd in nd_list
+        ],
+        dtype=float,
+    ).reshape(len(nd_list), len(years), len(fields))
+
+    return PackedInputs(nd_list, years, fields, values)
+
+
+class CalibModel:
+    """Array-based engine for running TEOTIL2 in calibration mode. Gives the same results
+       as run_model_multi_year(), but the input data are packed once into arrays with
+       shape (n_nodes, n_years, n_pars) and calibration parameters are applied as vector
+       broadcasts. All years are accumulated in a single sweep over the calibration
+       sub-network, so each set of calibration parameters can be evaluated quickly e.g.
+       within an optimiser.
+
+       For fixed retention multipliers ('b_r'), 'b_p' and 'b_d' can be evaluated or
+       fitted without re-accumulating the network. See get_basis(), run_linear() and
+       fit_source_factors(). Results for previously used values of 'b_r' can also be
+       kept in a CalibCache.
+
+    Attributes:
+        net:      Network object for the calibration sub-network
+        years:    List of int. Years of interest
+        par_list: List of parameters in the input file
+        reg_set:  List of regine IDs of interest
+        cache:    CalibCache or None
+    """
+
+    def __init__(self, g, st_yr, end_yr, in_data, par_list, reg_set, cache=None):
+        """Pack input data for the calibration sub-network.
+
+        Args:
+            g:        NetworkX graph returned by build_calib_network()
+            st_yr:    Int. Start year of interest
+            end_yr:   Int. End year of interest
+            in_data:  PackedInputs or dict. All data required to run model. See
+                      build_input_dict()
+            par_list: List of parameters in the input file
+            reg_set:  List of regine IDs of interest
+            cache:    CalibCache. Optional. If supplied, station-level results for each
+                      (rounded) set of 'b_r' values are cached and run() evaluates 'b_p'
+                      and 'b_d' using run_linear(). See get_basis()
+        """
+        assert "network" in g.graph, "'g' must be created by build_calib_network()."
+        self.net = g.graph["network"]
+        self.years = list(range(st_yr, end_yr + 1))
+        self.par_list = list(par_list)
+        self.reg_set = list(reg_set)
+
+        if not isinstance(in_data, PackedInputs):
+            in_data = pack_input_dict(
+                in_data, self.net.regine, self.years, self.par_list
+            )
+        self._set_fields(in_data.select(self.net.regine, self.years), in_data.fields)
+        self._data_key = self._hash_fields()
+
+        self._rows = self.net.get_indexer(self.reg_set)
+        assert (self._rows >= 0).all(), "Some IDs in 'reg_set' are not in 'g'."
+        self._basis = None
+        self.cache = cache
+
+    def _set_fields(self, values, fields):
+        """Split packed input data into contiguous arrays for each type of field."""
+        field_idx = {field: idx for idx, field in enumerate(fields)}
+
+        def get_fields(name):
+            idx = [field_idx[name % par] for par in self.par_list]
+            return np.ascontiguousarray(values[:, :, idx])
+
+        self._q = np.ascontiguousarray(values[:, :, field_idx["q_reg_m3/s"]])
+        self._trans = get_fields("trans_%s")
+        self._point = get_fields("all_point_%s_tonnes")
+        self._diff = get_fields("all_diff_%s_tonnes")
+
+    def _hash_fields(self):
+        """Hash of the input arrays, used in CalibCache keys."""
+        key = hashlib.sha1()
+        for arr in [self._q, self._trans, self._point, self._diff]:
+            key.update(str(arr.shape).encode())
+            key.update(np.ascontiguousarray(arr).tobytes())
+
+        return key.hexdigest()
+
+    def _get_state(self):
+        """Arrays and (small) metadata needed to recreate the model in another process.
+        See evaluate_parallel().
+        """
+        arrays = {
+            name: getattr(self, name)
+            for name in ["_q", "_trans", "_point", "_diff", "_rows"]
+        }
+        arrays.update(
+            {
+                "net_%s" % name: getattr(self.net, name)
+                for name in model.Network._arrays[2:]
+            }
+        )
+        meta = {
+            "years": self.years,
+            "par_list": self.par_list,
+            "reg_set": self.reg_set,
+            "regine": self.net.regine,
+            "regine_ned": self.net.regine_ned,
+            "key": self.net.key,
+            "data_key": self._data_key,
+            "cache": (
+                None
+                if self.cache is None
+                else (self.cache.max_bytes, self.cache.decimals)
+            ),
+        }
+
+        return arrays, meta
+
+    @classmethod
+    def _from_state(cls, arrays, meta):
+        """Recreate a model from the output of _get_state(), without copying arrays."""
+        cm = cls.__new__(cls)
+        cm.net = model.Network(
+            meta["regine"],
+            meta["regine_ned"],
+            *[arrays["net_%s" % name] for name in model.Network._arrays[2:]],
+            key=meta["key"],
+        )
+        cm.years = meta["years"]
+        cm.par_list = meta["par_list"]
+        cm.reg_set = meta["reg_set"]
+        for name in ["_q", "_trans", "_point", "_diff", "_rows"]:
+            setattr(cm, name, arrays[name])
+        cm._data_key = meta["data_key"]
+        cm._basis = None
+        cm.cache = None if meta["cache"] is None else CalibCache(*meta["cache"])
+
+        return cm
+
+    def run(self, cal_pars=None, as_array=False):
+        """Run model for all years.
+
+        Args:
+            cal_pars: Dict. Calibration parameters. Defaults to 1 for all parameters
+            as_array: Bool. Default False. Whether to return results as an array with
+                      shape (n_regines, n_years, n_pars + 1), where the first column is
+                      flow and the rest are loads for each parameter in 'par_list'
+
+        Returns:
+            Dataframe of annual accumulated loads for IDs in reg_set, with the same format
+            as run_model_multi_year(). Alternatively, an array (see above).
+        """
+        if self.cache is not None:
+            return self.run_linear(cal_pars, as_array=as_array)
+
+        b_r, b_p, b_d = self._get_coefs(cal_pars)
+
+        # Local inputs and transmission. Flow is not subject to retention
+        n_nds, n_yrs, n_pars = self._point.shape
+        local = np.empty((n_nds, n_yrs, n_pars + 1))
+        local[:, :, 0] = self._q
+        np.multiply(self._point, b_p, out=local[:, :, 1:])
+        local[:, :, 1:] += self._diff * b_d
+        trans = np.ones_like(local)
+        np.multiply(self._trans, b_r, out=trans[:, :, 1:])
+
+        # Accumulate all years together
+        accum = model.accumulate_arrays(self.net, local, trans, inplace=True)
+        res = accum[self._rows]
+
+        return res if as_array else self._to_dataframe(res)
+
+    def _get_coefs(self, cal_pars):
+        """Arrays of 'b_r', 'b_p' and 'b_d' coefficients for each parameter."""
+        cal_pars = _get_cal_pars(cal_pars, self.par_list)
+
+        return [
+            np.array([cal_pars["%s_%s" % (coef, par)] for par in self.par_list])
+            for coef in ["b_r", "b_p", "b_d"]
+        ]
+
+    def _to_dataframe(self, res):
+        """Convert an array of results to the same format as run_model_multi_year()."""
+        # Rows are ordered by year, then by 'reg_set'
+        n_stns, n_yrs, n_cols = res.shape
+        cols = ["q_m3/s"] + ["%s_tonnes" % i for i in self.par_list]
+        df = pd.DataFrame(res.transpose(1, 0, 2).reshape(-1, n_cols), columns=cols)
+        df.insert(0, "regine", np.tile(np.array(self.reg_set, dtype=object), n_yrs))
+        df.insert(1, "year", np.repeat(self.years, n_stns))
+
+        return df
+
+    def get_basis(self, cal_pars=None):
+        """Accumulate point and diffuse inputs separately, using the retention multipliers
+           ('b_r_{par}') in 'cal_pars'. For fixed 'b_r', accumulated loads are linear in
+           'b_p' and 'b_d', so results for any combination of 'b_p' and 'b_d' are given by
+           (b_p * point) + (b_d * diff). The most recent result is cached, so the network
+           only needs to be accumulated again when 'b_r' changes. If the model has a
+           CalibCache, results for all previously used (rounded) values of 'b_r' are
+           kept, subject to the cache's memory limit.
+
+        Args:
+            cal_pars: Dict. Calibration parameters. Only 'b_r_{par}' are used. Defaults
+                      to 1 for all parameters
+
+        Returns:
+            Tuple (q, point, diff). 'q' is an array of accumulated flows with shape
+            (n_regines, n_years). 'point' and 'diff' are arrays of accumulated loads with
+            shape (n_regines, n_years, n_pars) for point and diffuse inputs, respectively.
+        """
+        b_r = self._get_coefs(_get_b_r_pars(cal_pars, self.par_list))[0]
+        if self.cache is not None:
+            b_r = np.array(self.cache.round(b_r))
+            key = (
+                self.net.key,
+                self._data_key,
+                tuple(self.years),
+                tuple(self.par_list),
+                tuple(self.reg_set),
+                tuple(b_r),
+            )
+            basis = self.cache.get(key)
+            if basis is None:
+                basis = self._accumulate_basis(b_r)
+                self.cache.put(key, basis)
+
+            return basis
+
+        if (self._basis is not None) and np.array_equal(self._basis[0], b_r):
+            return self._basis[1]
+        basis = self._accumulate_basis(b_r)
+        self._basis = (b_r, basis)
+
+        return basis
+
+    def _accumulate_basis(self, b_r):
+        """Accumulate flow, point and diffuse inputs. See get_basis()."""
+        n_nds, n_yrs, n_pars = self._point.shape
+        local = np.concatenate(
+            [self._q[:, :, np.newaxis], self._point, self._diff], axis=2
+        )
+        trans = np.ones_like(local)
+        np.multiply(self._trans, b_r, out=trans[:, :, 1 : n_pars + 1])
+        trans[:, :, n_pars + 1 :] = trans[:, :, 1 : n_pars + 1]
+        accum = model.accumulate_arrays(self.net, local, trans, inplace=True)
+        accum = accum[self._rows]
+        accum.flags.writeable = False
+
+        return (accum[:, :, 0], accum[:, :, 1 : n_pars + 1], accum[:, :, n_pars + 1 :])
+
+    def run_linear(self, cal_pars=None, as_array=False):
+        """Run model for all years using the point and diffuse "basis" runs from
+           get_basis(). Gives the same results as run(), but only accumulates over the
+           network when 'b_r' changes.
+
+        Args:
+            cal_pars: Dict. Calibration parameters. Defaults to 1 for all parameters
+            as_array: Bool. Default False. See run()
+
+        Returns:
+            Dataframe or array. See run().
+        """
+        b_r, b_p, b_d = self._get_coefs(cal_pars)
+        q, point, diff = self.get_basis(cal_pars)
+        res = np.empty(q.shape + (len(self.par_list) + 1,))
+        res[:, :, 0] = q
+        np.multiply(point, b_p, out=res[:, :, 1:])
+        res[:, :, 1:] += diff * b_d
+
+        return res if as_array else self._to_dataframe(res)
+
+    def align_obs(self, obs_df):
+        """Align observed data with model results.
+
+        Args:
+            obs_df: Dataframe of observations with columns 'regine' and 'year', plus
+                    'q_m3/s' and/or '{par}_tonnes' for parameters in 'par_list'
+
+        Returns:
+            Array with shape (n_regines, n_years, n_pars + 1), in the same format as run()
+            with as_array=True. Missing values are NaN.
+        """
+        cols = ["q_m3/s"] + ["%s_tonnes" % i for i in self.par_list]
+        rows, yr_idx = self._obs_index(obs_df)
+        keep = (rows >= 0) & (yr_idx >= 0)
+
+        obs = np.full((len(self.reg_set), len(self.years), len(cols)), np.nan)
+        for idx, col in enumerate(cols):
+            if col in obs_df.columns:
+                vals = obs_df[col].to_numpy(dtype=float)
+                obs[rows[keep], yr_idx[keep], idx] = vals[keep]
+
+        return obs
+
+    def _obs_index(self, obs_df):
+        """Positions of each row of 'obs_df' in 'reg_set' and 'years' (-1 if absent)."""
+        rows = pd.Index(self.reg_set).get_indexer(obs_df["regine"])
+        yr_idx = pd.Index(self.years).get_indexer(obs_df["year"])
+
+        return rows, yr_idx
+
+    def fit_source_factors(self, obs_df, cal_pars=None, non_negative=True):
+        """Least-squares estimates of 'b_p' and 'b_d' for each parameter, given the
+           retention multipliers ('b_r') in 'cal_pars'. Uses the basis runs from
+           get_basis(), so the network is only accumulated once per value of 'b_r'.
+
+        Args:
+            obs_df:       Dataframe of observed loads. See align_obs()
+            cal_pars:     Dict. Calibration parameters. Only 'b_r_{par}' are used.
+                          Defaults to 1 for all parameters
+            non_negative: Bool. Default True. Whether to constrain 'b_p' and 'b_d' to be
+                          >= 0
+
+        Returns:
+            Dict. Calibration parameters, with 'b_r' from 'cal_pars' and fitted values
+            for 'b_p' and 'b_d'.
+        """
+        return self._fit_source_factors(self.align_obs(obs_df), cal_pars, non_negative)[
+            0
+        ]
+
+    def _fit_source_factors(self, obs, cal_pars, non_negative):
+        """See fit_source_factors(). 'obs' is an array from align_obs(). Also returns an
+        array of the sum of squared errors for each parameter.
+        """
+        cal_pars = _get_b_r_pars(cal_pars, self.par_list)
+        q, point, diff = self.get_basis(cal_pars)
+
+        sse = np.zeros(len(self.par_list))
+        for idx, par in enumerate(self.par_list):
+            y = obs[:, :, idx + 1]
+            mask = np.isfinite(y)
+            assert mask.any(), f"No observations for '{par}'."
+            x_p, x_d = point[:, :, idx][mask], diff[:, :, idx][mask]
+            b_p, b_d = _fit_two_factors(x_p, x_d, y[mask], non_negative)
+            cal_pars["b_p_%s" % par] = b_p
+            cal_pars["b_d_%s" % par] = b_d
+            sse[idx] = (((b_p * x_p) + (b_d * x_d) - y[mask]) ** 2).sum()
+
+        return cal_pars, sse
+
+    def calibrate(self, obs_df, b_r_values, non_negative=True):
+        """Calibrate the model against observed loads. For each value in 'b_r_values',
+           'b_p' and 'b_d' are estimated by least squares (see fit_source_factors()) and,
+           for each parameter, the combination with the lowest sum of squared errors is
+           chosen. The network is only accumulated once for each value of 'b_r'.
+
+        Args:
+            obs_df:       Dataframe of observed loads. See align_obs()
+            b_r_values:   List of float. Candidate retention multipliers. Each value is
+                          applied to all parameters, but the best value is chosen for
+                          each parameter separately
+            non_negative: Bool. Default True. Whether to constrain 'b_p' and 'b_d' to be
+                          >= 0
+
+        Returns:
+            Dict. Calibration parameters.
+        """
+        return self._calibrate(self.align_obs(obs_df), b_r_values, non_negative)
+
+    def _calibrate(self, obs, b_r_values, non_negative):
+        """See calibrate(). 'obs' is an array from align_obs()."""
+        best_sse = np.full(len(self.par_list), np.inf)
+        best_pars = {}
+        for b_r in b_r_values:
+            cal_pars = _get_cal_pars(None, self.par_list)
+            cal_pars.update({"b_r_%s" % par: b_r for par in self.par_list})
+            cal_pars, sse = self._fit_source_factors(obs, cal_pars, non_negative)
+            for idx, par in enumerate(self.par_list):
+                if sse[idx] < best_sse[idx]:
+                    best_sse[idx] = sse[idx]
+                    for coef in ["b_r", "b_p", "b_d"]:
+                        key = "%s_%s" % (coef, par)
+                        best_pars[key] = cal_pars[key]
+
+        return best_pars
+
+
+class CalibCache:
+    """Least-recently-used cache of station-level results for CalibModel. Each entry
+       holds the accumulated flows and point and diffuse loads returned by
+       CalibModel.get_basis(), keyed on the calibration sub-network, a hash of the input
+       data, years, parameters, stations and retention multipliers ('b_r'). Since results for any 'b_p' and 'b_d' are cheap
+       to calculate from these, repeated evaluations with previously used values of
+       'b_r' (including exact repeats of whole parameter sets) do not require the
+       network to be accumulated again.
+
+    Attributes:
+        max_bytes: Int. Maximum total size of the cached arrays. Least-recently-used
+                   entries are discarded when this is exceeded
+        decimals:  Int. Number of decimal places to which parameters are rounded
+        hits:      Int. Number of lookups found in the cache
+        misses:    Int. Number of lookups not found in the cache
+        nbytes:    Int. Current total size of the cached arrays
+    """
+
+    def __init__(self, max_bytes=2**28, decimals=6):
+        self.max_bytes = max_bytes
+        self.decimals = decimals
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "CalibCache(n_entries=%s, nbytes=%s, hits=%s, misses=%s)" % (
+            len(self),
+            self.nbytes,
+            self.hits,
+            self.misses,
+        )
+
+    @property
+    def hit_rate(self):
+        """Float. Fraction of lookups found in the cache."""
+        n_lookups = self.hits + self.misses
+
+        return self.hits / n_lookups if n_lookups > 0 else 0.0
+
+    def round(self, values):
+        """Round parameter values for use in cache keys."""
+        return tuple(round(float(val), self.decimals) for val in values)
+
+    def get(self, key):
+        """Cached value for 'key', or None if not present."""
+        if key in self._data:
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+        self.misses += 1
+
+        return None
+
+    def put(self, key, value):
+        """Add 'value' (a tuple of arrays) to the cache. Values larger than 'max_bytes'
+        are not stored.
+        """
+        size = sum(arr.nbytes for arr in value)
+        if size > self.max_bytes:
+            return
+        if key in self._data:
+            self.nbytes -= self._data.pop(key)[1]
+        self._data[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        self._data.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+def _fit_two_factors(x1, x2, y, non_negative=True):
+    """Least-squares solution of y = (b1 * x1) + (b2 * x2), optionally with b1, b2 >= 0.
+
+    Args:
+        x1, x2:       Arrays of float
+        y:            Array of float
+        non_negative: Bool. Whether to constrain b1 and b2 to be >= 0
+
+    Returns:
+        Tuple (b1, b2).
+    """
+    a = np.column_stack([x1, x2])
+    coefs = np.linalg.lstsq(a, y, rcond=None)[0]
+    if not non_negative or (coefs >= 0).all():
+        return (float(coefs[0]), float(coefs[1]))
+
+    # Optimum is on the boundary. Compare single-factor fits
+    cands = [np.zeros(2)]
+    for idx in range(2):
+        denom = a[:, idx] @ a[:, idx]
+        if denom > 0:
+            cand = np.zeros(2)
+            cand[idx] = max(a[:, idx] @ y / denom, 0)
+            cands.append(cand)
+    sse = [((a @ cand - y) ** 2).sum() for cand in cands]
+
+    best = cands[int(np.argmin(sse))]
+
+    return (float(best[0]), float(best[1]))
+
+
+def sse_objective(sim, obs):
+    """Default objective function for evaluate_parallel(). Sum of squared errors for all
+       loads (not flows) with observations.
+
+    Args:
+        sim: Array with shape (n_regines, n_years, n_pars + 1). Simulated flows and loads
+        obs: Array with the same shape as 'sim'. Observed values. NaN where missing
+
+    Returns:
+        Float.
+    """
+    err = sim[:, :, 1:] - obs[:, :, 1:]
+
+    return float(np.nansum(err**2))
+
+
+# Per-process state for worker processes. See _map_shared()
+_WORKER = {}
+
+
+def evaluate_parallel(cm, cand_list, obs_df=None, objective=None, n_workers=None):
+    """Evaluate a batch of calibration parameter sets in parallel. The packed input data and
+       network arrays for 'cm' are copied once into shared memory, which all worker
+       processes read directly, so only the parameter sets and results are sent between
+       processes.
+
+    Args:
+        cm:        CalibModel object
+        cand_list: List of dicts. Candidate calibration parameters. See CalibModel.run()
+        obs_df:    Dataframe. Optional. Observed data. See CalibModel.align_obs()
+        objective: Function. Optional. objective(sim, obs) => float, where 'sim' and
+                   'obs' are arrays in the format returned by CalibModel.align_obs().
+                   Must be defined at module level, so that it can be pickled. Default
+                   is sse_objective()
+        n_workers: Int. Optional. Number of worker processes. Default is os.cpu_count()
+
+    Returns:
+        Tuple (obj, res), in the same order as 'cand_list'. 'obj' is an array of objective
+        values (NaN if 'obs_df' is None). 'res' is an array of simulated flows and loads
+        with shape (n_cands, n_regines, n_years, n_pars + 1). See CalibModel.run().
+    """
+    arrays = {} if obs_df is None else {"obs": cm.align_obs(obs_df)}
+    meta = {"objective": sse_objective if objective is None else objective}
+    out = _map_shared(cm, _evaluate_worker, cand_list, arrays, meta, n_workers)
+
+    obj = np.array([i[0] for i in out])
+    res = np.stack([i[1] for i in out])
+
+    return (obj, res)
+
+
+def _map_shared(cm, func, tasks, arrays=None, meta=None, n_workers=None):
+    """Apply 'func' to each item in 'tasks' using a pool of worker processes. The state
+       of 'cm', plus any additional 'arrays', is copied once into a single shared memory
+       block. Each worker attaches to this block when it starts and recreates 'cm'
+       without copying. See _init_worker().
+
+    Args:
+        cm:        CalibModel object
+        func:      Function. Must be defined at module level
+        tasks:     List. Arguments for 'func'
+        arrays:    Dict. Optional. Additional arrays to share with the workers
+        meta:      Dict. Optional. Additional (small) objects to send to each worker
+        n_workers: Int. Optional. Number of worker processes. Default is os.cpu_count()
+
+    Returns:
+        List of results, in the same order as 'tasks'.
+    """
+    state_arrays, state_meta = cm._get_state()
+    state_arrays.update(arrays or {})
+    state_meta.update(meta or {})
+
+    # Copy arrays to a single shared memory block
+    spec, offset = {}, 0
+    for name, arr in state_arrays.items():
+        spec[name] = (offset, arr.shape, arr.dtype.str)
+        offset += -(-arr.nbytes // 8) * 8
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        for name, arr in _shared_arrays(shm, spec).items():
+            arr[...] = state_arrays[name]
+        del state_arrays
+
+        with mp.Pool(
+            n_workers, initializer=_init_worker, initargs=(shm.name, spec, state_meta)
+        ) as pool:
+            out = pool.map(func, tasks)
+
+            # Let workers exit normally, so they detach from the shared block
+            pool.close()
+            pool.join()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out
+
+
+def _shared_arrays(shm, spec):
+    """Arrays backed by the shared memory block 'shm'. See _map_shared()."""
+    return {
+        name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for name, (offset, shape, dtype) in spec.items()
+    }
+
+
+def _attach_shared(name):
+    """Attach to the shared memory block 'name' without registering it with the resource
+    tracker. The block is owned, and unlinked, by the parent process. See _map_shared().
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    # Earlier versions always register the block when attaching. Workers share the
+    # parent's resource tracker, so unregistering afterwards would also remove the
+    # parent's registration. Skip registration instead
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def _init_worker(shm_name, spec, meta):
+    """Attach a worker process to the shared data. See _map_shared()."""
+    shm = _attach_shared(shm_name)
+    try:
+        arrays = _shared_arrays(shm, spec)
+        _WORKER["cm"] = CalibModel._from_state(arrays, meta)
+        _WORKER["arrays"] = arrays
+        _WORKER["meta"] = meta
+    except BaseException:
+        _WORKER.clear()
+        shm.close()
+        raise
+    _WORKER["shm"] = shm
+    Finalize(None, _close_worker, exitpriority=10)
+
+
+def _close_worker():
+    """Detach a worker process from the shared data when it exits. See _init_worker()."""
+    shm = _WORKER.get("shm")
+    _WORKER.clear()
+    if shm is not None:
+        shm.close()
+
+
+def _evaluate_worker(cal_pars):
+    """Run the model and objective function for one parameter set in a worker process."""
+    res = _WORKER["cm"].run(cal_pars, as_array=True)
+    obs = _WORKER["arrays"].get("obs")
+    obj = np.nan if obs is None else _WORKER["meta"]["objective"](res, obs)
+
+    return (obj, res)
+
+
+def make_folds(obs_df, n_folds=5, groups=None, seed=1):
+    """Assign observations to folds for cross-validation. See cross_validate().
+
+    Args:
+        obs_df:  Dataframe of observations e.g. as returned by read_obs_data()
+        n_folds: Int or None. Number of folds. If None, each group in 'groups' is a
+                 separate fold i.e. "leave-one-group-out"
+        groups:  Str. Optional. Column in 'obs_df' e.g. 'regine' or 'station_id'. If
+                 supplied, all observations for each group are assigned to the same fold.
+                 Otherwise, rows are assigned to folds at random
+        seed:    Int. For repeatability
+
+    Returns:
+        Array of int. Fold number for each row in 'obs_df'.
+    """
+    rng = np.random.default_rng(seed)
+    if groups is None:
+        assert n_folds is not None, "'n_folds' must be specified if 'groups' is None."
+        folds = np.arange(len(obs_df)) % n_folds
+        rng.shuffle(folds)
+
+        return folds
+
+    codes, uniques = pd.factorize(obs_df[groups])
+    if n_folds is None:
+        n_folds = len(uniques)
+    grp_folds = rng.permutation(len(uniques)) % n_folds
+
+    return grp_folds[codes]
+
+
+def cross_validate(cm, obs_df, folds, b_r_values, non_negative=True, n_workers=None):
+    """Cross-validate the calibration procedure in CalibModel.calibrate(). For each fold,
+       the model is calibrated using observations from all other folds and skill scores
+       are calculated for both the calibration and validation data. Folds are processed in
+       parallel, with the packed input data shared between worker processes (see
+       evaluate_parallel()). Each worker caches the basis runs for each value of 'b_r',
+       so the network is accumulated at most once per value of 'b_r' in each worker.
+
+    Args:
+        cm:           CalibModel object
+        obs_df:       Dataframe of observed loads. See CalibModel.align_obs()
+        folds:        Array of int. Fold number for each row of 'obs_df'. See make_folds()
+        b_r_values:   List of float. Candidate retention multipliers. See
+                      CalibModel.calibrate()
+        non_negative: Bool. Default True. Whether to constrain 'b_p' and 'b_d' to be >= 0
+        n_workers:    Int. Optional. Number of worker processes. Default is
+                      os.cpu_count()
+
+    Returns:
+        Dataframe with one row per fold, parameter and dataset ('cal' or 'val'), with
+        skill scores and the calibrated parameters for each fold.
+    """
+    # Fold number for each (regine, year) in 'cm'. -1 if no observations
+    folds = np.asarray(folds)
+    assert len(folds) == len(obs_df), "'folds' must have one value per row of 'obs_df'."
+    rows, yr_idx = cm._obs_index(obs_df)
+    keep = (rows >= 0) & (yr_idx >= 0)
+    fold_arr = np.full((len(cm.reg_set), len(cm.years)), -1)
+    fold_arr[rows[keep], yr_idx[keep]] = folds[keep]
+
+    arrays = {"obs": cm.align_obs(obs_df), "folds": fold_arr}
+    meta = {"b_r_values": list(b_r_values), "non_negative": non_negative}
+    if cm.cache is None:
+        cache = CalibCache()
+        meta["cache"] = (cache.max_bytes, cache.decimals)
+    fold_list = [int(i) for i in np.unique(folds[keep])]
+    out = _map_shared(cm, _cv_worker, fold_list, arrays, meta, n_workers)
+
+    return pd.DataFrame([row for rows in out for row in rows])
+
+
+def _cv_worker(fold):
+    """Calibrate and validate for one fold in a worker process. See cross_validate()."""
+    cm, arrays, meta = _WORKER["cm"], _WORKER["arrays"], _WORKER["meta"]
+    obs = arrays["obs"]
+    is_val = (arrays["folds"] == fold)[:, :, np.newaxis]
+    datasets = {
+        "cal": np.where(is_val, np.nan, obs),
+        "val": np.where(is_val, obs, np.nan),
+    }
+
+    cal_pars = cm._calibrate(datasets["cal"], meta["b_r_values"], meta["non_negative"])
+    sim = cm.run_linear(cal_pars, as_array=True)
+    scores = {
+        dataset: skill_scores(sim, dataset_obs, by_station=False)
+        for dataset, dataset_obs in datasets.items()
+    }
+
+    rows = []
+    for dataset in datasets:
+        for idx, par in enumerate(cm.par_list):
+            row = {"fold": fold, "par": par, "dataset": dataset}
+            row.update({key: val[idx + 1] for key, val in scores[dataset].items()})
+            for coef in ["b_r", "b_p", "b_d"]:
+                row[coef] = cal_pars["%s_%s" % (coef, par)]
+            rows.append(row)
+
+    return rows
+
+
+def skill_scores(sim, obs, by_station=True):
+    """Skill scores for simulated flows and loads, for all stations, parameters and
+       (optionally) candidate parameter sets at once. Only (station, year) pairs with
+       observations are used. Sums are calculated using np.einsum(), so the only temporary
+       arrays the same size as 'sim' are one float and one bool buffer.
+
+    Args:
+        sim:        Array with shape (..., n_regines, n_years, n_cols) e.g. as returned by
+                    CalibModel.run() with as_array=True. Any leading dimensions (e.g.
+                    candidate parameter sets from evaluate_parallel()) are retained
+        obs:        Array with shape (n_regines, n_years, n_cols). Observed values, NaN
+                    where missing. See CalibModel.align_obs(), which can also be used to
+                    align dataframes returned by run_model_multi_year()
+        by_station: Bool. Default True. Whether to calculate scores for each station
+                    separately, or using all stations and years together
+
+    Returns:
+        Dict of arrays {metric: values}, where 'metric' is one of 'n_obs', 'bias_pct',
+        'nse', 'rmse', 'log_rmse' and 'r' (Pearson's correlation coefficient). Arrays
+        have shape (..., n_regines, n_cols) or, if 'by_station' is False, (..., n_cols).
+        Scores are NaN where there are insufficient data. 'log_rmse' only uses pairs where
+        both values are > 0.
+    """
+    # Sum over years, or over stations and years
+    out = "...sc" if by_station else "...c"
+    subs, subs_ss = "...syc,syc->" + out, "...syc,...syc->" + out
+    sum_axis = -2 if by_station else (-3, -2)
+    mask = np.isfinite(obs)
+    obs = np.where(mask, obs, 0.0)
+    ones = mask.astype(float)
+
+    # Simulated values where there are observations, set to zero elsewhere
+    buf = np.multiply(sim, ones)
+    n_obs = ones.sum(axis=sum_axis)
+    sum_o = obs.sum(axis=sum_axis)
+    sum_oo = (obs**2).sum(axis=sum_axis)
+    sum_s = np.einsum(subs, buf, ones)
+    sum_ss = np.einsum(subs_ss, buf, buf)
+    sum_so = np.einsum(subs, buf, obs)
+    buf -= obs
+    sse = np.einsum(subs_ss, buf, buf)
+
+    # Log errors. Reuse 'buf'
+    obs_pos = mask & (obs > 0)
+    log_obs = np.log(obs, out=np.zeros_like(obs), where=obs_pos)
+    pos = np.greater(sim, 0)
+    pos &= obs_pos
+    buf.fill(0)
+    np.log(sim, out=buf, where=pos)
+    np.subtract(buf, log_obs, out=buf, where=pos)
+    n_log = pos.sum(axis=sum_axis)
+    sse_log = np.einsum(subs_ss, buf, buf)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        n_obs = np.broadcast_to(n_obs, sse.shape)
+        sst = sum_oo - (sum_o**2 / n_obs)
+        cov = (n_obs * sum_so) - (sum_s * sum_o)
+        var_s = (n_obs * sum_ss) - sum_s**2
+        var_o = (n_obs * sum_oo) - sum_o**2
+        scores = {
+            "n_obs": n_obs.astype(int),
+            "bias_pct": 100 * (sum_s - sum_o) / sum_o,
+            "nse": 1 - (sse / sst),
+            "rmse": np.sqrt(sse / n_obs),
+            "log_rmse": np.sqrt(sse_log / n_log),
+            "r": cov / np.sqrt(var_s * var_o),
+        }
+
+    # Scores undefined without data
+    for key in ["bias_pct", "nse", "rmse", "r"]:
+        scores[key] = np.where(n_obs > 0, scores[key], np.nan)
+
+    return scores
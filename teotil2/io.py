@@ -1,5 +1,11 @@
 import calendar
+import hashlib
+import multiprocessing as mp
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -18,10 +24,29 @@ def get_annual_spredt_data(year, engine, par_list=["Tot-N", "Tot-P"]):
     Returns:
         Dataframe
     """
+    return get_annual_spredt_data_range(year, year, engine, par_list=par_list)[year]
+
+
+def get_annual_spredt_data_range(st_yr, end_yr, engine, par_list=["Tot-N", "Tot-P"]):
+    """Get annual spredt data from RESA2 for a range of years using a single query.
+
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        par_list: List. Parameters defined in
+                  RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        engine:   SQL-Alchemy 'engine' object already connected
+                  to RESA2
+
+    Returns:
+        Dict of dataframes {year: df}, as returned by get_annual_spredt_data(). None for
+        years with no data.
+    """
 
     # Get data, converting units to tonnes
     sql = (
-        "SELECT a.komm_no as komnr, "
+        "SELECT ar AS year, "
+        "       a.komm_no as komnr, "
         "       c.name, "
         "       (a.value*b.factor) AS value "
         "FROM resa2.rid_kilder_spredt_values a, "
@@ -29,18 +54,20 @@ def get_annual_spredt_data(year, engine, par_list=["Tot-N", "Tot-P"]):
         "resa2.rid_punktkilder_outpar_def c "
         "WHERE a.inp_par_id = b.in_pid "
         "AND b.out_pid = c.out_pid "
-        "AND ar = %s" % year
+        "AND ar BETWEEN %s AND %s" % (st_yr, end_yr)
     )
 
-    spr_df = pd.read_sql(sql, engine)
+    df = pd.read_sql(sql, engine)
 
-    # Only continue if data
-    if len(spr_df) == 0:
-        print("    No spredt data for %s." % year)
+    spr_dict = {}
+    for year, spr_df in _split_years(df, st_yr, end_yr).items():
+        # Only continue if data
+        if len(spr_df) == 0:
+            print("    No spredt data for %s." % year)
+            spr_dict[year] = None
 
-        return None
+            continue
 
-    else:
         # Pivot
         spr_df = spr_df.pivot(index="komnr", columns="name", values="value").copy()
 
@@ -59,7 +86,9 @@ def get_annual_spredt_data(year, engine, par_list=["Tot-N", "Tot-P"]):
         spr_df.dropna(subset=cols, how="all", inplace=True)
         spr_df["komnr"] = spr_df["komnr"].astype(int)
 
-        return spr_df
+        spr_dict[year] = spr_df
+
+    return spr_dict
 
 
 def get_annual_aquaculture_data(year, engine, par_list=["Tot-N", "Tot-P"]):
@@ -75,11 +104,34 @@ def get_annual_aquaculture_data(year, engine, par_list=["Tot-N", "Tot-P"]):
     Returns:
         Dataframe
     """
+    return get_annual_aquaculture_data_range(year, year, engine, par_list=par_list)[
+        year
+    ]
+
+
+def get_annual_aquaculture_data_range(
+    st_yr, end_yr, engine, par_list=["Tot-N", "Tot-P"]
+):
+    """Get annual aquaculture data from RESA2 for a range of years using a single query.
+
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        par_list: List. Parameters defined in
+                  RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        engine:   SQL-Alchemy 'engine' object already connected
+                  to RESA2
+
+    Returns:
+        Dict of dataframes {year: df}, as returned by get_annual_aquaculture_data(). None
+        for years with no data.
+    """
 
     # Get data, converting units to tonnes
     sql = (
-        "SELECT regine, name, SUM(value) AS value FROM ( "
-        "  SELECT b.regine, "
+        "SELECT year, regine, name, SUM(value) AS value FROM ( "
+        "  SELECT ar AS year, "
+        "         b.regine, "
         "         c.name, "
         "         (a.value*d.factor) AS value "
         "  FROM resa2.rid_kilder_aqkult_values a, "
@@ -89,19 +141,21 @@ def get_annual_aquaculture_data(year, engine, par_list=["Tot-N", "Tot-P"]):
         "  WHERE a.anlegg_nr = b.nr "
         "  AND a.inp_par_id = d.in_pid "
         "  AND c.out_pid = d.out_pid "
-        "  AND ar = %s) "
-        "GROUP BY regine, name" % year
+        "  AND ar BETWEEN %s AND %s) "
+        "GROUP BY year, regine, name" % (st_yr, end_yr)
     )
 
-    aqu_df = pd.read_sql(sql, engine)
+    df = pd.read_sql(sql, engine)
 
-    # Only continue if data
-    if len(aqu_df) == 0:
-        print("    No aquaculture data for %s." % year)
+    aqu_dict = {}
+    for year, aqu_df in _split_years(df, st_yr, end_yr).items():
+        # Only continue if data
+        if len(aqu_df) == 0:
+            print("    No aquaculture data for %s." % year)
+            aqu_dict[year] = None
 
-        return None
+            continue
 
-    else:
         # Pivot
         aqu_df = aqu_df.pivot(index="regine", columns="name", values="value").copy()
 
@@ -119,7 +173,9 @@ def get_annual_aquaculture_data(year, engine, par_list=["Tot-N", "Tot-P"]):
         )
         aqu_df.dropna(subset=cols, how="all", inplace=True)
 
-        return aqu_df
+        aqu_dict[year] = aqu_df
+
+    return aqu_dict
 
 
 def get_annual_renseanlegg_data(year, engine, par_list=["Tot-N", "Tot-P"]):
@@ -135,58 +191,29 @@ def get_annual_renseanlegg_data(year, engine, par_list=["Tot-N", "Tot-P"]):
     Returns:
         Dataframe
     """
+    return get_annual_renseanlegg_data_range(year, year, engine, par_list=par_list)[
+        year
+    ]
 
-    sql = (
-        "SELECT regine, name, SUM(value) AS value FROM ( "
-        "  SELECT b.regine, "
-        "         b.type, "
-        "         c.name, "
-        "         (a.value*d.factor) AS value "
-        "  FROM resa2.rid_punktkilder_inpar_values a, "
-        "  resa2.rid_punktkilder b, "
-        "  resa2.rid_punktkilder_outpar_def c, "
-        "  resa2.rid_punktkilder_inp_outp d "
-        "  WHERE a.anlegg_nr = b.anlegg_nr "
-        "  AND a.inp_par_id = d.in_pid "
-        "  AND c.out_pid = d.out_pid "
-        "  AND year = %s) "
-        "WHERE type = 'RENSEANLEGG' "
-        "GROUP BY regine, type, name" % year
-    )
-
-    ren_df = pd.read_sql(sql, engine)
-
-    # Only continue if data
-    if len(ren_df) == 0:
-        print("    No renseanlegg data for %s." % year)
-
-        return None
 
-    else:
-        # Pivot
-        ren_df = ren_df.pivot(index="regine", columns="name", values="value").copy()
-
-        # If no data for pars, add cols of 0
-        for par in par_list:
-            if par not in ren_df.columns:
-                print(f"    No renseanlegg data for {par} in {year}.")
-                ren_df[par] = 0
+def get_annual_renseanlegg_data_range(
+    st_yr, end_yr, engine, par_list=["Tot-N", "Tot-P"]
+):
+    """Get annual renseanlegg data from RESA2 for a range of years using a single query.
 
-        # Tidy
-        ren_df = ren_df[par_list]
-        cols = ["ren_%s_tonnes" % i.lower() for i in ren_df.columns]
-        ren_df.columns = cols
-        ren_df.columns.name = ""
-        ren_df.reset_index(inplace=True)
-        ren_df.dropna(
-            subset=[
-                "regine",
-            ],
-            inplace=True,
-        )
-        ren_df.dropna(subset=cols, how="all", inplace=True)
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        par_list: List. Parameters defined in
+                  RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        engine:   SQL-Alchemy 'engine' object already connected
+                  to RESA2
 
-        return ren_df
+    Returns:
+        Dict of dataframes {year: df}, as returned by get_annual_renseanlegg_data(). None
+        for years with no data.
+    """
+    return _get_punktkilder_data_range(st_yr, end_yr, engine, "RENSEANLEGG", par_list)
 
 
 def get_annual_industry_data(year, engine, par_list=["Tot-N", "Tot-P"]):
@@ -202,10 +229,54 @@ def get_annual_industry_data(year, engine, par_list=["Tot-N", "Tot-P"]):
     Returns:
         Dataframe
     """
+    return get_annual_industry_data_range(year, year, engine, par_list=par_list)[year]
+
+
+def get_annual_industry_data_range(st_yr, end_yr, engine, par_list=["Tot-N", "Tot-P"]):
+    """Get annual industry data from RESA2 for a range of years using a single query.
+
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        par_list: List. Parameters defined in
+                  RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        engine:   SQL-Alchemy 'engine' object already connected
+                  to RESA2
+
+    Returns:
+        Dict of dataframes {year: df}, as returned by get_annual_industry_data(). None for
+        years with no data.
+    """
+    return _get_punktkilder_data_range(st_yr, end_yr, engine, "INDUSTRI", par_list)
+
+
+def _get_punktkilder_data_range(st_yr, end_yr, engine, typ, par_list):
+    """Get annual renseanlegg or industry data from RESA2 for a range of years. See
+       get_annual_renseanlegg_data_range() and get_annual_industry_data_range().
+
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        engine:   SQL-Alchemy 'engine' object already connected
+                  to RESA2
+        typ:      Str. One of ['RENSEANLEGG', 'INDUSTRI']
+        par_list: List. Parameters defined in
+                  RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+
+    Returns:
+        Dict of dataframes {year: df}. None for years with no data.
+    """
+    if typ == "RENSEANLEGG":
+        name, prefix = "renseanlegg", "ren"
+    elif typ == "INDUSTRI":
+        name, prefix = "industry", "ind"
+    else:
+        raise ValueError("'typ' must be one of ['RENSEANLEGG', 'INDUSTRI'].")
 
     sql = (
-        "SELECT regine, name, SUM(value) AS value FROM ( "
-        "  SELECT b.regine, "
+        "SELECT year, regine, name, SUM(value) AS value FROM ( "
+        "  SELECT year, "
+        "         b.regine, "
         "         b.type, "
         "         c.name, "
         "         (a.value*d.factor) AS value "
@@ -216,38 +287,49 @@ def get_annual_industry_data(year, engine, par_list=["Tot-N", "Tot-P"]):
         "  WHERE a.anlegg_nr = b.anlegg_nr "
         "  AND a.inp_par_id = d.in_pid "
         "  AND c.out_pid = d.out_pid "
-        "  AND year = %s) "
-        "WHERE type = 'INDUSTRI' "
-        "GROUP BY regine, type, name" % year
+        "  AND year BETWEEN %s AND %s) "
+        "WHERE type = '%s' "
+        "GROUP BY year, regine, type, name" % (st_yr, end_yr, typ)
     )
 
-    ind_df = pd.read_sql(sql, engine)
+    df = pd.read_sql(sql, engine)
 
-    # Only continue if data
-    if len(ind_df) == 0:
-        print("    No industry data for %s." % year)
+    pt_dict = {}
+    for year, pt_df in _split_years(df, st_yr, end_yr).items():
+        # Only continue if data
+        if len(pt_df) == 0:
+            print(f"    No {name} data for {year}.")
+            pt_dict[year] = None
 
-        return None
+            continue
 
-    else:
         # Pivot
-        ind_df = ind_df.pivot(index="regine", columns="name", values="value").copy()
+        pt_df = pt_df.pivot(index="regine", columns="name", values="value").copy()
+
+        # If no data for pars, add cols of 0. Only done for renseanlegg (as before)
+        if typ == "RENSEANLEGG":
+            for par in par_list:
+                if par not in pt_df.columns:
+                    print(f"    No {name} data for {par} in {year}.")
+                    pt_df[par] = 0
 
         # Tidy
-        ind_df = ind_df[par_list]
-        cols = ["ind_%s_tonnes" % i.lower() for i in ind_df.columns]
-        ind_df.columns = cols
-        ind_df.columns.name = ""
-        ind_df.reset_index(inplace=True)
-        ind_df.dropna(
+        pt_df = pt_df[par_list]
+        cols = [f"{prefix}_{i.lower()}_tonnes" for i in pt_df.columns]
+        pt_df.columns = cols
+        pt_df.columns.name = ""
+        pt_df.reset_index(inplace=True)
+        pt_df.dropna(
             subset=[
                 "regine",
             ],
             inplace=True,
         )
-        ind_df.dropna(subset=cols, how="all", inplace=True)
+        pt_df.dropna(subset=cols, how="all", inplace=True)
+
+        pt_dict[year] = pt_df
 
-        return ind_df
+    return pt_dict
 
 
 def get_annual_vassdrag_mean_flows(year, engine):
@@ -262,6 +344,25 @@ def get_annual_vassdrag_mean_flows(year, engine):
     Returns:
         Dataframe
     """
+    return get_annual_vassdrag_mean_flows_range(year, year, engine)[year]
+
+
+def get_annual_vassdrag_mean_flows_range(st_yr, end_yr, engine):
+    """Get annual flow data for main NVE vassdrags based on
+        RESA2.DISCHARGE_VALUES for a range of years. Uses a single query for
+        the discharge values, filtered on a date range so that indexes on
+        'xdate' can be used.
+
+    Args:
+        st_yr:    Int. First year of interest
+        end_yr:   Int. Last year of interest
+        engine:   SQL-Alchemy 'engine' object already connected to
+                  RESA2
+
+    Returns:
+        Dict of dataframes {year: df}, as returned by
+        get_annual_vassdrag_mean_flows().
+    """
 
     # Get NVE stn IDs
     sql = (
@@ -276,33 +377,41 @@ def get_annual_vassdrag_mean_flows(year, engine):
 
     # Get avg. annual values for NVE stns
     sql = (
-        "SELECT dis_station_id, AVG(xvalue) AS q_yr "
+        "SELECT dis_station_id, "
+        "       TO_CHAR(xdate, 'YYYY') AS year, "
+        "       AVG(xvalue) AS q_yr "
         "FROM resa2.discharge_values "
         "WHERE dis_station_id in ( "
         "  SELECT dis_station_id "
         "  FROM resa2.discharge_stations "
         "  WHERE dis_station_name LIKE 'NVE Modellert%%') "
-        "AND TO_CHAR(xdate, 'YYYY') = %s "
-        "GROUP BY dis_station_id "
-        "ORDER BY dis_station_id" % year
+        "AND xdate >= TO_DATE('%s-01-01', 'YYYY-MM-DD') "
+        "AND xdate < TO_DATE('%s-01-01', 'YYYY-MM-DD') "
+        "GROUP BY dis_station_id, TO_CHAR(xdate, 'YYYY') "
+        "ORDER BY dis_station_id" % (st_yr, end_yr + 1)
     )
 
-    an_avg_df = pd.read_sql_query(sql, engine)
-    an_avg_df.index = an_avg_df["dis_station_id"]
-    del an_avg_df["dis_station_id"]
+    df = pd.read_sql_query(sql, engine)
 
-    # Combine
-    q_df = pd.concat([nve_stn_df, an_avg_df], axis=1)
+    q_dict = {}
+    for year, an_avg_df in _split_years(df, st_yr, end_yr).items():
+        an_avg_df.index = an_avg_df["dis_station_id"]
+        del an_avg_df["dis_station_id"]
 
-    # Tidy
-    q_df.reset_index(inplace=True, drop=True)
-    q_df.sort_values(by="vassdrag", ascending=True, inplace=True)
-    q_df.columns = ["vassom", "q_yr_m3/s"]
+        # Combine
+        q_df = pd.concat([nve_stn_df, an_avg_df], axis=1)
+
+        # Tidy
+        q_df.reset_index(inplace=True, drop=True)
+        q_df.sort_values(by="vassdrag", ascending=True, inplace=True)
+        q_df.columns = ["vassom", "q_yr_m3/s"]
+
+        q_dict[year] = q_df
 
-    return q_df
+    return q_dict
 
 
-def get_annual_agricultural_coefficients(year, engine, core_fold):
+def get_annual_agricultural_coefficients(year, engine, core_fold, cache_dir=None):
     """Get annual agricultural inputs from Bioforsk and
         convert to land use coefficients.
 
@@ -311,61 +420,121 @@ def get_annual_agricultural_coefficients(year, engine, core_fold):
         engine:    SQL-Alchemy 'engine' object already connected to
                    RESA2
         core_fold: Str. Path to folder containing core TEOTIL2 data files
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
 
     Returns:
         Dataframe
     """
-    # Read LU areas (same values used every year)
-    csv_path = os.path.join(core_fold, "fysone_land_areas.csv")
-    lu_areas = pd.read_csv(csv_path, sep=";", encoding="windows-1252")
+    return get_annual_agricultural_coefficients_range(
+        year, year, engine, core_fold, cache_dir=cache_dir
+    )[year]
 
-    # Read Bioforsk data
-    sql = "SELECT * FROM RESA2.RID_AGRI_INPUTS " "WHERE year = %s" % year
-    lu_lds = pd.read_sql(sql, engine)
-    del lu_lds["year"]
 
-    # Check have data
-    if len(lu_lds) == 0:
-        print("    No agricultural land use coefficients for %s." % year)
+def get_annual_agricultural_coefficients_range(
+    st_yr, end_yr, engine, core_fold, cache_dir=None
+):
+    """Get annual agricultural inputs from Bioforsk for a range of years using a
+        single query, and convert to land use coefficients.
 
-    # Join
-    lu_df = pd.merge(lu_lds, lu_areas, how="outer", on="omrade")
-
-    # Calculate required columns
-    # N
-    lu_df["agri_diff_tot-n_kg/km2"] = lu_df["n_diff_kg"] / lu_df["a_fy_agri_km2"]
-    lu_df["agri_point_tot-n_kg/km2"] = (
-        lu_df["n_point_kg"] / lu_df["a_fy_agri_km2"]
-    )  # Orig a_fy_eng_km2??
-    lu_df["agri_back_tot-n_kg/km2"] = lu_df["n_back_kg"] / lu_df["a_fy_agri_km2"]
-
-    # P
-    lu_df["agri_diff_tot-p_kg/km2"] = lu_df["p_diff_kg"] / lu_df["a_fy_agri_km2"]
-    lu_df["agri_point_tot-p_kg/km2"] = (
-        lu_df["p_point_kg"] / lu_df["a_fy_agri_km2"]
-    )  # Orig a_fy_eng_km2??
-    lu_df["agri_back_tot-p_kg/km2"] = lu_df["p_back_kg"] / lu_df["a_fy_agri_km2"]
+    Args:
+        st_yr:     Int. First year of interest
+        end_yr:    Int. Last year of interest
+        engine:    SQL-Alchemy 'engine' object already connected to
+                   RESA2
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
 
-    # Get cols of interest
-    cols = [
-        "fylke_sone",
-        "fysone_name",
-        "agri_diff_tot-n_kg/km2",
-        "agri_point_tot-n_kg/km2",
-        "agri_back_tot-n_kg/km2",
-        "agri_diff_tot-p_kg/km2",
-        "agri_point_tot-p_kg/km2",
-        "agri_back_tot-p_kg/km2",
-        "a_fy_agri_km2",
-        "a_fy_eng_km2",
-    ]
+    Returns:
+        Dict of dataframes {year: df}, as returned by
+        get_annual_agricultural_coefficients().
+    """
+    # Read LU areas (same values used every year)
+    lu_areas = read_core_data(core_fold, "fysone_land_areas", cache_dir=cache_dir)
+
+    # Read Bioforsk data
+    sql = "SELECT * FROM RESA2.RID_AGRI_INPUTS WHERE year BETWEEN %s AND %s" % (
+        st_yr,
+        end_yr,
+    )
+    df = pd.read_sql(sql, engine)
+
+    lu_dict = {}
+    for year, lu_lds in _split_years(df, st_yr, end_yr).items():
+        # Check have data
+        if len(lu_lds) == 0:
+            print("    No agricultural land use coefficients for %s." % year)
+
+        # Join
+        lu_df = pd.merge(lu_lds, lu_areas, how="outer", on="omrade")
+
+        # Calculate required columns
+        # N
+        lu_df["agri_diff_tot-n_kg/km2"] = lu_df["n_diff_kg"] / lu_df["a_fy_agri_km2"]
+        lu_df["agri_point_tot-n_kg/km2"] = (
+            lu_df["n_point_kg"] / lu_df["a_fy_agri_km2"]
+        )  # Orig a_fy_eng_km2??
+        lu_df["agri_back_tot-n_kg/km2"] = lu_df["n_back_kg"] / lu_df["a_fy_agri_km2"]
+
+        # P
+        lu_df["agri_diff_tot-p_kg/km2"] = lu_df["p_diff_kg"] / lu_df["a_fy_agri_km2"]
+        lu_df["agri_point_tot-p_kg/km2"] = (
+            lu_df["p_point_kg"] / lu_df["a_fy_agri_km2"]
+        )  # Orig a_fy_eng_km2??
+        lu_df["agri_back_tot-p_kg/km2"] = lu_df["p_back_kg"] / lu_df["a_fy_agri_km2"]
+
+        # Get cols of interest
+        cols = [
+            "fylke_sone",
+            "fysone_name",
+            "agri_diff_tot-n_kg/km2",
+            "agri_point_tot-n_kg/km2",
+            "agri_back_tot-n_kg/km2",
+            "agri_diff_tot-p_kg/km2",
+            "agri_point_tot-p_kg/km2",
+            "agri_back_tot-p_kg/km2",
+            "a_fy_agri_km2",
+            "a_fy_eng_km2",
+        ]
+
+        lu_dict[year] = lu_df[cols]
+
+    return lu_dict
+
+
+def _split_years(df, st_yr, end_yr):
+    """Split the results of a query for a range of years into one dataframe per year.
+
+    Args:
+        df:     Dataframe. Must have a 'year' column
+        st_yr:  Int. First year of interest
+        end_yr: Int. Last year of interest
 
-    lu_df = lu_df[cols]
+    Returns:
+        Dict of dataframes {year: df}, without the 'year' column. Years with no data
+        have an empty dataframe.
+    """
+    years = df["year"].astype(int)
+    df = df.drop(columns="year")
+    grp_dict = dict(iter(df.groupby(years.values)))
 
-    return lu_df
+    return {
+        year: grp_dict.get(year, df.iloc[:0]).reset_index(drop=True)
+        for year in range(st_yr, end_yr + 1)
+    }
 
 
-def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "Tot-P"]):
+def make_rid_input_file(
+    year,
+    engine,
+    core_fold,
+    out_csv,
+    par_list=["Tot-N", "Tot-P"],
+    cache_dir=None,
+    n_threads=None,
+    verbose=False,
+):
     """Builds a TEOTIL2 input file for the RID programme for the specified year. All the
        required data must be complete in RESA2.
 
@@ -377,52 +546,246 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
         core_fold: Str. Path to folder containing core TEOTIL2 data files
         engine:    SQL-Alchemy 'engine' object already connected
                    to RESA2
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+        n_threads: Int. Optional. Maximum number of concurrent RESA2 queries (and
+                   connections). Default is one per data source
+        verbose:   Bool. Default False. Whether to print the time spent on each RESA2
+                   query
+
+    Returns:
+        Dataframe. The CSV is written to the specified path.
+    """
+
+    # Read data from RESA2
+    src = _get_source_data_range(
+        year,
+        year,
+        engine,
+        core_fold,
+        "nutrients",
+        par_list,
+        cache_dir=cache_dir,
+        n_threads=n_threads,
+        verbose=verbose,
+    )[year]
+
+    # Read core TEOTIL2 inputs and process year-invariant data
+    static = _make_static_inputs(year, core_fold, "nutrients", cache_dir=cache_dir)
+
+    # Process annual data
+    df = _make_rid_annual_inputs(year, static, src, par_list)
+
+    # Write output
+    df.to_csv(out_csv, encoding="utf-8", index=False)
+
+    return df
+
+
+def make_metals_input_file(
+    year,
+    engine,
+    core_fold,
+    out_csv,
+    par_list=["As", "Cd", "Cr", "Cu", "Hg", "Ni", "Pb", "Zn"],
+    cache_dir=None,
+    n_threads=None,
+    verbose=False,
+):
+    """Builds an input file for the selected metals for the specified year. All the required
+       data must be complete in RESA2.
+
+    Args:
+        year:      Int. Year of interest
+        par_list:  List. Metal parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        out_csv:   Path for output CSV file
+        core_fold: Path to folder containing core TEOTIL2 data files
+        engine:    SQL-Alchemy 'engine' object already connected to RESA2
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+        n_threads: Int. Optional. Maximum number of concurrent RESA2 queries (and
+                   connections). Default is one per data source
+        verbose:   Bool. Default False. Whether to print the time spent on each RESA2
+                   query
 
     Returns:
         Dataframe. The CSV is written to the specified path.
     """
+    # Validate input
+    valid_metals = ["As", "Cd", "Cr", "Cu", "Hg", "Ni", "Pb", "Zn"]
+    for par in par_list:
+        assert (
+            par in valid_metals
+        ), f"{par} is not valid. Must be one of ['As', 'Cd', 'Cr', 'Cu', 'Hg', 'Ni', 'Pb', 'Zn']."
 
     # Read data from RESA2
-    spr_df = get_annual_spredt_data(year, engine, par_list=par_list)
-    aqu_df = get_annual_aquaculture_data(year, engine, par_list=par_list)
-    ren_df = get_annual_renseanlegg_data(year, engine, par_list=par_list)
-    ind_df = get_annual_industry_data(year, engine, par_list=par_list)
-    agri_df = get_annual_agricultural_coefficients(year, engine, core_fold)
-    q_df = get_annual_vassdrag_mean_flows(year, engine)
+    src = _get_source_data_range(
+        year,
+        year,
+        engine,
+        core_fold,
+        "metals",
+        par_list,
+        cache_dir=cache_dir,
+        n_threads=n_threads,
+        verbose=verbose,
+    )[year]
+
+    # Read core TEOTIL2 inputs and process year-invariant data
+    static = _make_static_inputs(year, core_fold, "metals", cache_dir=cache_dir)
+
+    # Process annual data
+    df = _make_metals_annual_inputs(year, static, src, par_list)
+
+    # Write output
+    df.to_csv(out_csv, encoding="utf-8", index=False)
+
+    return df
+
+
+def _get_source_data_range(
+    st_yr,
+    end_yr,
+    engine,
+    core_fold,
+    mode,
+    par_list,
+    cache_dir=None,
+    n_threads=None,
+    verbose=False,
+):
+    """Read the annual data from RESA2 required to build input files for a range of
+       years. Uses one query per data source, regardless of the number of years. The
+       queries are independent and run concurrently in a pool of threads, so 'engine'
+       must be safe to use from several threads. An SQL-Alchemy engine checks out a
+       separate connection from its pool for each query. For other connections, use
+       'n_threads=1'.
+
+    Args:
+        st_yr:     Int. First year of interest
+        end_yr:    Int. Last year of interest
+        engine:    SQL-Alchemy 'engine' object already connected to RESA2
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        mode:      Str. One of ['nutrients', 'metals']
+        par_list:  List. Parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+        n_threads: Int. Optional. Number of threads, and hence the maximum number of
+                   connections used at once. Default is one per data source. Use 1 to
+                   run the queries sequentially
+        verbose:   Bool. Default False. Whether to print the time spent on each data
+                   source
+
+    Returns:
+        Dict {year: src}, where 'src' is a dict of dataframes with keys 'ren', 'ind'
+        and 'q', plus 'spr', 'aqu' and 'agri' if 'mode' is 'nutrients'.
+    """
+    if mode == "nutrients":
+        func_dict = {
+            "spr": partial(
+                get_annual_spredt_data_range, st_yr, end_yr, engine, par_list=par_list
+            ),
+            "aqu": partial(
+                get_annual_aquaculture_data_range,
+                st_yr,
+                end_yr,
+                engine,
+                par_list=par_list,
+            ),
+            "agri": partial(
+                get_annual_agricultural_coefficients_range,
+                st_yr,
+                end_yr,
+                engine,
+                core_fold,
+                cache_dir=cache_dir,
+            ),
+        }
+
+    elif mode == "metals":
+        func_dict = {}
+
+    else:
+        raise ValueError("'mode' must be one of ['nutrients', 'metals'].")
+
+    func_dict["ren"] = partial(
+        get_annual_renseanlegg_data_range, st_yr, end_yr, engine, par_list=par_list
+    )
+    func_dict["ind"] = partial(
+        get_annual_industry_data_range, st_yr, end_yr, engine, par_list=par_list
+    )
+    func_dict["q"] = partial(
+        get_annual_vassdrag_mean_flows_range, st_yr, end_yr, engine
+    )
+
+    if n_threads is None:
+        n_threads = len(func_dict)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        future_dict = {
+            key: executor.submit(_timed_call, func) for key, func in func_dict.items()
+        }
+        src_dict, time_dict = {}, {}
+        for key, future in future_dict.items():
+            src_dict[key], time_dict[key] = future.result()
+
+    if verbose:
+        yr_range = st_yr if st_yr == end_yr else f"{st_yr}-{end_yr}"
+        print(f"    RESA2 query times for {yr_range} (seconds):")
+        for key, secs in sorted(time_dict.items(), key=lambda i: -i[1]):
+            print(f"        {key}: {secs:.2f}")
+
+    return {
+        year: {key: data[year] for key, data in src_dict.items()}
+        for year in range(st_yr, end_yr + 1)
+    }
+
+
+def _timed_call(func):
+    """Call 'func()' and return a tuple (result, elapsed time in seconds)."""
+    start = time.perf_counter()
+    result = func()
+
+    return result, time.perf_counter() - start
+
+
+def _make_static_inputs(year, core_fold, mode, cache_dir=None):
+    """Read the core TEOTIL2 data and process the parts of an input file that do not
+       change from year to year (land areas, background coefficients etc.). These depend
+       only on the version of the regine network used for 'year', so the results can be
+       shared by all years using the same network.
+
+    Args:
+        year:      Int. Year of interest
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        mode:      Str. One of ['nutrients', 'metals']
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+
+    Returns:
+        Dict of dataframes with keys 'area' and 'ret', plus 'wc' and 'fac' if 'mode' is
+        'metals'. Not modified by the annual processing functions.
+    """
+    if mode not in ("nutrients", "metals"):
+        raise ValueError("'mode' must be one of ['nutrients', 'metals'].")
 
     # Read core TEOTIL2 inputs
     # 1. Regine network
     # Changes to kommuner boundaries require different files for
     # different years
-    if year < 2017:
-        csv_path = os.path.join(core_fold, "regine_pre_2017.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
-    else:
-        csv_path = os.path.join(core_fold, f"regine_{year}.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    reg_df = read_core_data(core_fold, "regine", year=year, cache_dir=cache_dir)
 
     # 2. Retention factors
-    csv_path = os.path.join(core_fold, "retention_nutrients.csv")
-    ret_df = pd.read_csv(csv_path, sep=";")
+    ret_name = "retention_nutrients" if mode == "nutrients" else "retention_metals"
+    ret_df = read_core_data(core_fold, ret_name, cache_dir=cache_dir)
 
     # 3. Land cover
-    csv_path = os.path.join(core_fold, "land_cover.csv")
-    lc_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    lc_df = read_core_data(core_fold, "land_cover", cache_dir=cache_dir)
 
     # 4. Lake areas
-    csv_path = os.path.join(core_fold, "lake_areas.csv")
-    la_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    la_df = read_core_data(core_fold, "lake_areas", cache_dir=cache_dir)
 
     # 5. Background coefficients
-    csv_path = os.path.join(core_fold, "back_coeffs.csv")
-    back_df = pd.read_csv(csv_path, sep=";")
-
-    # 7. Fylke-Sone
-    csv_path = os.path.join(core_fold, "regine_fysone.csv")
-    fy_df = pd.read_csv(csv_path, sep=";")
-
-    # Convert par_list to lower case
-    par_list = [i.lower() for i in par_list]
+    back_df = read_core_data(core_fold, "back_coeffs", cache_dir=cache_dir)
 
     # Process data
     # 1. Land use
@@ -483,8 +846,48 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
     # 1.2. Join background coeffs
     area_df = pd.merge(area_df, back_df, how="left", on="regine")
 
+    static = {"area": area_df, "ret": ret_df}
+
+    if mode == "nutrients":
+        # 1.3. Join fylke-sone. Agri coeffs for each fylke-sone are joined annually
+        fy_df = read_core_data(core_fold, "regine_fysone", cache_dir=cache_dir)
+        static["area"] = pd.merge(area_df, fy_df, how="left", on="regine")
+
+    else:
+        # Diffuse concs from 1000 Lakes data
+        static["wc"] = read_core_data(
+            core_fold, "mean_metal_concs", cache_dir=cache_dir
+        )
+
+        # Change factors for water chemistry
+        static["fac"] = read_core_data(
+            core_fold, "metal_change_factors", cache_dir=cache_dir
+        )
+
+    return static
+
+
+def _make_rid_annual_inputs(year, static, src, par_list):
+    """Process the year-specific parts of an input file for N and P. See
+       make_rid_input_file().
+
+    Args:
+        year:     Int. Year of interest
+        static:   Dict. Year-invariant data from _make_static_inputs()
+        src:      Dict. Annual data from _get_source_data_range()
+        par_list: List. Parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+
+    Returns:
+        Dataframe.
+    """
+    area_df, ret_df = static["area"], static["ret"]
+    spr_df, aqu_df, ren_df, ind_df = src["spr"], src["aqu"], src["ren"], src["ind"]
+    agri_df, q_df = src["agri"], src["q"]
+
+    # Convert par_list to lower case
+    par_list = [i.lower() for i in par_list]
+
     # 1.3. Join agri coeffs
-    area_df = pd.merge(area_df, fy_df, how="left", on="regine")
     area_df = pd.merge(area_df, agri_df, how="left", on="fylke_sone")
 
     # 2. Discharge
@@ -508,7 +911,7 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
         df[col] = df[col] * df["q_fac"]
 
         # Fill NaN
-        df[col].fillna(value=0, inplace=True)
+        df[col] = df[col].fillna(value=0)
 
     # Tidy
     del df["q_fac"], df["q_yr_m3/s"], df["q_lta_m3/s"]
@@ -537,7 +940,7 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
         for par in par_list:
             col = "%s_%s_tonnes" % (typ, par)
             if col in df.columns:
-                df[col].fillna(value=0, inplace=True)
+                df[col] = df[col].fillna(value=0)
             else:  # Create cols of zeros
                 df[col] = 0
 
@@ -578,12 +981,12 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
     del df["spr_agri"], df["spr_all"]
 
     # Fill NaN
-    df["a_kom_km2"].fillna(value=0, inplace=True)
-    df["a_agri_kom_km2"].fillna(value=0, inplace=True)
+    df["a_kom_km2"] = df["a_kom_km2"].fillna(value=0)
+    df["a_agri_kom_km2"] = df["a_agri_kom_km2"].fillna(value=0)
 
     for par in par_list:
         # Fill
-        df["spr_%s_tonnes" % par].fillna(value=0, inplace=True)
+        df["spr_%s_tonnes" % par] = df["spr_%s_tonnes" % par].fillna(value=0)
 
     # 4. Diffuse
     # Loop over pars
@@ -640,12 +1043,17 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
     # Fill NaN
     for par in par_list:
         # Fill NaN
-        df["ret_%s" % par].fillna(value=0, inplace=True)
+        df["ret_%s" % par] = df["ret_%s" % par].fillna(value=0)
 
         # Calculate transmission
         df["trans_%s" % par] = 1 - df["ret_%s" % par]
 
     # 6. Aggregate values
+    # Components are NaN for regines without land data. Fill before aggregating, so
+    # totals include the other sources
+    src_cols = [col for col in df.columns if col.endswith("_tonnes")]
+    df[src_cols] = df[src_cols].fillna(value=0)
+
     # Loop over pars
     for par in par_list:
         # All point sources
@@ -730,150 +1138,38 @@ def make_rid_input_file(year, engine, core_fold, out_csv, par_list=["Tot-N", "To
     # Fill Nan
     df.fillna(value=0, inplace=True)
 
-    # 7. Write output
-    df.to_csv(out_csv, encoding="utf-8", index=False)
-
     return df
 
 
-def make_metals_input_file(
-    year,
-    engine,
-    core_fold,
-    out_csv,
-    par_list=["As", "Cd", "Cr", "Cu", "Hg", "Ni", "Pb", "Zn"],
-):
-    """Builds an input file for the selected metals for the specified year. All the required
-       data must be complete in RESA2.
+def _make_metals_annual_inputs(year, static, src, par_list):
+    """Process the year-specific parts of an input file for metals. See
+       make_metals_input_file().
 
     Args:
-        year:      Int. Year of interest
-        par_list:  List. Metal parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
-        out_csv:   Path for output CSV file
-        core_fold: Path to folder containing core TEOTIL2 data files
-        engine:    SQL-Alchemy 'engine' object already connected to RESA2
+        year:     Int. Year of interest
+        static:   Dict. Year-invariant data from _make_static_inputs()
+        src:      Dict. Annual data from _get_source_data_range()
+        par_list: List. Metal parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
 
     Returns:
-        Dataframe. The CSV is written to the specified path.
+        Dataframe.
     """
-    # Validate input
-    valid_metals = ["As", "Cd", "Cr", "Cu", "Hg", "Ni", "Pb", "Zn"]
-    for par in par_list:
-        assert (
-            par in valid_metals
-        ), f"{par} is not valid. Must be one of ['As', 'Cd', 'Cr', 'Cu', 'Hg', 'Ni', 'Pb', 'Zn']."
-
-    # Read data from RESA2
-    ren_df = get_annual_renseanlegg_data(year, engine, par_list=par_list)
-    ind_df = get_annual_industry_data(year, engine, par_list=par_list)
-    q_df = get_annual_vassdrag_mean_flows(year, engine)
-
-    # Read core TEOTIL2 inputs
-    # 1. Regine network
-    # Changes to kommuner boundaries require different files for
-    # different years
-    if year < 2017:
-        csv_path = os.path.join(core_fold, "regine_pre_2017.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
-    else:
-        csv_path = os.path.join(core_fold, f"regine_{year}.csv")
-        reg_df = pd.read_csv(csv_path, index_col=0, sep=";")
+    area_df, ret_df = static["area"], static["ret"]
+    ren_df, ind_df, q_df = src["ren"], src["ind"], src["q"]
 
-    # 2. Retention factors
-    csv_path = os.path.join(core_fold, "retention_metals.csv")
-    ret_df = pd.read_csv(csv_path, sep=";")
-
-    # 3. Land cover
-    csv_path = os.path.join(core_fold, "land_cover.csv")
-    lc_df = pd.read_csv(csv_path, index_col=0, sep=";")
-
-    # 4. Lake areas
-    csv_path = os.path.join(core_fold, "lake_areas.csv")
-    la_df = pd.read_csv(csv_path, index_col=0, sep=";")
-
-    # 5. Background coefficients
-    csv_path = os.path.join(core_fold, "back_coeffs.csv")
-    back_df = pd.read_csv(csv_path, sep=";")
-
-    # 7. Fylke-Sone
-    csv_path = os.path.join(core_fold, "regine_fysone.csv")
-    fy_df = pd.read_csv(csv_path, sep=";")
-
-    # 8. Diffuse concs from 1000 Lakes data
-    csv_path = os.path.join(core_fold, "mean_metal_concs_2019.csv")
-    wc_df = pd.read_csv(csv_path)
+    # Diffuse concs from 1000 Lakes data
+    wc_df = static["wc"]
     cols = ["regine"] + [i for i in wc_df.columns if i.split("_")[0] in par_list]
-    wc_df = wc_df[cols]
+    wc_df = wc_df[cols].copy()
     wc_df.columns = [f"diff_{i.lower()}" for i in wc_df.columns]
     wc_df.rename({"diff_regine": "regine"}, inplace=True, axis="columns")
 
-    # 9. Change factors for water chemistry
-    csv_path = os.path.join(core_fold, "ospar_region_mean_metals_div_2019_smooth.csv")
-    fac_df = pd.read_csv(csv_path)
-    fac_df = fac_df.query("year == @year")
+    # Change factors for water chemistry
+    fac_df = static["fac"].query("year == @year")
 
     # Convert par_list to lower case
     par_list = [i.lower() for i in par_list]
 
-    # Process data
-    # 1. Land use
-    # 1.1 Land areas
-    # Join lu datasets
-    area_df = pd.concat([reg_df, lc_df, la_df], axis=1, sort=True)
-    area_df.index.name = "regine"
-    area_df.reset_index(inplace=True)
-
-    # Fill NaN
-    area_df.fillna(value=0, inplace=True)
-
-    # Get total area of categories
-    area_df["a_sum"] = (
-        area_df["a_wood_km2"]
-        + area_df["a_agri_km2"]
-        + area_df["a_upland_km2"]
-        + area_df["a_glacier_km2"]
-        + area_df["a_urban_km2"]
-        + area_df["a_sea_km2"]
-        + area_df["a_lake_km2"]
-    )
-
-    # If total exceeds overall area, calc correction factor
-    area_df["a_cor_fac"] = np.where(
-        area_df["a_sum"] > area_df["a_reg_km2"],
-        area_df["a_reg_km2"] / area_df["a_sum"],
-        1,
-    )
-
-    # Apply correction factor
-    area_cols = [
-        "a_wood_km2",
-        "a_agri_km2",
-        "a_upland_km2",
-        "a_glacier_km2",
-        "a_urban_km2",
-        "a_sea_km2",
-        "a_lake_km2",
-        "a_sum",
-    ]
-
-    for col in area_cols:
-        area_df[col] = area_df[col] * area_df["a_cor_fac"]
-
-    # Calc 'other' column
-    area_df["a_other_km2"] = area_df["a_reg_km2"] - area_df["a_sum"]
-
-    # Combine 'glacier' and 'upland' as 'upland'
-    area_df["a_upland_km2"] = area_df["a_upland_km2"] + area_df["a_glacier_km2"]
-
-    # Add 'land area' column
-    area_df["a_land_km2"] = area_df["a_reg_km2"] - area_df["a_sea_km2"]
-
-    # Tidy
-    del area_df["a_glacier_km2"], area_df["a_sum"], area_df["a_cor_fac"]
-
-    # 1.2. Join background coeffs
-    area_df = pd.merge(area_df, back_df, how="left", on="regine")
-
     # 2. Discharge
     # Sum LTA to vassom level
     lta_df = area_df[["vassom", "q_reg_m3/s"]].groupby("vassom").sum().reset_index()
@@ -895,7 +1191,7 @@ def make_metals_input_file(
         df[col] = df[col] * df["q_fac"]
 
         # Fill NaN
-        df[col].fillna(value=0, inplace=True)
+        df[col] = df[col].fillna(value=0)
 
     # Tidy
     del df["q_fac"], df["q_yr_m3/s"], df["q_lta_m3/s"]
@@ -923,7 +1219,7 @@ def make_metals_input_file(
         for par in par_list:
             col = "%s_%s_tonnes" % (typ, par)
             if col in df.columns:
-                df[col].fillna(value=0, inplace=True)
+                df[col] = df[col].fillna(value=0)
             else:  # Create cols of zeros
                 df[col] = 0
 
@@ -968,10 +1264,12 @@ def make_metals_input_file(
     # Retention and transmission
     df = pd.merge(df, ret_df, how="left", on="regine")
     for par in par_list:
-        df["ret_%s" % par].fillna(value=0, inplace=True)
+        df["ret_%s" % par] = df["ret_%s" % par].fillna(value=0)
         df["trans_%s" % par] = 1 - df["ret_%s" % par]
 
-    # Calculate aggregate columns
+    # Calculate aggregate columns. Fill NaN first, so totals include the other sources
+    src_cols = [col for col in df.columns if col.endswith("_tonnes")]
+    df[src_cols] = df[src_cols].fillna(value=0)
     for par in par_list:
         df[f"all_point_{par}_tonnes"] = (
             df[f"ind_{par}_tonnes"] + df[f"ren_{par}_tonnes"]
@@ -1018,14 +1316,19 @@ def make_metals_input_file(
     # Fill Nan
     df.fillna(value=0, inplace=True)
 
-    # Write output
-    df.to_csv(out_csv, encoding="utf-8", index=False)
-
     return df
 
 
 def make_input_file(
-    year, engine, core_fold, out_csv, mode="nutrients", par_list=["Tot-N", "Tot-P"]
+    year,
+    engine,
+    core_fold,
+    out_csv,
+    mode="nutrients",
+    par_list=["Tot-N", "Tot-P"],
+    cache_dir=None,
+    n_threads=None,
+    verbose=False,
 ):
     """Make an input file for TEOTIL2 for either 'nutrients' (N and P) or 'metals' (As, Cd, Cr,
         Cu, Hg, Ni, Pb, Zn).
@@ -1038,29 +1341,176 @@ def make_input_file(
         mode:      Str. One of ['nutrients', 'metals']. Use 'nutrients' to simulate total N and
                    total P; 'metals' simulates As, Cd, Cr, Cu, Hg, Ni, Pb and Zn.
         par_list:  List. Parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+        n_threads: Int. Optional. Maximum number of concurrent RESA2 queries (and
+                   connections). Default is one per data source
+        verbose:   Bool. Default False. Whether to print the time spent on each RESA2
+                   query
 
     Returns:
         Dataframe. The CSV is written to the specified path.
     """
+    _check_input_pars(mode, par_list)
     if mode == "nutrients":
-        valid_pars = ["Tot-N", "Tot-P"]
-        for par in par_list:
-            assert (
-                par in valid_pars
-            ), f"Parameter '{par}' is not recognised for mode = '{mode}'."
-        df = make_rid_input_file(year, engine, core_fold, out_csv, par_list=par_list)
+        df = make_rid_input_file(
+            year,
+            engine,
+            core_fold,
+            out_csv,
+            par_list=par_list,
+            cache_dir=cache_dir,
+            n_threads=n_threads,
+            verbose=verbose,
+        )
+    else:
+        df = make_metals_input_file(
+            year,
+            engine,
+            core_fold,
+            out_csv,
+            par_list=par_list,
+            cache_dir=cache_dir,
+            n_threads=n_threads,
+            verbose=verbose,
+        )
+
+    return df
+
+
+def make_input_files(
+    years,
+    engine,
+    core_fold,
+    out_csv=None,
+    mode="nutrients",
+    par_list=["Tot-N", "Tot-P"],
+    stacked=False,
+    n_workers=None,
+    cache_dir=None,
+    n_threads=None,
+    verbose=False,
+):
+    """Make input files for TEOTIL2 for several years. Equivalent to calling
+       make_input_file() for each year, but the year-invariant data (land areas,
+       background coefficients etc.) are only processed once for each version of the
+       regine network. Data for all years are read from RESA2 in this process, using
+       one query per data source, then the annual data for each year are processed in
+       parallel.
+
+    Args:
+        years:     List of int. Years of interest
+        engine:    SQL-Alchemy 'engine' object already connected to RESA2
+        core_fold: Path to folder containing core TEOTIL2 data files
+        out_csv:   Str. Optional. Path for output CSV file(s). If 'stacked' is False,
+                   must include '{year}' (e.g. 'input_data_{year}.csv') and one file
+                   is written per year. If None, no files are written
+        mode:      Str. One of ['nutrients', 'metals']. See make_input_file()
+        par_list:  List. Parameters defined in RESA2.RID_PUNKTKILDER_OUTPAR_DEF
+        stacked:   Bool. Default False. Whether to return a single dataframe for all
+                   years, with an additional 'year' column
+        n_workers: Int. Optional. Number of worker processes. Default is
+                   os.cpu_count(). Use 1 to process all years in this process
+        cache_dir: Str. Optional. Folder for the on-disk core data cache. See
+                   read_core_data()
+        n_threads: Int. Optional. Maximum number of concurrent RESA2 queries (and
+                   connections). Default is one per data source
+        verbose:   Bool. Default False. Whether to print the time spent on each RESA2
+                   query
+
+    Returns:
+        Dict of dataframes {year: df}, or a single dataframe if 'stacked' is True.
+    """
+    _check_input_pars(mode, par_list)
+    if out_csv and not stacked:
+        assert "{year}" in out_csv, "'out_csv' must include '{year}' if not 'stacked'."
+
+    # Read data from RESA2 for all years, using one query per source
+    src_dict = _get_source_data_range(
+        min(years),
+        max(years),
+        engine,
+        core_fold,
+        mode,
+        par_list,
+        cache_dir=cache_dir,
+        n_threads=n_threads,
+        verbose=verbose,
+    )
+
+    # Process year-invariant data once per network version
+    statics, tasks = {}, []
+    for year in years:
+        reg_csv = core_data_path(core_fold, "regine", year=year)
+        key = source_key([reg_csv], use_hash=True)
+        if key not in statics:
+            statics[key] = _make_static_inputs(
+                year, core_fold, mode, cache_dir=cache_dir
+            )
+        src = src_dict[year]
+        year_csv = out_csv.format(year=year) if (out_csv and not stacked) else None
+        tasks.append((year, key, src, mode, par_list, year_csv))
+
+    if n_workers == 1:
+        _WORKER["statics"] = statics
+        try:
+            df_list = [_input_worker(task) for task in tasks]
+        finally:
+            _WORKER.clear()
+    else:
+        with mp.Pool(
+            n_workers, initializer=_init_input_worker, initargs=(statics,)
+        ) as pool:
+            df_list = pool.map(_input_worker, tasks)
+
+    if not stacked:
+        return dict(zip(years, df_list))
+
+    for year, df in zip(years, df_list):
+        df.insert(0, "year", year)
+    df = pd.concat(df_list, axis=0, ignore_index=True)
+    if out_csv:
+        df.to_csv(out_csv, encoding="utf-8", index=False)
+
+    return df
 
+
+def _check_input_pars(mode, par_list):
+    """Check that 'par_list' is valid for 'mode'. See make_input_file()."""
+    if mode == "nutrients":
+        valid_pars = ["Tot-N", "Tot-P"]
     elif mode == "metals":
         valid_pars = ["As", "Cd", "Cr", "Cu", "Hg", "Ni", "Pb", "Zn"]
-        for par in par_list:
-            assert (
-                par in valid_pars
-            ), f"Parameter '{par}' is not recognised for mode = '{mode}'."
-        df = make_metals_input_file(year, engine, core_fold, out_csv, par_list=par_list)
-
     else:
         raise ValueError("'mode' must be one of ['nutrients', 'metals'].")
 
+    for par in par_list:
+        assert (
+            par in valid_pars
+        ), f"Parameter '{par}' is not recognised for mode = '{mode}'."
+
+
+# Year-invariant data for each worker process. See make_input_files()
+_WORKER = {}
+
+
+def _init_input_worker(statics):
+    """Store the year-invariant data in a worker process. See make_input_files()."""
+    _WORKER["statics"] = statics
+
+
+def _input_worker(task):
+    """Process the annual data for one year in a worker. See make_input_files()."""
+    year, key, src, mode, par_list, out_csv = task
+    static = _WORKER["statics"][key]
+    if mode == "nutrients":
+        df = _make_rid_annual_inputs(year, static, src, par_list)
+    else:
+        df = _make_metals_annual_inputs(year, static, src, par_list)
+
+    if out_csv:
+        df.to_csv(out_csv, encoding="utf-8", index=False)
+
     return df
 
 
@@ -1229,3 +1679,302 @@ def estimate_metal_change_factors_over_time(
         ann_df.to_csv(out_csv, index=False)
 
     return ann_df
+
+
+def source_key(paths, *args, use_hash=False):
+    """Build a key identifying the current version of one or more source files, for use
+       with cached_frame(). By default, the key depends on the path, size and modification
+       time of each file. If 'use_hash' is True, the file contents are hashed instead,
+       which is slower but robust to e.g. copying files between machines.
+
+    Args:
+        paths:    List of str. Source file paths
+        args:     Any other objects affecting the cached result (e.g. lists of
+                  parameters). Included in the key using repr()
+        use_hash: Bool. Default False. Whether to hash the file contents
+
+    Returns:
+        Str.
+    """
+    key = hashlib.sha1()
+    for path in paths:
+        if use_hash:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    key.update(chunk)
+        else:
+            stat = os.stat(path)
+            key.update(
+                (
+                    "%s|%s|%s" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+                ).encode()
+            )
+    for arg in args:
+        key.update(repr(arg).encode())
+
+    return key.hexdigest()[:16]
+
+
+def cached_frame(name, key, func, cache_dir=None):
+    """Get a dataframe from a binary cache in 'cache_dir', or create it by calling
+       'func()' and add it to the cache. Cache files are named '{name}_{key}', so a new
+       file is created whenever 'key' changes (see source_key()). Older files are kept,
+       so that processes using different versions of the source data can share
+       'cache_dir'. Use clear_cache() to delete them. Uses Parquet if pyarrow is
+       installed, otherwise pickle.
+
+    Args:
+        name:      Str. Name of the cached dataset
+        key:       Str. Version of the dataset e.g. from source_key(). Must not contain
+                   underscores
+        func:      Function. Called with no arguments to create the dataframe
+        cache_dir: Str. Optional. Cache folder. If None, 'func()' is returned directly
+
+    Returns:
+        Dataframe.
+    """
+    if cache_dir is None:
+        return func()
+
+    try:
+        import pyarrow  # noqa: F401
+
+        ext, read, write = ".parquet", pd.read_parquet, pd.DataFrame.to_parquet
+    except ImportError:
+        ext, read, write = ".pkl", pd.read_pickle, pd.DataFrame.to_pickle
+
+    path = os.path.join(cache_dir, "%s_%s%s" % (name, key, ext))
+    try:
+        return read(path)
+    except FileNotFoundError:
+        # Not cached, or deleted by another process
+        pass
+
+    df = func()
+
+    # Write to a temporary file first, so other processes never see a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    write(df, tmp_path)
+    os.replace(tmp_path, path)
+
+    return df
+
+
+# Files written by cached_frame(), including temporary files
+_CACHE_FILE_PATTERN = re.compile(
+    r"^(?P<name>.+)_(?P<key>[^_]+)\.(parquet|pkl)(\.\d+\.tmp)?$"
+)
+
+
+def clear_cache(cache_dir, name=None, keep=None):
+    """Delete files created by cached_frame() in 'cache_dir'. Files for other versions
+       of the data may still be in use by other processes sharing 'cache_dir', in which
+       case they are recreated when next needed.
+
+    Args:
+        cache_dir: Str. Cache folder
+        name:      Str. Optional. Only delete files for this dataset. Default is to delete
+                   files for all datasets
+        keep:      List of str. Optional. Keys of versions to keep e.g. the current key
+                   from source_key()
+
+    Returns:
+        List of str. Paths of the deleted files.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+
+    keep = set() if keep is None else set(keep)
+    deleted = []
+    for fname in sorted(os.listdir(cache_dir)):
+        match = _CACHE_FILE_PATTERN.match(fname)
+        if (
+            (match is None)
+            or ((name is not None) and (match["name"] != name))
+            or (match["key"] in keep)
+        ):
+            continue
+        path = os.path.join(cache_dir, fname)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already deleted by another process
+            continue
+        deleted.append(path)
+
+    return deleted
+
+
+# Schemas for the static TEOTIL2 core data files. 'file' may contain '{year}' for
+# datasets with one file per year (see core_data_path()). Only the listed columns are
+# read. Physical quantities are float64, even where the current files only contain whole
+# numbers; int64 is only used for codes. Text columns (e.g. 'regine') are strings
+CORE_DATA_SCHEMAS = {
+    "regine": {
+        "file": "regine_{year}.csv",
+        "read_csv": {"sep": ";", "index_col": "regine"},
+        "dtype": {
+            "regine": str,
+            "regine_ned": str,
+            "a_reg_km2": np.float64,
+            "q_sp_m3/s/km2": np.float64,
+            "runoff_mm/yr": np.float64,
+            "q_reg_m3/s": np.float64,
+            "vassom": np.int64,
+            "komnr": np.int64,
+            "fylke": np.int64,
+            "ospar_region": str,
+        },
+    },
+    "retention_nutrients": {
+        "file": "retention_nutrients.csv",
+        "read_csv": {"sep": ";"},
+        "dtype": {"regine": str, "ret_tot-p": np.float64, "ret_tot-n": np.float64},
+    },
+    "retention_metals": {
+        "file": "retention_metals.csv",
+        "read_csv": {"sep": ";"},
+        "dtype": {
+            "regine": str,
+            **{f"ret_{par}": np.float64 for par in ["as", "cd", "cr", "cu"]},
+            **{f"ret_{par}": np.float64 for par in ["hg", "ni", "pb", "zn"]},
+        },
+    },
+    "land_cover": {
+        "file": "land_cover.csv",
+        "read_csv": {"sep": ";", "index_col": "regine"},
+        "dtype": {
+            "regine": str,
+            "a_wood_km2": np.float64,
+            "a_agri_km2": np.float64,
+            "a_upland_km2": np.float64,
+            "a_glacier_km2": np.float64,
+            "a_urban_km2": np.float64,
+            "a_sea_km2": np.float64,
+        },
+    },
+    "lake_areas": {
+        "file": "lake_areas.csv",
+        "read_csv": {"sep": ";", "index_col": "regine"},
+        "dtype": {"regine": str, "a_lake_km2": np.float64},
+    },
+    "back_coeffs": {
+        "file": "back_coeffs.csv",
+        "read_csv": {"sep": ";"},
+        "dtype": {
+            "regine": str,
+            **{
+                f"c_{src}_{par}": np.float64
+                for par in ["tot-p", "tot-n"]
+                for src in ["wood_mg/l", "upland_mg/l"]
+            },
+            **{
+                f"c_{src}_kg/km2_{par}": np.float64
+                for par in ["tot-p", "tot-n"]
+                for src in ["lake", "urban", "city"]
+            },
+        },
+    },
+    "regine_fysone": {
+        "file": "regine_fysone.csv",
+        "read_csv": {"sep": ";"},
+        "dtype": {"regine": str, "fylke_sone": str},
+    },
+    "fysone_land_areas": {
+        "file": "fysone_land_areas.csv",
+        "read_csv": {"sep": ";", "encoding": "windows-1252"},
+        "dtype": {
+            "omrade": str,
+            "fylke_sone": str,
+            "fysone_name": str,
+            "a_fy_agri_km2": np.float64,
+            "a_fy_eng_km2": np.float64,
+        },
+    },
+    "mean_metal_concs": {
+        "file": "mean_metal_concs_2019.csv",
+        "read_csv": {"sep": ","},
+        "dtype": {
+            **{f"{par}_µgpl": np.float64 for par in ["As", "Cd", "Cr", "Cu"]},
+            "Hg_ngpl": np.float64,
+            **{f"{par}_µgpl": np.float64 for par in ["Ni", "Pb", "Zn"]},
+            "regine": str,
+        },
+    },
+    "metal_change_factors": {
+        "file": "ospar_region_mean_metals_div_2019_smooth.csv",
+        "read_csv": {"sep": ","},
+        "dtype": {
+            "ospar_region": str,
+            "year": np.int64,
+            **{
+                f"{par}_div_2019": np.float64
+                for par in ["as", "cd", "cr", "cu", "hg", "ni", "pb", "zn"]
+            },
+        },
+    },
+}
+
+# In-process cache of parsed core data. {path: (source_key, dataframe)}
+_CORE_DATA_CACHE = {}
+
+
+def core_data_path(core_fold, name, year=None):
+    """Get the path to a core TEOTIL2 data file. Changes to kommuner boundaries require
+       different regine files for different years.
+
+    Args:
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        name:      Str. Dataset name. One of the keys in CORE_DATA_SCHEMAS
+        year:      Int. Optional. Year of interest. Required for 'regine'
+
+    Returns:
+        Str.
+    """
+    if name not in CORE_DATA_SCHEMAS:
+        raise ValueError(f"'name' must be one of {list(CORE_DATA_SCHEMAS.keys())}.")
+
+    fname = CORE_DATA_SCHEMAS[name]["file"]
+    if "{year}" in fname:
+        assert year is not None, f"'year' is required for '{name}'."
+        fname = fname.format(year="pre_2017" if year < 2017 else year)
+
+    return os.path.join(core_fold, fname)
+
+
+def read_core_data(core_fold, name, year=None, cache_dir=None):
+    """Read a core TEOTIL2 data file using the schema in CORE_DATA_SCHEMAS. Parsed data
+       are cached in memory for as long as the file size and modification time are
+       unchanged, so builders for different years share a single parsed copy. If
+       'cache_dir' is given, the parsed data are also cached on disk in a binary
+       format, keyed by a hash of the file contents.
+
+    Args:
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        name:      Str. Dataset name. One of the keys in CORE_DATA_SCHEMAS
+        year:      Int. Optional. Year of interest. Required for 'regine'
+        cache_dir: Str. Optional. Folder for the on-disk cache
+
+    Returns:
+        Dataframe. A copy of the cached data, which can be modified freely.
+    """
+    path = core_data_path(core_fold, name, year=year)
+    schema = CORE_DATA_SCHEMAS[name]
+    stat_key = source_key([path])
+    cached = _CORE_DATA_CACHE.get(path)
+    if cached is None or cached[0] != stat_key:
+        fname = os.path.splitext(os.path.basename(path))[0]
+        df = cached_frame(
+            f"core_{fname}",
+            source_key([path], schema, use_hash=True) if cache_dir else None,
+            lambda: pd.read_csv(
+                path,
+                usecols=list(schema["dtype"].keys()),
+                dtype=schema["dtype"],
+                **schema["read_csv"],
+            ),
+            cache_dir=cache_dir,
+        )
+        _CORE_DATA_CACHE[path] = (stat_key, df)
+    return _CORE_DATA_CACHE[path][1].copy()
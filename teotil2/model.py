@@ -1,5 +1,6 @@
+import hashlib
 import os
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import geopandas as gpd
 import graphviz
@@ -8,30 +9,87 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 
+REQ_COLS = [
+    "regine",
+    "regine_ned",
+    "a_reg_km2",
+    "runoff_mm/yr",
+    "q_reg_m3/s",
+    "vol_lake_m3",
+]
 
-def run_model(data):
+
+def run_model(data, as_graph=True, cache_dir=None, targets=None):
     """Run the TEOTIL2 model with the specified inputs. 'data' must either be a dataframe or a
        file path to a CSV in the correct format e.g. the dataframe or CSV returned by
        make_input_file(). See below for format details.
 
        Quantities specified in 'data' are assigned to the regine catchment network and
-       accumulated downstream, allowing for retention.
+       accumulated downstream, allowing for retention. Accumulation is performed using the
+       array-based engine in accumulate_arrays().
 
     Args:
-        data: Raw str or dataframe e.g. as returned by make_input_file(). The following
-              columns are mandatory:
+        data:      Raw str or dataframe e.g. as returned by make_input_file(). The following
+                   columns are mandatory:
 
-                   ["regine", "regine_ned", "a_reg_km2",
-                    "runoff_mm/yr", "q_reg_m3/s", "vol_lake_m3"]
+                        ["regine", "regine_ned", "a_reg_km2",
+                         "runoff_mm/yr", "q_reg_m3/s", "vol_lake_m3"]
 
-              Additional columns to be accumulated must be named '{source}_{par}_{unit}',
-              all in lowercase e.g. 'ind_cd_tonnes' for industrial point inputs of cadmium
-              in tonnes. In addition, theremust be a corresponding column named
-              'trans_{par}' containing transmission factors (floats between 0 and 1)
+                   Additional columns to be accumulated must be named '{source}_{par}_{unit}',
+                   all in lowercase e.g. 'ind_cd_tonnes' for industrial point inputs of cadmium
+                   in tonnes. In addition, theremust be a corresponding column named
+                   'trans_{par}' containing transmission factors (floats between 0 and 1)
+        as_graph:  Bool. Default True. Whether to return results as a NetworkX graph, with
+                   'local' and 'accum' dicts for each node. The dicts are plain, mutable
+                   copies of every column for every node (as in previous versions), so
+                   building the graph takes time and memory proportional to
+                   (n_nodes x n_columns) and usually dominates the run time. If False,
+                   results are returned directly as a ModelResult, without creating
+                   per-node dicts, which is much faster for large networks. Use
+                   model_to_dataframe() to convert either to a dataframe
+        cache_dir: Str. Optional. Folder in which to cache the compiled regine network. See
+                   get_network()
+        targets:   List of str. Optional. Regine IDs of interest e.g. monitoring stations.
+                   If supplied, only the catchments upstream of (and including) 'targets'
+                   are modelled and returned
 
     Returns:
-        NetworkX graph object with results added as node attributes.
+        NetworkX graph object with results added as node attributes or, if 'as_graph' is
+        False, a ModelResult.
     """
+    df = _parse_input(data)
+    acc_cols = _get_acc_cols(df)
+
+    # Get compiled network and accumulate
+    net = get_network(df, cache_dir=cache_dir)
+    if targets is not None:
+        net = net.prune(targets)
+        df = df.iloc[net.align(df["regine"])]
+    local, trans = _get_local_arrays(df, net, acc_cols)
+    accum = accumulate_arrays(net, local, trans)
+    accum_cols = ["upstr_area_km2", "q_m3/s"] + acc_cols
+
+    if not as_graph:
+        return _build_result(df, net, accum_cols, accum)
+
+    # Build graph. Node attributes are plain dicts, as for accumulate_loads(), so this is
+    # O(n_nodes x n_columns). Use as_graph=False to avoid it
+    df = df.iloc[net.align(df["regine"])]
+    g = nx.DiGraph()
+    g.add_nodes_from(
+        (nd, {"local": local_dict, "accum": dict(zip(accum_cols, accum_row))})
+        for nd, local_dict, accum_row in zip(
+            net.regine, df.to_dict("records"), accum.tolist()
+        )
+    )
+    g.add_edges_from(zip(net.regine, net.regine_ned))
+    g.graph["network"] = net
+
+    return g
+
+
+def _parse_input(data):
+    """Read model input data and check required columns are present. See run_model()."""
     # Parse input
     if isinstance(data, pd.DataFrame):
         df = data
@@ -41,20 +99,19 @@ def run_model(data):
         raise ValueError('"data" must be either a "raw" string or a Pandas dataframe.')
 
     # Check required cols are present
-    req_cols = [
-        "regine",
-        "regine_ned",
-        "a_reg_km2",
-        "runoff_mm/yr",
-        "q_reg_m3/s",
-        "vol_lake_m3",
-    ]
-    for col in req_cols:
+    for col in REQ_COLS:
         assert col in df.columns, f"'data' must contain a column named '{col}'."
 
+    return df
+
+
+def _get_acc_cols(df):
+    """Identify columns to accumulate and check the corresponding 'trans' columns are
+    present and valid. See run_model().
+    """
     # Identify cols to accumulate
     acc_cols = [
-        i for i in df.columns if (i not in req_cols) and (i.split("_")[0] != "trans")
+        i for i in df.columns if (i not in REQ_COLS) and (i.split("_")[0] != "trans")
     ]
 
     # Check 'trans' cols are present
@@ -64,27 +121,1235 @@ def run_model(data):
             f"trans_{par}" in df.columns
         ), f"Column 'trans_{par}' not present in input.'"
         assert (
-            df[f"trans_{par}"].between(0, 1, inclusive='both').all()
+            df[f"trans_{par}"].between(0, 1, inclusive="both").all()
         ), f"Column 'trans_{par}' contains values outside of range [0, 1]"
 
-    # Build graph
-    g = nx.DiGraph()
+    return acc_cols
+
+
+class Network:
+    """Compiled regine network, as returned by compile_network() or get_network(). Nodes are
+       stored in topological order (headwaters first) and sorted into "levels", where level
+       0 contains the headwaters and each node is in a higher level than all of the nodes
+       directly upstream. Within each level, nodes are grouped by their downstream
+       neighbour, so that loads can be passed downstream one level at a time using
+       np.add.reduceat().
+
+    Attributes:
+        regine:     Array of str. Regine IDs in topological order
+        regine_ned: Array of str. Downstream regine IDs in topological order
+        parent:     Array of int. Position of the downstream node in 'regine' (-1 if the
+                    node drains to an outlet outside the network)
+        level_ptr:  Array of int. Start and end positions of each level in 'regine'
+        seg_ptr:    Array of int. Start and end positions of each level in 'seg_start'
+                    and 'seg_parent'
+        seg_start:  Array of int. Offsets within each level of groups of nodes sharing a
+                    parent
+        seg_parent: Array of int. Parent position for each group
+        key:        Str. Content hash of the network links. See network_key()
+        is_tree:    Bool. Whether the network has been validated as a directed tree
+    """
+
+    _arrays = [
+        "regine",
+        "regine_ned",
+        "parent",
+        "level_ptr",
+        "seg_ptr",
+        "seg_start",
+        "seg_parent",
+    ]
+
+    def __init__(
+        self,
+        regine,
+        regine_ned,
+        parent,
+        level_ptr,
+        seg_ptr,
+        seg_start,
+        seg_parent,
+        key=None,
+        is_tree=False,
+    ):
+        self.regine = regine
+        self.regine_ned = regine_ned
+        self.parent = parent
+        self.level_ptr = level_ptr
+        self.seg_ptr = seg_ptr
+        self.seg_start = seg_start
+        self.seg_parent = seg_parent
+        self.key = key
+        self.is_tree = is_tree
+        self._index = None
+        self._children = None
+        self._euler = None
+
+    def __len__(self):
+        return len(self.regine)
+
+    def __repr__(self):
+        return "Network(n_nodes=%s, n_levels=%s, key=%s)" % (
+            len(self),
+            self.n_levels,
+            self.key,
+        )
+
+    @property
+    def n_levels(self):
+        return len(self.level_ptr) - 1
+
+    @property
+    def index(self):
+        """pd.Index mapping regine IDs to positions in the network."""
+        if self._index is None:
+            self._index = pd.Index(self.regine)
+        return self._index
+
+    @property
+    def level(self):
+        """Array of int. Level of each node."""
+        return np.repeat(np.arange(self.n_levels), np.diff(self.level_ptr))
+
+    @property
+    def children(self):
+        """Tuple (ptr, idx) of arrays in compressed sparse row format. The positions of
+        the nodes directly upstream of node 'i' are idx[ptr[i]:ptr[i + 1]].
+        """
+        if self._children is None:
+            has_par = np.flatnonzero(self.parent >= 0)
+            idx = has_par[np.argsort(self.parent[has_par], kind="stable")]
+            counts = np.bincount(self.parent[has_par], minlength=len(self))
+            ptr = np.concatenate([[0], np.cumsum(counts)])
+            self._children = (ptr, idx)
+        return self._children
+
+    def downstream_nodes(self, pos):
+        """Sorted positions of all nodes on the paths from the nodes in 'pos' (inclusive)
+        to the network outlet.
+        """
+        mark = np.zeros(len(self), dtype=bool)
+        front = np.unique(pos)
+        while front.size > 0:
+            front = front[~mark[front]]
+            mark[front] = True
+            front = self.parent[front]
+            front = np.unique(front[front >= 0])
+
+        return np.flatnonzero(mark)
+
+    @property
+    def euler(self):
+        """Tuple (tin, tout, order) of arrays defining an interval index based on a
+        depth-first traversal upstream from the outlet. Node 'i' is visited at step
+        tin[i] and all nodes upstream of 'i' (inclusive) are visited in steps
+        tin[i] <= step < tout[i]. 'order' gives the node visited at each step, so the
+        nodes upstream of 'i' are order[tin[i]:tout[i]].
+        """
+        if self._euler is None:
+            # Number of nodes upstream of each node (inclusive)
+            size = accumulate_arrays(self, np.ones(len(self)), 1)
+            size = np.rint(size).astype(np.int64)
+
+            # Offset of each node from its parent, allowing for siblings visited earlier.
+            # Nodes draining to the outlet are treated as siblings
+            ptr, idx = self.children
+            roots = np.flatnonzero(self.parent < 0)
+            offset = np.zeros(len(self), dtype=np.int64)
+            for nds, st in [(idx, ptr[self.parent[idx]]), (roots, 0)]:
+                excl = np.cumsum(size[nds]) - size[nds]
+                offset[nds] = excl - excl[st]
+
+            # Assign entry steps working upstream
+            tin = np.empty(len(self), dtype=np.int64)
+            for lev in reversed(range(self.n_levels)):
+                st, end = self.level_ptr[lev], self.level_ptr[lev + 1]
+                par = self.parent[st:end]
+                par_tin = np.where(par >= 0, tin[np.maximum(par, 0)], -1)
+                tin[st:end] = par_tin + 1 + offset[st:end]
+
+            order = np.empty(len(self), dtype=np.int64)
+            order[tin] = np.arange(len(self))
+            self._euler = (tin, tin + size, order)
 
-    # Add nodes
-    for idx, row in df.iterrows():
-        nd = row["regine"]
-        g.add_node(nd, local=row.to_dict(), accum={})
+        return self._euler
 
-    # Add edges
-    for idx, row in df.iterrows():
-        fr_nd = row["regine"]
-        to_nd = row["regine_ned"]
-        g.add_edge(fr_nd, to_nd)
+    def upstream_nodes(self, regine):
+        """Positions of all nodes upstream of 'regine' (inclusive), in depth-first order.
+
+        Args:
+            regine: Str. Regine ID
+
+        Returns:
+            Array of int.
+        """
+        tin, tout, order = self.euler
+        pos = self.index.get_loc(regine)
+
+        return order[tin[pos] : tout[pos]]
+
+    def is_upstream(self, regine_a, regine_b):
+        """Whether 'regine_a' is upstream of (or equal to) 'regine_b'. Both arguments can
+        be single IDs or array-likes of IDs of the same length.
+        """
+        tin, tout, order = self.euler
+        pos_a = self.get_indexer(np.atleast_1d(regine_a))
+        pos_b = self.get_indexer(np.atleast_1d(regine_b))
+        assert (pos_a >= 0).all() and (
+            pos_b >= 0
+        ).all(), "Some regine IDs are not in the network."
+        res = (tin[pos_b] <= tin[pos_a]) & (tin[pos_a] < tout[pos_b])
+
+        return res if np.ndim(regine_a) or np.ndim(regine_b) else bool(res[0])
+
+    def downstream_path(self, regine):
+        """Positions of the nodes on the path from 'regine' (inclusive) to the outlet.
+
+        Args:
+            regine: Str. Regine ID
+
+        Returns:
+            Array of int.
+        """
+        path = [self.index.get_loc(regine)]
+        while self.parent[path[-1]] >= 0:
+            path.append(self.parent[path[-1]])
+
+        return np.array(path)
+
+    def get_indexer(self, regine):
+        """Positions of the IDs in 'regine' within the network (-1 if not present)."""
+        return self.index.get_indexer(regine)
+
+    def align(self, regine):
+        """Get row positions that sort 'regine' (e.g. the 'regine' column of an input
+        dataframe) into the network's topological order. 'regine' must contain each
+        node in the network exactly once. Any other IDs in 'regine' are ignored.
+        """
+        reg_idx = pd.Index(regine)
+        assert reg_idx.is_unique, "Regine IDs must be unique."
+        rows = reg_idx.get_indexer(self.regine)
+        assert (rows >= 0).all(), "'regine' does not match the nodes in the network."
+
+        return rows
+
+    def upstream_mask(self, regine):
+        """Boolean mask identifying all nodes upstream of (or equal to) any of the IDs in
+           'regine'. The Euler intervals for all targets are marked in a single pass.
+
+        Args:
+            regine: List of str. Regine IDs
+
+        Returns:
+            Array of bool.
+        """
+        tin, tout, order = self.euler
+        pos = self.get_indexer(regine)
+        assert (pos >= 0).all(), "Some regine IDs are not in the network."
+        steps = np.zeros(len(self) + 1, dtype=np.int64)
+        np.add.at(steps, tin[pos], 1)
+        np.add.at(steps, tout[pos], -1)
+        in_steps = np.cumsum(steps[:-1]) > 0
+
+        return in_steps[tin]
+
+    def prune(self, regine):
+        """Get the sub-network draining to any of the nodes in 'regine' i.e. all nodes
+           upstream of (and including) 'regine'. A node in 'regine' that lies upstream of
+           another remains an interior node of the sub-network.
+
+        Args:
+            regine: List of str. Regine IDs
+
+        Returns:
+            Network object.
+        """
+        keep = np.flatnonzero(self.upstream_mask(regine))
+        new_pos = np.full(len(self), -1)
+        new_pos[keep] = np.arange(len(keep))
+        par = self.parent[keep]
+        par = np.where(par >= 0, new_pos[np.maximum(par, 0)], -1)
+        reg, reg_ned = self.regine[keep], self.regine_ned[keep]
+
+        return _sort_network(
+            reg, reg_ned, par, self.level[keep], key=network_key(reg, reg_ned)
+        )
+
+    def save(self, path):
+        """Save the compiled network as a compressed .npz file."""
+        arrays = {name: getattr(self, name) for name in self._arrays}
+        arrays["regine"] = arrays["regine"].astype(str)
+        arrays["regine_ned"] = arrays["regine_ned"].astype(str)
+        np.savez_compressed(path, key=str(self.key), is_tree=self.is_tree, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a compiled network saved using Network.save()."""
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in cls._arrays}
+            key = str(data["key"])
+            is_tree = bool(data["is_tree"])
+        arrays["regine"] = arrays["regine"].astype(object)
+        arrays["regine_ned"] = arrays["regine_ned"].astype(object)
+
+        return cls(key=key, is_tree=is_tree, **arrays)
+
+
+# Compiled networks already loaded in this session, keyed by network_key()
+_NETWORK_CACHE = {}
+
+
+def network_key(regine, regine_ned):
+    """Content hash for a regine network. The hash depends only on the set of links
+       ('regine' => 'regine_ned'), not on the row order, so all input files built from
+       the same regine_YYYY.csv share the same key.
+
+    Args:
+        regine:     Array-like of str. Regine IDs
+        regine_ned: Array-like of str. Regine ID of the downstream neighbour for each
+                    node in 'regine'
+
+    Returns:
+        Str. SHA-1 hex digest.
+    """
+    links = pd.DataFrame(
+        {
+            "regine": np.asarray(regine, dtype=str),
+            "regine_ned": np.asarray(regine_ned, dtype=str),
+        }
+    )
+    hashes = np.sort(pd.util.hash_pandas_object(links, index=False).to_numpy())
+
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+
+def get_network(data, cache_dir=None, sep=","):
+    """Get the compiled network for a dataframe or CSV containing columns 'regine' and
+       'regine_ned' e.g. a model input file or one of the core 'regine_YYYY.csv' files
+       (use sep=";"). Compiled networks are cached in memory and, optionally, on disk as
+       'network_{key}.npz' files in 'cache_dir', where 'key' is the content hash returned by
+       network_key(). The network is therefore only compiled and validated once for each
+       version of the regine network, and the cache is invalidated automatically if the
+       links change.
+
+    Args:
+        data:      Raw str or dataframe. If a path is supplied, rows with no value for
+                   'regine_ned' are ignored (as in make_input_file())
+        cache_dir: Str. Optional. Folder in which to store compiled networks
+        sep:       Str. Default ','. Delimiter used if 'data' is a path
+
+    Returns:
+        Network object.
+    """
+    # Parse input
+    if isinstance(data, pd.DataFrame):
+        df = data
+    elif isinstance(data, str):
+        df = pd.read_csv(data, sep=sep, usecols=["regine", "regine_ned"])
+        df = df.dropna(subset=["regine_ned"])
+    else:
+        raise ValueError('"data" must be either a "raw" string or a Pandas dataframe.')
+
+    # Check required cols are present
+    for col in ["regine", "regine_ned"]:
+        assert col in df.columns, f"'data' must contain a column named '{col}'."
+
+    key = network_key(df["regine"], df["regine_ned"])
+    if key in _NETWORK_CACHE:
+        return _NETWORK_CACHE[key]
+
+    net = None
+    if cache_dir:
+        npz_path = os.path.join(cache_dir, f"network_{key}.npz")
+        if os.path.isfile(npz_path):
+            net = Network.load(npz_path)
+            if (net.key != key) or (not net.is_tree):
+                net = None
+
+    if net is None:
+        net = compile_network(df["regine"], df["regine_ned"], key=key)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            net.save(npz_path)
+
+    _NETWORK_CACHE[key] = net
+
+    return net
+
+
+def compile_network(regine, regine_ned, key=None):
+    """Compile and validate a regine network for use with accumulate_arrays(). Usually
+       called via get_network(), which caches the result. See the Network class for
+       details.
+
+    Args:
+        regine:     Array-like of str. Regine IDs. Must be unique
+        regine_ned: Array-like of str. Regine ID of the downstream neighbour for each node
+                    in 'regine'. Exactly one ID (the outlet or "sea") may appear here that
+                    is not present in 'regine'
+        key:        Str. Optional. Content hash for the network. Calculated using
+                    network_key() if not supplied
+
+    Returns:
+        Network object.
+    """
+    regine = np.asarray(regine, dtype=object)
+    regine_ned = np.asarray(regine_ned, dtype=object)
+    n_nds = len(regine)
+    if key is None:
+        key = network_key(regine, regine_ned)
+
+    # Intern IDs
+    reg_idx = pd.Index(regine)
+    assert reg_idx.is_unique, "Regine IDs must be unique."
+    par = reg_idx.get_indexer(regine_ned)
+
+    # Check directed tree i.e. a single outlet and no cycles
+    assert len(set(regine_ned[par < 0])) == 1, "g is not a valid tree."
+
+    # Assign levels working down from headwaters
+    n_up = np.bincount(par[par >= 0], minlength=n_nds)
+    level = np.full(n_nds, -1)
+    front = np.flatnonzero(n_up == 0)
+    n_lev = 0
+    while front.size > 0:
+        level[front] = n_lev
+        pars = par[front]
+        pars = pars[pars >= 0]
+        np.subtract.at(n_up, pars, 1)
+        front = np.unique(pars)
+        front = front[n_up[front] == 0]
+        n_lev += 1
+    assert (level >= 0).all(), "g is not a valid DAG."
+
+    return _sort_network(regine, regine_ned, par, level, key=key, is_tree=True)
+
+
+def _sort_network(regine, regine_ned, par, level, key=None, is_tree=False):
+    """Sort nodes by level and then by parent, and build a Network object. See
+       compile_network().
+
+    Args:
+        regine:     Array of str. Regine IDs
+        regine_ned: Array of str. Downstream regine IDs
+        par:        Array of int. Position of the downstream node in 'regine' (-1 if not
+                    present)
+        level:      Array of int. Level of each node
+        key:        Str. Optional. Content hash for the network
+        is_tree:    Bool. Whether the network has been validated as a directed tree
+
+    Returns:
+        Network object.
+    """
+    n_nds = len(regine)
+    n_lev = level.max() + 1 if n_nds > 0 else 0
+    order = np.lexsort((par, level))
+    pos = np.empty(n_nds, dtype=np.int64)
+    pos[order] = np.arange(n_nds)
+    parent = par[order]
+    parent = np.where(parent >= 0, pos[np.maximum(parent, 0)], -1)
+    level_ptr = np.searchsorted(level[order], np.arange(n_lev + 1))
+
+    seg_start, seg_parent, seg_ptr = _level_segments(parent, level_ptr)
+
+    return Network(
+        regine=regine[order],
+        regine_ned=regine_ned[order],
+        parent=parent,
+        level_ptr=level_ptr,
+        seg_ptr=seg_ptr,
+        seg_start=seg_start,
+        seg_parent=seg_parent,
+        key=key,
+        is_tree=is_tree,
+    )
+
+
+def _level_segments(parent, level_ptr):
+    """Find groups of nodes with the same parent within each level. Nodes must already be
+    sorted by level and then by parent. See compile_network().
+    """
+    seg_start, seg_parent, seg_ptr = [], [], [0]
+    for lev in range(len(level_ptr) - 1):
+        st, end = level_ptr[lev], level_ptr[lev + 1]
+        lev_par = parent[st:end]
+        starts = np.flatnonzero(np.diff(lev_par, prepend=-2) != 0)
+        starts = starts[lev_par[starts] >= 0]
+        seg_start.append(starts)
+        seg_parent.append(lev_par[starts])
+        seg_ptr.append(seg_ptr[-1] + len(starts))
+
+    return (
+        np.concatenate([[]] + seg_start).astype(np.int64),
+        np.concatenate([[]] + seg_parent).astype(np.int64),
+        np.array(seg_ptr, dtype=np.int64),
+    )
+
+
+def accumulate_arrays(net, local, trans, inplace=False):
+    """Perform accumulation over a compiled TEOTIL2 network. Equivalent to
+       accumulate_loads(), but operating on arrays rather than graph attributes. Local
+       inputs are accumulated downstream one level at a time, such that for each node
+       Oi = ti(Li + Ii).
+
+    Args:
+        net:     Network object returned by get_network() or compile_network()
+        local:   Array of floats with shape (n_nodes, ...). Local inputs for each node, in
+                 the same (topological) order as net.regine. Any number of trailing
+                 dimensions (e.g. columns, scenarios or years) are allowed
+        trans:   Array of floats. Transmission factors. Must be broadcastable to 'local'
+        inplace: Bool. Default False. If True, 'local' (which must then be an array of
+                 floats) is overwritten with the results, avoiding a copy
+
+    Returns:
+        Array with the same shape as 'local'. Total amount of substance flowing out of
+        each node.
+    """
+    accum = local if inplace else np.array(local, dtype=float)
+    trans = np.broadcast_to(trans, accum.shape)
+    level_ptr, seg_ptr = net.level_ptr, net.seg_ptr
+    seg_start, seg_parent = net.seg_start, net.seg_parent
+
+    # Process levels from headwaters down
+    for lev in range(len(level_ptr) - 1):
+        st, end = level_ptr[lev], level_ptr[lev + 1]
+
+        # Oi = ti(Li + Ii). Ii has already been added to accum
+        blk = accum[st:end]
+        blk *= trans[st:end]
+
+        # Pass output to downstream nodes
+        seg_st, seg_end = seg_ptr[lev], seg_ptr[lev + 1]
+        if seg_end > seg_st:
+            accum[seg_parent[seg_st:seg_end]] += np.add.reduceat(
+                blk, seg_start[seg_st:seg_end], axis=0
+            )
+
+    return accum
+
+
+def _get_local_arrays(df, net, acc_cols):
+    """Extract local inputs and transmission factors from 'df' as arrays in topological
+    order. Area and flow are included as the first two columns, with transmission of 1.
+    """
+    df = df.iloc[net.align(df["regine"])]
+    local = df[["a_reg_km2", "q_reg_m3/s"] + acc_cols].to_numpy(dtype=float)
+    trans_cols = ["trans_%s" % col.split("_")[-2] for col in acc_cols]
+    trans = np.ones_like(local)
+    trans[:, 2:] = df[trans_cols].to_numpy(dtype=float)
+
+    return local, trans
+
+
+def _build_result(df, net, accum_cols, accum, local_cols=None, local=None, trans=None):
+    """Build a ModelResult from input data and accumulated results. Local inputs and
+       transmission factors are taken from 'df', unless modified values are supplied in
+       'local' and 'trans' (e.g. for scenarios).
+
+    Args:
+        df:         Dataframe. Input data
+        net:        Network object
+        accum_cols: List of str. Names of columns in 'accum'
+        accum:      Array with shape (n_nodes, n_accum_cols). Accumulated results
+        local_cols: List of str. Optional. Names of columns in 'local'
+        local:      Array with shape (n_nodes, n_local_cols). Optional. Local inputs
+        trans:      Array with shape (n_nodes, n_local_cols). Optional. Transmission
+                    factors for each column in 'local'
+
+    Returns:
+        ModelResult.
+    """
+    df = df.iloc[net.align(df["regine"])]
+    cols = sorted(col for col in df.columns if col not in ("regine", "regine_ned"))
+    values = np.asfortranarray(df[cols].to_numpy(dtype=float))
+
+    if local_cols is not None:
+        col_idx = {col: idx for idx, col in enumerate(cols)}
+        for idx, col in enumerate(local_cols):
+            values[:, col_idx[col]] = local[:, idx]
+            if idx > 1:
+                values[:, col_idx["trans_%s" % col.split("_")[-2]]] = trans[:, idx]
+
+    return ModelResult(net, cols, values, accum_cols, accum)
+
+
+class ModelResult:
+    """Columnar TEOTIL2 results, as returned by run_model(as_graph=False). Local inputs and
+       accumulated results are stored as 2D float arrays with one row per regine (in
+       network order) and columns sorted by name. Arrays are column-major, so each column
+       is contiguous and model_to_dataframe() can wrap them without copying.
+
+       Can be used in place of a graph with model_to_dataframe(), plot_network() and
+       make_map(). Code that reads or modifies per-node dicts (e.g.
+       g.nodes[regine]['accum']) requires a graph from run_model(as_graph=True).
+
+       Columns can be accessed by name in O(1) e.g. res["accum_q_m3/s"], which returns a
+       view of the underlying array.
+
+    Attributes:
+        network:    Network object. Rows are in the same order as 'network.regine'
+        regine:     Array of str. Regine IDs
+        regine_ned: Array of str. Downstream regine IDs
+        local_cols: List of str. Names of the columns in 'local'
+        local:      Array with shape (n_nodes, n_local_cols). Local inputs
+        accum_cols: List of str. Names of the columns in 'accum'
+        accum:      Array with shape (n_nodes, n_accum_cols). Accumulated results
+    """
+
+    def __init__(self, network, local_cols, local, accum_cols, accum):
+        self.network = network
+        self.regine = network.regine
+        self.regine_ned = network.regine_ned
+        self.local_cols, self.local = self._sort_cols(local_cols, local)
+        self.accum_cols, self.accum = self._sort_cols(accum_cols, accum)
+        self._cols = {
+            "regine": (self.regine, None),
+            "regine_ned": (self.regine_ned, None),
+        }
+        for stat in ["local", "accum"]:
+            for idx, col in enumerate(getattr(self, "%s_cols" % stat)):
+                self._cols["%s_%s" % (stat, col)] = (getattr(self, stat), idx)
+
+    @staticmethod
+    def _sort_cols(cols, arr):
+        """Sort columns by name and convert to a column-major float array."""
+        cols = list(cols)
+        order = np.argsort(cols, kind="stable")
+        if (order != np.arange(len(cols))).any():
+            cols = [cols[idx] for idx in order]
+            arr = arr[:, order]
+
+        return cols, np.asfortranarray(arr, dtype=float)
+
+    def __len__(self):
+        return len(self.regine)
+
+    def __repr__(self):
+        return "ModelResult(n_nodes=%s, n_local_cols=%s, n_accum_cols=%s)" % (
+            len(self),
+            len(self.local_cols),
+            len(self.accum_cols),
+        )
+
+    def __contains__(self, col):
+        return col in self._cols
+
+    def __getitem__(self, col):
+        """Column by name e.g. 'regine', 'local_q_reg_m3/s' or 'accum_q_m3/s'."""
+        arr, idx = self._cols[col]
+
+        return arr if idx is None else arr[:, idx]
+
+    @property
+    def columns(self):
+        """List of str. Column names, in the same order as model_to_dataframe()."""
+        return list(self._cols)
+
+    def to_dataframe(self):
+        """Dataframe with the same format as model_to_dataframe(). The 'local_' and
+        'accum_' columns share memory with the arrays in this object.
+        """
+        key_df = pd.DataFrame({"regine": self.regine, "regine_ned": self.regine_ned})
+        accum_df = pd.DataFrame(
+            self.accum,
+            columns=["accum_%s" % col for col in self.accum_cols],
+            copy=False,
+        )
+        local_df = pd.DataFrame(
+            self.local,
+            columns=["local_%s" % col for col in self.local_cols],
+            copy=False,
+        )
+
+        return pd.concat([key_df, accum_df, local_df], axis=1, **_CONCAT_KWARGS)
+
+
+# pd.concat() copies by default in pandas < 3. The 'copy' argument was removed in 3.0
+_CONCAT_KWARGS = {"copy": False} if int(pd.__version__.split(".")[0]) < 3 else {}
+
+
+def run_scenarios(data, scenarios, cache_dir=None):
+    """Run the TEOTIL2 model for several management scenarios in a single pass. Each
+       scenario is defined by multipliers or replacement values for one or more columns
+       of the base input. All scenarios are accumulated together as an array with shape
+       (n_nodes, n_cols, n_scenarios), so the network and Python overhead are only paid
+       once.
+
+       NOTE: Aggregated columns (e.g. 'all_point_{par}_tonnes') are not recalculated from
+       their components. If a scenario modifies e.g. 'aqu_tot-p_tonnes', corresponding
+       changes to the aggregated columns must be specified explicitly.
+
+    Args:
+        data:      Raw str or dataframe. Base input data. See run_model() for details
+        scenarios: Dict. {name: {'multiply': {col: value}, 'replace': {col: value}}}.
+                   'col' can be any accumulated column, 'a_reg_km2', 'q_reg_m3/s' or
+                   'trans_{par}'. 'value' is either a float (applied to all regines) or a
+                   Series indexed by regine ID (applied to the listed regines only). For
+                   example, to reduce aquaculture P by 30 % in the regines in 'reg_list':
+
+                       fac = pd.Series(0.7, index=reg_list)
+                       {"aqu_cut": {"multiply": {"aqu_tot-p_tonnes": fac}}}
+
+        cache_dir: Str. Optional. Folder in which to cache the compiled regine network. See
+                   get_network()
+
+    Returns:
+        Dataframe in "long" format. Columns are 'scenario', 'regine', 'regine_ned' and the
+        'local_' and 'accum_' columns returned by model_to_dataframe().
+    """
+    df = _parse_input(data)
+    acc_cols = _get_acc_cols(df)
+    net = get_network(df, cache_dir=cache_dir)
+    local, trans = _get_local_arrays(df, net, acc_cols)
+    local_cols = ["a_reg_km2", "q_reg_m3/s"] + acc_cols
+    col_pars = [None, None] + [col.split("_")[-2] for col in acc_cols]
+    accum_cols = ["upstr_area_km2", "q_m3/s"] + acc_cols
+
+    # Expand to (node, col, scenario). Trans is only copied if it is modified
+    names = list(scenarios)
+    local = np.repeat(local[:, :, np.newaxis], len(names), axis=2)
+    mod_trans = any(
+        col.split("_")[0] == "trans"
+        for spec in scenarios.values()
+        for cols in spec.values()
+        for col in cols
+    )
+    if mod_trans:
+        trans = np.repeat(trans[:, :, np.newaxis], len(names), axis=2)
+    else:
+        trans = trans[:, :, np.newaxis]
+
+    # Apply scenarios
+    for scen, name in enumerate(names):
+        for how, cols in scenarios[name].items():
+            if how not in ("multiply", "replace"):
+                raise ValueError("Scenario keys must be 'multiply' or 'replace'.")
+            for col, value in cols.items():
+                if col.split("_")[0] == "trans":
+                    arr = trans
+                    col_idx = [
+                        idx for idx, par in enumerate(col_pars) if par == col[6:]
+                    ]
+                    assert (
+                        len(col_idx) > 0
+                    ), f"'{col}' is not a transmission factor for an accumulated column."
+                else:
+                    assert col in local_cols, f"Column '{col}' cannot be modified."
+                    arr = local
+                    col_idx = [local_cols.index(col)]
+                rows, value = _node_values(net, value)
+                for idx in col_idx:
+                    if how == "multiply":
+                        arr[rows, idx, scen] *= value
+                    else:
+                        arr[rows, idx, scen] = value
+
+    assert (
+        (trans >= 0) & (trans <= 1)
+    ).all(), "Scenario transmission factors must be in [0, 1]."
 
     # Accumulate
-    g = accumulate_loads(g, acc_cols)
+    accum = accumulate_arrays(net, local, trans)
+
+    # Build output
+    df_list = []
+    for scen, name in enumerate(names):
+        res_df = _build_result(
+            df,
+            net,
+            accum_cols,
+            accum[:, :, scen],
+            local_cols,
+            local[:, :, scen],
+            trans[:, :, min(scen, trans.shape[2] - 1)],
+        ).to_dataframe()
+        res_df.insert(0, "scenario", name)
+        df_list.append(res_df)
+
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+
+class IncrementalModel:
+    """Stateful TEOTIL2 model for interactive "what if" analyses. The model is run once
+       when the object is created and the accumulated results are kept. Subsequent changes
+       to local inputs or transmission factors for a few regines are then propagated along
+       the affected paths to the outlet only, rather than re-accumulating the whole network.
+
+    Attributes:
+        net:        Network object
+        local_cols: List of str. Names of the columns in 'local' and 'trans'
+        accum_cols: List of str. Names of the columns in 'accum'
+        local:      Array with shape (n_nodes, n_local_cols). Current local inputs
+        trans:      Array with shape (n_nodes, n_local_cols). Current transmission factors
+                    for each column in 'local'
+        accum:      Array with shape (n_nodes, n_accum_cols). Current accumulated results
+    """
+
+    def __init__(self, data, cache_dir=None):
+        """Build the model and perform a full accumulation.
+
+        Args:
+            data:      Raw str or dataframe. Input data. See run_model() for details
+            cache_dir: Str. Optional. Folder in which to cache the compiled regine network.
+                       See get_network()
+        """
+        df = _parse_input(data)
+        acc_cols = _get_acc_cols(df)
+        self.net = get_network(df, cache_dir=cache_dir)
+        self.local_cols = ["a_reg_km2", "q_reg_m3/s"] + acc_cols
+        self.accum_cols = ["upstr_area_km2", "q_m3/s"] + acc_cols
+        self.local, self.trans = _get_local_arrays(df, self.net, acc_cols)
+        self.accum = accumulate_arrays(self.net, self.local, self.trans)
+        self._base_df = df.iloc[self.net.align(df["regine"])]
+        self._col_idx = {col: idx for idx, col in enumerate(self.local_cols)}
+
+    def update(self, loads=None, trans=None, how="add"):
+        """Update local inputs and/or transmission factors for selected regines and
+           re-accumulate the affected paths downstream.
+
+        Args:
+            loads: Dataframe. Optional. Indexed by (unique) regine ID, with one or more
+                   columns from 'local_cols'. Interpreted according to 'how'
+            trans: Dataframe. Optional. Indexed by (unique) regine ID, with one or more
+                   columns named 'trans_{par}' giving new transmission factors
+            how:   Str. 'add' or 'replace'. Whether values in 'loads' are changes to be
+                   added to the current local inputs, or new values
+
+        Returns:
+            None. The object is updated in place.
+        """
+        if how not in ("add", "replace"):
+            raise ValueError("'how' must be one of ['add', 'replace'].")
+        for name, upd_df in [("loads", loads), ("trans", trans)]:
+            if (upd_df is not None) and upd_df.index.has_duplicates:
+                raise ValueError(f"'{name}' contains duplicate regine IDs.")
+
+        n_cols = len(self.local_cols)
+        rows_list, d_in_list, d_out_list = [], [], []
+
+        # Transmission changes. Must use local inputs before any change to loads
+        if trans is not None:
+            rows = self._get_rows(trans.index)
+            new_trans = self.trans[rows]
+            for col in trans.columns:
+                par = col[6:]
+                col_idx = [
+                    idx
+                    for idx, name in enumerate(self.local_cols)
+                    if (idx > 1) and (name.split("_")[-2] == par)
+                ]
+                assert (col.split("_")[0] == "trans") and (
+                    len(col_idx) > 0
+                ), f"'{col}' is not a transmission factor for an accumulated column."
+                vals = trans[col].to_numpy(dtype=float)
+                assert (
+                    (vals >= 0) & (vals <= 1)
+                ).all(), f"Column '{col}' contains values outside of range [0, 1]"
+                new_trans[:, col_idx] = vals[:, np.newaxis]
+
+            # Change in output is (Li + Ii) * (ti_new - ti_old)
+            ptr, idx = self.net.children
+            inflow = np.zeros((len(rows), n_cols))
+            for i, row in enumerate(rows):
+                inflow[i] = self.accum[idx[ptr[row] : ptr[row + 1]]].sum(axis=0)
+            d_out = (self.local[rows] + inflow) * (new_trans - self.trans[rows])
+            self.trans[rows] = new_trans
+
+            rows_list.append(rows)
+            d_in_list.append(np.zeros((len(rows), n_cols)))
+            d_out_list.append(d_out)
+
+        # Changes to local inputs
+        if loads is not None:
+            rows = self._get_rows(loads.index)
+            for col in loads.columns:
+                assert col in self._col_idx, f"Column '{col}' is not a local input."
+            col_idx = [self._col_idx[col] for col in loads.columns]
+            vals = loads.to_numpy(dtype=float)
+            if how == "replace":
+                vals = vals - self.local[rows[:, np.newaxis], col_idx]
+            self.local[rows[:, np.newaxis], col_idx] += vals
+
+            d_in = np.zeros((len(rows), n_cols))
+            d_in[:, col_idx] = vals
+            rows_list.append(rows)
+            d_in_list.append(d_in)
+            d_out_list.append(np.zeros((len(rows), n_cols)))
+
+        if rows_list:
+            self._propagate(
+                np.concatenate(rows_list),
+                np.concatenate(d_in_list),
+                np.concatenate(d_out_list),
+            )
+
+    def _get_rows(self, regine):
+        """Network positions for regine IDs, checking they are present."""
+        rows = self.net.get_indexer(regine)
+        assert (rows >= 0).all(), "Some regine IDs are not in the network."
+
+        return rows
+
+    def _propagate(self, rows, d_in, d_out):
+        """Propagate changes downstream from 'rows'. 'd_in' are changes to the total input
+        to each node (Li + Ii), which are subject to retention at the node itself.
+        'd_out' are changes to the output from each node. Only nodes on the paths from
+        'rows' to the outlet are processed, in topological order.
+        """
+        nodes = self.net.downstream_nodes(rows)
+        loc = np.searchsorted(nodes, rows)
+        delta_in = np.zeros((len(nodes), d_in.shape[1]))
+        delta_out = np.zeros_like(delta_in)
+        np.add.at(delta_in, loc, d_in)
+        np.add.at(delta_out, loc, d_out)
+
+        # Position of each node's parent in 'nodes' (-1 for the outlet)
+        par = self.net.parent[nodes]
+        par_loc = np.where(par >= 0, np.searchsorted(nodes, par), -1)
+
+        # Process one level at a time. 'nodes' is sorted, so levels are contiguous
+        levels = self.net.level[nodes]
+        bounds = np.concatenate(
+            [[0], np.flatnonzero(np.diff(levels)) + 1, [len(nodes)]]
+        )
+        for st, end in zip(bounds[:-1], bounds[1:]):
+            out = delta_in[st:end] * self.trans[nodes[st:end]] + delta_out[st:end]
+            self.accum[nodes[st:end]] += out
+            has_par = par_loc[st:end] >= 0
+            np.add.at(delta_in, par_loc[st:end][has_par], out[has_par])
+
+    def get_accum(self, regine):
+        """Current accumulated results for the regines in 'regine'.
+
+        Args:
+            regine: List of str. Regine IDs
+
+        Returns:
+            Dataframe indexed by regine ID.
+        """
+        rows = self._get_rows(regine)
+        df = pd.DataFrame(
+            self.accum[rows],
+            index=pd.Index(self.net.regine[rows], name="regine"),
+            columns=["accum_%s" % col for col in self.accum_cols],
+        )
+
+        return df
+
+    def to_result(self):
+        """Copy of the current state of the model as a ModelResult."""
+        return _build_result(
+            self._base_df,
+            self.net,
+            self.accum_cols,
+            self.accum.copy(),
+            self.local_cols,
+            self.local,
+            self.trans,
+        )
+
+    def to_dataframe(self):
+        """Current state of the model as a dataframe, with the same format as
+        model_to_dataframe().
+        """
+        return self.to_result().to_dataframe()
+
+
+def run_model_years(data, years=None, cache_dir=None, targets=None):
+    """Run the TEOTIL2 model for several years at once. Annual input files are grouped
+       according to the version of the regine network they use. Within each group, the
+       inputs are stacked into an array with shape (n_nodes, n_cols, n_years) and all years
+       are accumulated in a single sweep over the shared network.
+
+    Args:
+        data:      Dict or raw str. Either a dict {year: data}, where 'data' is a dataframe
+                   or file path as accepted by run_model(), or a path template containing
+                   '{year}' e.g. r'../data/norway_annual_input_data/input_data_{year}.csv'
+        years:     List of int. Years of interest. Required if 'data' is a path template.
+                   Defaults to all keys in 'data' if 'data' is a dict
+        cache_dir: Str. Optional. Folder in which to cache the compiled regine networks.
+                   See get_network()
+        targets:   List of str. Optional. Regine IDs of interest. If supplied, only the
+                   catchments upstream of (and including) 'targets' are modelled and
+                   returned
+
+    Returns:
+        Dataframe in "long" format. Columns are 'year', 'regine', 'regine_ned' and the
+        'local_' and 'accum_' columns returned by model_to_dataframe().
+    """
+    # Parse input
+    if isinstance(data, dict):
+        if years is None:
+            years = sorted(data.keys())
+        data = {year: data[year] for year in years}
+    elif isinstance(data, str):
+        assert "{year}" in data, "Path template must contain '{year}'."
+        assert years is not None, "'years' must be specified for a path template."
+        data = {year: data.format(year=year) for year in years}
+    else:
+        raise ValueError('"data" must be either a dict or a "raw" string.')
+
+    # Read data and group years by network version
+    groups = {}
+    for year, year_data in data.items():
+        df = _parse_input(year_data)
+        acc_cols = _get_acc_cols(df)
+        net = get_network(df, cache_dir=cache_dir)
+        groups.setdefault(net.key, (net, []))[1].append((year, df, acc_cols))
+
+    # Accumulate each group
+    df_list = []
+    for net, group in groups.values():
+        if targets is not None:
+            net = net.prune(targets)
+        acc_cols = group[0][2]
+        for year, df, year_cols in group:
+            assert set(year_cols) == set(
+                acc_cols
+            ), f"Columns for {year} do not match those for {group[0][0]}."
+        arrays = [_get_local_arrays(df, net, acc_cols) for year, df, cols in group]
+        local = np.stack([arr[0] for arr in arrays], axis=2)
+        trans = np.stack([arr[1] for arr in arrays], axis=2)
+        del arrays
+        accum = accumulate_arrays(net, local, trans, inplace=True)
+        accum_cols = ["upstr_area_km2", "q_m3/s"] + acc_cols
+
+        for idx, (year, df, cols) in enumerate(group):
+            res_df = _build_result(df, net, accum_cols, accum[:, :, idx]).to_dataframe()
+            res_df.insert(0, "year", year)
+            df_list.append(res_df)
+
+    df = pd.concat(df_list, axis=0, ignore_index=True)
+    df.sort_values("year", kind="stable", inplace=True, ignore_index=True)
+
+    return df
+
+
+# Delivery coefficients already calculated in this session. See delivery_coefficients()
+_COEF_CACHE = OrderedDict()
+_COEF_CACHE_SIZE = 8
 
-    return g
+
+def delivery_coefficients(data, outlets, cache_dir=None):
+    """Calculate delivery coefficients for every (upstream regine, outlet) pair. The
+       coefficient for regine 'j' and outlet 'k' is the fraction of the local input to 'j'
+       that reaches (and leaves) 'k' i.e. the product of 'trans_{par}' for all regines on
+       the path from 'j' to 'k', inclusive. Coefficients are calculated for all outlets
+       with a single pass down the network per parameter, and depend only on the
+       transmission factors. Results are cached in memory, so calling this function again
+       with input data for another year having the same network and transmission factors
+       is fast. The returned dataframe is a copy, which can be modified without affecting
+       the cache, and can also be passed to attribute_loads() directly.
+
+    Args:
+        data:      Raw str or dataframe. Input data. See run_model() for details
+        outlets:   List of str. Regine IDs of interest e.g. RID stations or coastal regines
+        cache_dir: Str. Optional. Folder in which to cache the compiled regine network. See
+                   get_network()
+
+    Returns:
+        Dataframe with columns 'outlet', 'regine' and 'coef_{par}' for each parameter in
+        'data'. Only pairs where 'regine' is upstream of (or equal to) 'outlet' are included.
+    """
+    df = _parse_input(data)
+    acc_cols = _get_acc_cols(df)
+    net = get_network(df, cache_dir=cache_dir)
+    par_list = sorted(set(col.split("_")[-2] for col in acc_cols))
+    trans = df[["trans_%s" % par for par in par_list]].to_numpy(dtype=float)
+    trans = trans[net.align(df["regine"])]
+
+    # Check cache
+    outlets = list(dict.fromkeys(outlets))
+    key = (
+        net.key,
+        tuple(par_list),
+        tuple(outlets),
+        hashlib.sha1(np.ascontiguousarray(trans).tobytes()).hexdigest(),
+    )
+    if key in _COEF_CACHE:
+        _COEF_CACHE.move_to_end(key)
+        return _COEF_CACHE[key].copy()
+
+    out_rows = net.get_indexer(outlets)
+    assert (out_rows >= 0).all(), "Some outlets are not in the network."
+    is_outlet = np.zeros(len(net), dtype=bool)
+    is_outlet[out_rows] = True
+
+    # Products from each node to the nearest outlet downstream
+    coef, nearest = _downstream_products(net, trans, is_outlet)
+
+    # Group nodes by nearest outlet
+    has_out = np.flatnonzero(nearest >= 0)
+    has_out = has_out[np.argsort(nearest[has_out], kind="stable")]
+    grp_outs, grp_st = np.unique(nearest[has_out], return_index=True)
+    grp_end = np.append(grp_st[1:], len(has_out))
+    members = {out: has_out[st:end] for out, st, end in zip(grp_outs, grp_st, grp_end)}
+
+    # Nodes draining to outlet 'k' also drain to outlets further downstream. Follow the
+    # chain of outlets, multiplying by the products between them
+    out_list, reg_list, coef_list = [], [], []
+    for out in out_rows:
+        nds = members[out]
+        fac = np.ones(len(par_list))
+        nxt = out
+        while nxt >= 0:
+            out_list.append(np.full(len(nds), nxt))
+            reg_list.append(nds)
+            coef_list.append(coef[nds] * fac)
+            par = net.parent[nxt]
+            if par < 0:
+                break
+            fac = fac * coef[par]
+            nxt = nearest[par]
+
+    out_idx = np.concatenate(out_list)
+    reg_idx = np.concatenate(reg_list)
+    res_df = pd.DataFrame(
+        np.concatenate(coef_list), columns=["coef_%s" % par for par in par_list]
+    )
+    res_df.insert(0, "outlet", net.regine[out_idx])
+    res_df.insert(1, "regine", net.regine[reg_idx])
+    res_df.sort_values("outlet", kind="stable", inplace=True, ignore_index=True)
+
+    _COEF_CACHE[key] = res_df
+    if len(_COEF_CACHE) > _COEF_CACHE_SIZE:
+        _COEF_CACHE.popitem(last=False)
+
+    return res_df.copy()
+
+
+def attribute_loads(data, outlets=None, coeffs=None, cols=None, by_regine=True):
+    """Attribute accumulated loads at selected outlets to the upstream regines (and
+       sources) they come from. The contribution of regine 'j' to outlet 'k' is the local
+       input to 'j' multiplied by the delivery coefficient for ('j', 'k'). See
+       delivery_coefficients().
+
+    Args:
+        data:      Raw str or dataframe. Input data. See run_model() for details
+        outlets:   List of str. Regine IDs of interest. Ignored if 'coeffs' is supplied
+        coeffs:    Dataframe. Optional. Delivery coefficients returned by
+                   delivery_coefficients(), which can be re-used for all years with the
+                   same network and transmission factors
+        cols:      List of str. Optional. Accumulated columns to attribute e.g.
+                   ['ind_tot-p_tonnes', 'aqu_tot-p_tonnes']. Defaults to all
+        by_regine: Bool. Default True. If False, contributions are summed over all upstream
+                   regines to give the delivered load for each source at each outlet
+
+    Returns:
+        Dataframe with columns 'outlet', 'regine' (if 'by_regine' is True) and the
+        delivered load for each column in 'cols'.
+    """
+    df = _parse_input(data)
+    acc_cols = _get_acc_cols(df)
+    if cols is None:
+        cols = acc_cols
+    for col in cols:
+        assert col in acc_cols, f"'{col}' is not an accumulated column."
+    if coeffs is None:
+        assert outlets is not None, "Either 'outlets' or 'coeffs' must be supplied."
+        coeffs = delivery_coefficients(df, outlets)
+
+    # Get local inputs for each pair
+    rows = pd.Index(df["regine"]).get_indexer(coeffs["regine"])
+    assert (rows >= 0).all(), "'coeffs' contains regine IDs not in 'data'."
+    res_df = coeffs[["outlet", "regine"]].copy()
+    for col in cols:
+        res_df[col] = (
+            df[col].to_numpy(dtype=float)[rows]
+            * coeffs["coef_%s" % col.split("_")[-2]].to_numpy()
+        )
+
+    if not by_regine:
+        res_df = res_df.drop(columns="regine").groupby("outlet", sort=False).sum()
+        res_df.reset_index(inplace=True)
+
+    return res_df
+
+
+def delivery_ratios(data, cache_dir=None):
+    """Calculate the delivery ratio for every regine i.e. the fraction of a unit local
+       input that eventually reaches the sea. This is the product of 'trans_{par}' for all
+       regines on the path from the regine to the network outlet (inclusive), calculated
+       for all regines with a single pass down the network.
+
+    Args:
+        data:      Raw str or dataframe. Input data. See run_model() for details. Only
+                   'regine', 'regine_ned' and the 'trans_{par}' columns are used
+        cache_dir: Str. Optional. Folder in which to cache the compiled regine network. See
+                   get_network()
+
+    Returns:
+        Dataframe with columns 'regine' and 'deliv_{par}_frac' for each 'trans_{par}'
+        column in 'data'. Can be passed directly to make_map() e.g. with
+        quant='deliv_tot-p_frac'.
+    """
+    df = _parse_input(data)
+    par_list = [col[6:] for col in df.columns if col.split("_")[0] == "trans"]
+    for par in par_list:
+        assert (
+            df[f"trans_{par}"].between(0, 1, inclusive="both").all()
+        ), f"Column 'trans_{par}' contains values outside of range [0, 1]"
+    net = get_network(df, cache_dir=cache_dir)
+    trans = df[["trans_%s" % par for par in par_list]].to_numpy(dtype=float)
+    trans = trans[net.align(df["regine"])]
+
+    prod = _downstream_products(net, trans)[0]
+
+    res_df = pd.DataFrame(prod, columns=["deliv_%s_frac" % par for par in par_list])
+    res_df.insert(0, "regine", net.regine)
+
+    return res_df
+
+
+def _downstream_products(net, trans, is_outlet=None):
+    """Calculate products of 'trans' along the path from each node down to the nearest
+       outlet, working from the network outlet upstream. If 'is_outlet' is None, products
+       are calculated to the network outlet (i.e. the sea).
+
+    Args:
+        net:       Network object
+        trans:     Array with shape (n_nodes, ...). Transmission factors in network order
+        is_outlet: Array of bool. Optional. Nodes at which the products should stop
+
+    Returns:
+        Tuple (prod, nearest). 'prod' has the same shape as 'trans'. 'nearest' is the
+        position of the nearest outlet downstream of each node (-1 if none), or None if
+        'is_outlet' is None.
+    """
+    prod = np.empty_like(trans, dtype=float)
+    nearest = None if is_outlet is None else np.full(len(net), -1)
+
+    # Parents are always in higher levels
+    for lev in reversed(range(net.n_levels)):
+        st, end = net.level_ptr[lev], net.level_ptr[lev + 1]
+        par = net.parent[st:end]
+        has_par = par >= 0
+        par_prod = np.ones_like(prod[st:end])
+        par_prod[has_par] = prod[par[has_par]]
+        if is_outlet is not None:
+            out = is_outlet[st:end]
+            par_prod[out] = 1
+            near = np.where(has_par, nearest[np.maximum(par, 0)], -1)
+            near[out] = np.arange(st, end)[out]
+            nearest[st:end] = near
+        prod[st:end] = trans[st:end] * par_prod
+
+    return prod, nearest
+
+
+def _node_values(net, value):
+    """Convert a scalar or a Series indexed by regine ID into (rows, values) for indexing
+    arrays in network order.
+    """
+    if isinstance(value, pd.Series):
+        assert value.index.is_unique, "Scenario Series must have a unique regine index."
+        rows = net.get_indexer(value.index)
+        assert (
+            rows >= 0
+        ).all(), "Scenario Series contains regine IDs not in the network."
+        return rows, value.to_numpy(dtype=float)
+
+    return slice(None), float(value)
 
 
 def accumulate_loads(g, acc_cols):
@@ -160,7 +1425,7 @@ def plot_network(g, catch_id, direct="down", stat="accum", quant="upstr_area_km2
     """Create schematic diagram upstream or downstream of specified node.
 
     Args:
-        g         NetworkX graph object returned by teo.run_model()
+        g         NetworkX graph object or ModelResult returned by teo.run_model()
         catch_id: Str. Regine ID of interest
         direct:   Str. 'up' or 'down'. Direction to trace network
         stat:     Str. 'local' or 'accum'. Type of results to display
@@ -169,26 +1434,35 @@ def plot_network(g, catch_id, direct="down", stat="accum", quant="upstr_area_km2
     Returns:
         NetworkX graph. Can be displayed using draw(g2, show='ipynb')
     """
+    net = _graph_network(g)
+
     # Parse direction
     if direct == "down":
-        # Get sub-tree
-        g2 = nx.dfs_tree(g, catch_id)
-
-        # Update labels with 'quant'
-        for nd in list(nx.topological_sort(g2))[:-1]:
-            g2.nodes[nd]["label"] = "%s\n(%.2f)" % (nd, g.nodes[nd][stat][quant])
+        # Get path to the outlet
+        nds = net.downstream_path(catch_id)
 
     elif direct == "up":
         # Get sub-tree
-        g2 = nx.dfs_tree(g.reverse(), catch_id).reverse()
-
-        # Update labels with 'quant'
-        for nd in list(nx.topological_sort(g2)):
-            g2.nodes[nd]["label"] = "%s\n(%.2f)" % (nd, g.nodes[nd][stat][quant])
+        nds = net.upstream_nodes(catch_id)
 
     else:
         raise ValueError('"direct" must be "up" or "down".')
 
+    # Build sub-tree. Links from 'catch_id' are only included when tracing downstream
+    links = nds if direct == "down" else nds[net.regine[nds] != catch_id]
+    g2 = nx.DiGraph()
+    g2.add_nodes_from(net.regine[nds])
+    g2.add_edges_from(zip(net.regine[links], net.regine_ned[links]))
+
+    # Update labels with 'quant'
+    res = _get_result(g)
+    if res is not None:
+        vals = res["%s_%s" % (stat, quant)][nds]
+    else:
+        vals = [g.nodes[nd][stat][quant] for nd in net.regine[nds]]
+    for nd, val in zip(net.regine[nds], vals):
+        g2.nodes[nd]["label"] = "%s\n(%.2f)" % (nd, val)
+
     # Draw
     res = nx.nx_agraph.to_agraph(g2)
     res.layout("dot")
@@ -196,6 +1470,25 @@ def plot_network(g, catch_id, direct="down", stat="accum", quant="upstr_area_km2
     return graphviz.Source(res.to_string())
 
 
+def _graph_network(g):
+    """Get the compiled network for a graph or ModelResult returned by run_model()."""
+    if isinstance(g, ModelResult):
+        return g.network
+    if "network" in g.graph:
+        return g.graph["network"]
+
+    df = pd.DataFrame(list(g.edges), columns=["regine", "regine_ned"])
+
+    return get_network(df)
+
+
+def _get_result(g):
+    """'g' if it is a ModelResult, or None if it is a graph. Results in graphs are read
+    from the node attribute dicts, which may have been modified since run_model().
+    """
+    return g if isinstance(g, ModelResult) else None
+
+
 def make_map(
     g,
     core_fold,
@@ -212,10 +1505,13 @@ def make_map(
     to the quantity specified.
 
     Args:
-        g          NetworkX graph object returned by teo.run_model()
+        g          NetworkX graph object or ModelResult returned by teo.run_model().
+                   Alternatively, a dataframe with a 'regine' column e.g. as returned by model_to_dataframe()
+                   or delivery_ratios()
         core_fold: Str. Path to folder containing core TEOTIL2 data files
         stat:      Str. 'local' or 'accum'. Type of results to display
-        quant:     Str. Any of the returned result types
+        quant:     Str. Any of the returned result types. If 'g' is a dataframe, either
+                   '{stat}_{quant}' or 'quant' must be a column in 'g'
         trans:     Str. One of ['none', 'log', 'sqrt']. Whether to transform 'quant'
                    before plotting
         cmap:      Str. Valid matplotlib colourmap
@@ -229,13 +1525,29 @@ def make_map(
     Returns:
         None
     """
-    # Extract data of interest from graph
-    reg_list = []
-    par_list = []
+    if isinstance(g, pd.DataFrame):
+        # Extract data of interest from df
+        col = f"{stat}_{quant}" if f"{stat}_{quant}" in g.columns else quant
+        reg_list = g["regine"].to_numpy()
+        par_list = g[col].to_numpy()
 
-    for nd in list(nx.topological_sort(g))[:-1]:
-        reg_list.append(g.nodes[nd]["local"]["regine"])
-        par_list.append(g.nodes[nd][stat][quant])
+    elif _get_result(g) is not None:
+        # Extract data of interest from columnar results
+        res = _get_result(g)
+        reg_list = res.regine
+        par_list = res[f"{stat}_{quant}"]
+
+    else:
+        # Extract data of interest from graph
+        reg_list = []
+        par_list = []
+
+        for nd in list(nx.topological_sort(g)):
+            # Outlet nodes have no data
+            if "local" not in g.nodes[nd]:
+                continue
+            reg_list.append(g.nodes[nd]["local"]["regine"])
+            par_list.append(g.nodes[nd][stat][quant])
 
     # Build df
     df = pd.DataFrame(data={quant: par_list, "VASSDRAGNR": reg_list})
@@ -282,38 +1594,45 @@ def make_map(
 
 
 def model_to_dataframe(g, out_path=None):
-    """Convert a TEOTIL2 graph to a Pandas dataframe. If a path is supplied, the dataframe
+    """Convert TEOTIL2 results to a Pandas dataframe. If a path is supplied, the dataframe
        will be written to CSV format.
 
     Args:
-        g          NetworkX graph object returned by teo.run_model()
+        g          NetworkX graph object or ModelResult returned by teo.run_model()
         plot_path: Raw Str. Optional. CSV path to which df will
                    be saved
 
     Returns:
         Dataframe
     """
+    res = _get_result(g)
+    if res is not None:
+        # Wrap the columnar results directly
+        df = res.to_dataframe()
 
-    # Container for data
-    out_dict = defaultdict(list)
+    else:
+        # Container for data
+        out_dict = defaultdict(list)
 
-    # Loop over data
-    for nd in list(nx.topological_sort(g))[:-1]:
-        for stat in ["local", "accum"]:
-            for key in g.nodes[nd][stat]:
-                out_dict["%s_%s" % (stat, key)].append(g.nodes[nd][stat][key])
-
-    # Convert to df
-    df = pd.DataFrame(out_dict)
-
-    # Reorder cols
-    key_cols = ["local_regine", "local_regine_ned"]
-    cols = [i for i in df.columns if not i in key_cols]
-    cols.sort()
-    df = df[key_cols + cols]
-    cols = list(df.columns)
-    cols[:2] = ["regine", "regine_ned"]
-    df.columns = cols
+        # Loop over data. Outlet nodes have no data
+        for nd in list(nx.topological_sort(g)):
+            if "local" not in g.nodes[nd]:
+                continue
+            for stat in ["local", "accum"]:
+                for key in g.nodes[nd][stat]:
+                    out_dict["%s_%s" % (stat, key)].append(g.nodes[nd][stat][key])
+
+        # Convert to df
+        df = pd.DataFrame(out_dict)
+
+        # Reorder cols
+        key_cols = ["local_regine", "local_regine_ned"]
+        cols = [i for i in df.columns if not i in key_cols]
+        cols.sort()
+        df = df[key_cols + cols]
+        cols = list(df.columns)
+        cols[:2] = ["regine", "regine_ned"]
+        df.columns = cols
 
     # Write output
     if out_path:
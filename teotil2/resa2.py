@@ -0,0 +1,580 @@
+import datetime as dt
+import glob
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from . import io
+
+# Tables used by the queries in teotil2.io, with the columns and SQLite types served by
+# the local stand-in for RESA2. See connect()
+RESA2_TABLES = {
+    "rid_punktkilder_outpar_def": {
+        "out_pid": "INTEGER",
+        "name": "TEXT",
+        "unit": "TEXT",
+    },
+    "rid_punktkilder_inp_outp": {
+        "in_pid": "INTEGER",
+        "out_pid": "INTEGER",
+        "factor": "REAL",
+    },
+    "rid_kilder_spredt_values": {
+        "komm_no": "INTEGER",
+        "inp_par_id": "INTEGER",
+        "ar": "INTEGER",
+        "value": "REAL",
+    },
+    "rid_kilder_aquakultur": {"nr": "INTEGER", "regine": "TEXT"},
+    "rid_kilder_aqkult_values": {
+        "anlegg_nr": "INTEGER",
+        "inp_par_id": "INTEGER",
+        "ar": "INTEGER",
+        "value": "REAL",
+    },
+    "rid_punktkilder": {"anlegg_nr": "INTEGER", "type": "TEXT", "regine": "TEXT"},
+    "rid_punktkilder_inpar_values": {
+        "anlegg_nr": "INTEGER",
+        "inp_par_id": "INTEGER",
+        "year": "INTEGER",
+        "value": "REAL",
+    },
+    "discharge_stations": {
+        "dis_station_id": "INTEGER",
+        "dis_station_name": "TEXT",
+        "nve_serienummer": "TEXT",
+    },
+    "discharge_values": {
+        "dis_station_id": "INTEGER",
+        "xdate": "TEXT",
+        "xvalue": "REAL",
+    },
+    "rid_agri_inputs": {
+        "omrade": "TEXT",
+        "year": "INTEGER",
+        "n_diff_kg": "REAL",
+        "n_point_kg": "REAL",
+        "n_back_kg": "REAL",
+        "p_diff_kg": "REAL",
+        "p_point_kg": "REAL",
+        "p_back_kg": "REAL",
+    },
+}
+
+# Indexes matching the filters used by the queries in teotil2.io
+RESA2_INDEXES = {
+    "rid_kilder_spredt_values": ["ar"],
+    "rid_kilder_aqkult_values": ["ar"],
+    "rid_punktkilder_inpar_values": ["year"],
+    "discharge_values": ["dis_station_id", "xdate"],
+    "rid_agri_inputs": ["year"],
+}
+
+# Output parameters and units in RID_PUNKTKILDER_OUTPAR_DEF. Input parameters are
+# reported in kg (or g for Hg) and converted to tonnes using RID_PUNKTKILDER_INP_OUTP
+_OUT_PARS = [
+    ("Tot-N", "tonn", 1e-3),
+    ("Tot-P", "tonn", 1e-3),
+    ("As", "tonn", 1e-3),
+    ("Cd", "tonn", 1e-3),
+    ("Cr", "tonn", 1e-3),
+    ("Cu", "tonn", 1e-3),
+    ("Hg", "tonn", 1e-6),
+    ("Ni", "tonn", 1e-3),
+    ("Pb", "tonn", 1e-3),
+    ("Zn", "tonn", 1e-3),
+]
+
+# Median annual loads (kg) per site for each source and output parameter, used by
+# make_synthetic_data(). Log-normally distributed between sites
+_MEDIAN_LOADS_KG = {
+    "spr": {"Tot-N": 5000, "Tot-P": 800},
+    "aqu": {"Tot-N": 40000, "Tot-P": 6000},
+    "RENSEANLEGG": {
+        "Tot-N": 2000,
+        "Tot-P": 150,
+        "As": 0.2,
+        "Cd": 0.02,
+        "Cr": 0.5,
+        "Cu": 5,
+        "Hg": 0.5,
+        "Ni": 1,
+        "Pb": 0.5,
+        "Zn": 15,
+    },
+    "INDUSTRI": {
+        "Tot-N": 1000,
+        "Tot-P": 50,
+        "As": 1,
+        "Cd": 0.1,
+        "Cr": 2,
+        "Cu": 10,
+        "Hg": 2,
+        "Ni": 10,
+        "Pb": 2,
+        "Zn": 50,
+    },
+}
+
+
+def make_synthetic_data(
+    core_fold,
+    st_yr=1990,
+    end_yr=2022,
+    n_aqu=1200,
+    n_ren=2600,
+    n_ind=700,
+    q_freq="D",
+    seed=1,
+):
+    """Generate synthetic versions of the RESA2 tables used by teotil2.io, with
+       realistic volumes and values. Sites and stations are linked to the regines,
+       kommuner, vassdragsområder and fylke-soner in the core TEOTIL2 data, so that the
+       synthetic tables can be used to build complete input files.
+
+    Args:
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        st_yr:     Int. Default 1990. First year to generate
+        end_yr:    Int. Default 2022. Last year to generate
+        n_aqu:     Int. Default 1200. Number of aquaculture sites
+        n_ren:     Int. Default 2600. Number of renseanlegg
+        n_ind:     Int. Default 700. Number of industrial sites
+        q_freq:    Str. Default 'D'. Frequency of discharge values. Any pandas
+                   frequency string. Daily values for 1990 to 2022 give about 3.2
+                   million rows in DISCHARGE_VALUES
+        seed:      Int. Default 1. Seed for the random number generator
+
+    Returns:
+        Dict of dataframes {table_name: df}. See RESA2_TABLES.
+    """
+    rng = np.random.default_rng(seed)
+    years = np.arange(st_yr, end_yr + 1)
+    tables = {}
+
+    reg_df = io.read_core_data(core_fold, "regine", year=end_yr)
+    regines = reg_df.index.values
+
+    # Parameters. Input parameter IDs are offset from the output IDs, as in RESA2
+    pars = [par for par, unit, factor in _OUT_PARS]
+    tables["rid_punktkilder_outpar_def"] = pd.DataFrame(
+        {
+            "out_pid": np.arange(len(_OUT_PARS)) + 1,
+            "name": pars,
+            "unit": [unit for par, unit, factor in _OUT_PARS],
+        }
+    )
+    tables["rid_punktkilder_inp_outp"] = pd.DataFrame(
+        {
+            "in_pid": np.arange(len(_OUT_PARS)) + 101,
+            "out_pid": np.arange(len(_OUT_PARS)) + 1,
+            "factor": [factor for par, unit, factor in _OUT_PARS],
+        }
+    )
+    in_pids = dict(zip(pars, tables["rid_punktkilder_inp_outp"]["in_pid"]))
+
+    # Spredt. One value per kommune, year and parameter. Kommuner change over time
+    df_list = []
+    for year in years:
+        kom_df = io.read_core_data(core_fold, "regine", year=year)
+        komnrs = np.unique(kom_df["komnr"])
+        df_list.append(
+            _synthetic_loads(rng, komnrs, year, _MEDIAN_LOADS_KG["spr"], in_pids)
+        )
+    tables["rid_kilder_spredt_values"] = pd.concat(df_list, ignore_index=True).rename(
+        columns={"site": "komm_no", "year": "ar"}
+    )
+
+    # Aquaculture. About 80% of sites are active in any year
+    tables["rid_kilder_aquakultur"] = pd.DataFrame(
+        {"nr": np.arange(n_aqu) + 1, "regine": rng.choice(regines, n_aqu)}
+    )
+    df_list = [
+        _synthetic_loads(
+            rng,
+            rng.choice(n_aqu, int(0.8 * n_aqu), replace=False) + 1,
+            year,
+            _MEDIAN_LOADS_KG["aqu"],
+            in_pids,
+        )
+        for year in years
+    ]
+    tables["rid_kilder_aqkult_values"] = pd.concat(df_list, ignore_index=True).rename(
+        columns={"site": "anlegg_nr", "year": "ar"}
+    )
+
+    # Renseanlegg and industry. All sites report N and P every year; about a third also
+    # report metals
+    n_pt = n_ren + n_ind
+    tables["rid_punktkilder"] = pd.DataFrame(
+        {
+            "anlegg_nr": np.arange(n_pt) + 1,
+            "type": ["RENSEANLEGG"] * n_ren + ["INDUSTRI"] * n_ind,
+            "regine": rng.choice(regines, n_pt),
+        }
+    )
+    df_list = []
+    for typ, first, n_sites in [
+        ("RENSEANLEGG", 1, n_ren),
+        ("INDUSTRI", n_ren + 1, n_ind),
+    ]:
+        sites = np.arange(first, first + n_sites)
+        nut_loads = {par: _MEDIAN_LOADS_KG[typ][par] for par in ["Tot-N", "Tot-P"]}
+        met_loads = {
+            par: load
+            for par, load in _MEDIAN_LOADS_KG[typ].items()
+            if par not in nut_loads
+        }
+        met_sites = sites[rng.random(n_sites) < 1 / 3]
+        for year in years:
+            df_list.append(_synthetic_loads(rng, sites, year, nut_loads, in_pids))
+            df_list.append(_synthetic_loads(rng, met_sites, year, met_loads, in_pids))
+    tables["rid_punktkilder_inpar_values"] = pd.concat(
+        df_list, ignore_index=True
+    ).rename(columns={"site": "anlegg_nr"})
+
+    # Discharge. One modelled NVE station per vassdragsområde, plus some observed
+    # stations that are not used by TEOTIL2. Flows vary around the long-term average
+    # for each vassom, with year-to-year variability and a seasonal cycle
+    lta = reg_df.groupby("vassom")["q_reg_m3/s"].sum()
+    n_vass, n_other = len(lta), 50
+    tables["discharge_stations"] = pd.DataFrame(
+        {
+            "dis_station_id": np.arange(n_vass + n_other) + 1,
+            "dis_station_name": [f"NVE Modellert {vass}" for vass in lta.index]
+            + [f"NVE Observert {i}" for i in range(n_other)],
+            "nve_serienummer": [str(vass) for vass in lta.index]
+            + [f"{i}.{i}.0" for i in range(n_other)],
+        }
+    )
+    dates = pd.date_range(f"{st_yr}-01-01", f"{end_yr}-12-31", freq=q_freq)
+    ann_fac = rng.lognormal(0, 0.15, size=(len(years), n_vass + n_other))
+    season = 1 + 0.6 * np.sin(2 * np.pi * (dates.dayofyear.values - 60) / 365)
+    noise = rng.lognormal(0, 0.3, size=(len(dates), n_vass + n_other))
+    q_mean = np.concatenate([lta.values, rng.lognormal(3, 1, n_other)])
+    xvalue = (
+        q_mean[None, :]
+        * ann_fac[dates.year.values - st_yr]
+        * season[:, None]
+        * noise
+        / np.exp(0.3**2 / 2)
+    )
+    tables["discharge_values"] = pd.DataFrame(
+        {
+            "dis_station_id": np.tile(
+                tables["discharge_stations"]["dis_station_id"].values, len(dates)
+            ),
+            "xdate": np.repeat(
+                dates.strftime("%Y-%m-%d %H:%M:%S").values, n_vass + n_other
+            ),
+            "xvalue": xvalue.ravel(),
+        }
+    )
+
+    # Agriculture. Loads per fylke-sone scale with agricultural area
+    fy_df = io.read_core_data(core_fold, "fysone_land_areas")
+    coeffs = {
+        "n_diff_kg": 1500,
+        "n_point_kg": 50,
+        "n_back_kg": 300,
+        "p_diff_kg": 80,
+        "p_point_kg": 10,
+        "p_back_kg": 10,
+    }
+    agri_df = pd.DataFrame(
+        {
+            "omrade": np.tile(fy_df["omrade"].values, len(years)),
+            "year": np.repeat(years, len(fy_df)),
+        }
+    )
+    area = np.tile(fy_df["a_fy_agri_km2"].values, len(years))
+    for col, coeff in coeffs.items():
+        agri_df[col] = area * coeff * rng.lognormal(0, 0.2, len(agri_df))
+    tables["rid_agri_inputs"] = agri_df
+
+    return tables
+
+
+def _synthetic_loads(rng, sites, year, median_loads, in_pids):
+    """Log-normally distributed annual loads for each site and parameter. See
+    make_synthetic_data().
+    """
+    return pd.DataFrame(
+        {
+            "site": np.tile(sites, len(median_loads)),
+            "inp_par_id": np.repeat([in_pids[par] for par in median_loads], len(sites)),
+            "year": year,
+            "value": np.repeat(list(median_loads.values()), len(sites))
+            * rng.lognormal(0, 1, len(sites) * len(median_loads)),
+        }
+    )
+
+
+def save_tables(tables, path):
+    """Save RESA2 tables, e.g. from make_synthetic_data(), for use with connect().
+
+    Args:
+        tables: Dict of dataframes {table_name: df}. See RESA2_TABLES
+        path:   Str. Either a SQLite database file ending '.db' or '.sqlite', which is
+                overwritten, or a folder in which to save one Parquet file per table.
+                Parquet requires pyarrow
+
+    Returns:
+        None. Tables are saved to 'path'.
+    """
+    for name, df in tables.items():
+        assert name in RESA2_TABLES, f"'{name}' is not a recognised RESA2 table."
+        assert list(df.columns) == list(
+            RESA2_TABLES[name].keys()
+        ), f"Columns of '{name}' do not match RESA2_TABLES."
+
+    if _is_sqlite_path(path):
+        if os.path.isfile(path):
+            os.remove(path)
+        con = sqlite3.connect(path)
+        try:
+            for name, df in tables.items():
+                _create_table(con, name, df)
+            con.commit()
+        finally:
+            con.close()
+
+    else:
+        os.makedirs(path, exist_ok=True)
+        for name, df in tables.items():
+            df.to_parquet(os.path.join(path, f"{name}.parquet"), index=False)
+
+
+def _is_sqlite_path(path):
+    """Whether 'path' refers to a SQLite database rather than a Parquet folder."""
+    return os.path.splitext(path)[1].lower() in (".db", ".sqlite")
+
+
+def _create_table(con, name, df):
+    """Create table 'name' from 'df' using the types in RESA2_TABLES, plus indexes."""
+    cols = ", ".join(f"{col} {typ}" for col, typ in RESA2_TABLES[name].items())
+    con.execute(f"CREATE TABLE {name} ({cols})")
+    con.executemany(
+        f"INSERT INTO {name} VALUES ({', '.join(['?'] * len(df.columns))})",
+        df.itertuples(index=False, name=None),
+    )
+    if name in RESA2_INDEXES:
+        cols = ", ".join(RESA2_INDEXES[name])
+        con.execute(f"CREATE INDEX idx_{name} ON {name} ({cols})")
+
+
+def connect(path):
+    """Connect to a local stand-in for RESA2, saved using save_tables(). The result can
+       be passed as 'engine' to the functions in teotil2.io, in place of a connection to
+       the Oracle database.
+
+    Args:
+        path: Str. SQLite database file or folder of Parquet files. Parquet files are
+              loaded into an in-memory SQLite database
+
+    Returns:
+        LocalRESA2 object.
+    """
+    if _is_sqlite_path(path):
+        assert os.path.isfile(path), f"'{path}' does not exist."
+
+        return LocalRESA2(path)
+
+    # Load Parquet files into a shared in-memory database. This stays open for as long
+    # as the returned object
+    uri = f"file:resa2_{id(path)}_{time.time_ns()}?mode=memory&cache=shared"
+    keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    for pq_path in sorted(glob.glob(os.path.join(path, "*.parquet"))):
+        name = os.path.splitext(os.path.basename(pq_path))[0]
+        if name in RESA2_TABLES:
+            _create_table(keeper, name, pd.read_parquet(pq_path))
+    keeper.commit()
+    con = LocalRESA2(uri)
+    con._keeper = keeper
+
+    return con
+
+
+class LocalRESA2(sqlite3.Connection):
+    """SQLite stand-in for a connection to RESA2. Tables are available in the 'resa2'
+    schema, and the Oracle functions TO_CHAR, TO_DATE and TO_NUMBER are emulated for
+    the formats used in teotil2.io. As with Oracle via SQL-Alchemy, column names are
+    returned in lower case. Each thread gets its own underlying connection, so the
+    object can be shared by the thread pool in teotil2.io like a pooled SQL-Alchemy
+    engine.
+    """
+
+    def __init__(self, db_path):
+        super().__init__(":memory:", check_same_thread=False)
+        self.db_path = db_path
+        self._local = threading.local()
+        self._cons = []
+        self._keeper = None
+
+    def _get_con(self):
+        """Connection for the current thread."""
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(":memory:", uri=True, check_same_thread=False)
+            con.execute("ATTACH DATABASE ? AS resa2", (self.db_path,))
+            con.create_function("TO_CHAR", 2, _to_char, deterministic=True)
+            con.create_function("TO_DATE", 2, _to_date, deterministic=True)
+            con.create_function("TO_NUMBER", 1, _to_number, deterministic=True)
+            self._local.con = con
+            self._cons.append(con)
+
+        return con
+
+    def cursor(self, factory=None):
+        return self._get_con().cursor(_LowerCaseCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def commit(self):
+        self._get_con().commit()
+
+    def rollback(self):
+        self._get_con().rollback()
+
+    def close(self):
+        for con in self._cons:
+            con.close()
+        self._cons = []
+        if self._keeper is not None:
+            self._keeper.close()
+        super().close()
+
+
+class _LowerCaseCursor(sqlite3.Cursor):
+    """Cursor returning lower case column names. See LocalRESA2."""
+
+    @property
+    def description(self):
+        desc = super().description
+        if desc is None:
+            return None
+
+        return tuple((col[0].lower(),) + tuple(col[1:]) for col in desc)
+
+
+# Oracle date format elements supported by _to_char() and _to_date()
+_DATE_FORMATS = {
+    "YYYY": "%Y",
+    "MM": "%m",
+    "DD": "%d",
+    "HH24": "%H",
+    "MI": "%M",
+    "SS": "%S",
+}
+
+
+def _oracle_to_strftime(fmt):
+    """Convert an Oracle date format e.g. 'YYYY-MM-DD' to a strftime format."""
+    for ora, py in _DATE_FORMATS.items():
+        fmt = fmt.replace(ora, py)
+
+    return fmt
+
+
+def _to_char(value, fmt):
+    """SQLite version of Oracle's TO_CHAR for dates stored as ISO strings."""
+    if value is None:
+        return None
+    date = dt.datetime.fromisoformat(value)
+
+    return date.strftime(_oracle_to_strftime(fmt))
+
+
+def _to_date(value, fmt):
+    """SQLite version of Oracle's TO_DATE. Returns an ISO string for comparison with
+    dates stored as ISO strings.
+    """
+    if value is None:
+        return None
+    date = dt.datetime.strptime(value, _oracle_to_strftime(fmt))
+
+    return date.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _to_number(value):
+    """SQLite version of Oracle's TO_NUMBER."""
+    if value is None:
+        return None
+    number = float(value)
+
+    return int(number) if number.is_integer() else number
+
+
+def benchmark_input_files(
+    engine,
+    core_fold,
+    years,
+    mode="nutrients",
+    par_list=["Tot-N", "Tot-P"],
+    n_repeats=3,
+    n_workers=1,
+    out_csv=None,
+):
+    """Time building input files with io.make_input_file() (one year at a time) and
+       io.make_input_files() (all years together). Both methods write one CSV per year
+       to a temporary folder, as in normal use. Intended for use with connect(), so
+       that the performance of the input pipeline can be tracked over time.
+
+    Args:
+        engine:    Connection to RESA2 or a local stand-in from connect()
+        core_fold: Str. Path to folder containing core TEOTIL2 data files
+        years:     List of int. Years of interest
+        mode:      Str. One of ['nutrients', 'metals']. See io.make_input_file()
+        par_list:  List. Parameters of interest. See io.make_input_file()
+        n_repeats: Int. Default 3. Number of times to repeat each method
+        n_workers: Int. Default 1. Passed to io.make_input_files()
+        out_csv:   Str. Optional. CSV file to which the timings are appended
+
+    Returns:
+        Dataframe of timings in seconds, with one row per method and repeat.
+    """
+    timestamp = dt.datetime.now().isoformat(timespec="seconds")
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_fold:
+        csv_path = os.path.join(tmp_fold, "input_data_{year}.csv")
+        for repeat in range(n_repeats):
+            start = time.perf_counter()
+            for year in years:
+                io.make_input_file(
+                    year,
+                    engine,
+                    core_fold,
+                    csv_path.format(year=year),
+                    mode=mode,
+                    par_list=par_list,
+                )
+            rows.append(("make_input_file", repeat, time.perf_counter() - start))
+
+            start = time.perf_counter()
+            io.make_input_files(
+                years,
+                engine,
+                core_fold,
+                out_csv=csv_path,
+                mode=mode,
+                par_list=par_list,
+                n_workers=n_workers,
+            )
+            rows.append(("make_input_files", repeat, time.perf_counter() - start))
+
+    df = pd.DataFrame(rows, columns=["method", "repeat", "seconds"])
+    df.insert(0, "timestamp", timestamp)
+    df.insert(1, "mode", mode)
+    df.insert(2, "st_yr", min(years))
+    df.insert(3, "end_yr", max(years))
+    df.insert(4, "n_years", len(years))
+
+    if out_csv:
+        df.to_csv(out_csv, mode="a", header=not os.path.isfile(out_csv), index=False)
+
+    return df
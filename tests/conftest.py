@@ -0,0 +1,100 @@
+import os
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from teotil2 import io, model, resa2
+
+CORE_FOLD = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data",
+    "core_input_data",
+)
+YEARS = [2015, 2016]
+
+
+def baseline_run_model(df):
+    """Reference implementation of run_model(), building a NetworkX graph row by row and
+    accumulating with accumulate_loads(), as in the original version of TEOTIL2.
+    """
+    acc_cols = [
+        i
+        for i in df.columns
+        if (i not in model.REQ_COLS) and (i.split("_")[0] != "trans")
+    ]
+    g = nx.DiGraph()
+    for idx, row in df.iterrows():
+        g.add_node(row["regine"], local=row.to_dict(), accum={})
+    for idx, row in df.iterrows():
+        g.add_edge(row["regine"], row["regine_ned"])
+
+    return model.accumulate_loads(g, acc_cols)
+
+
+def baseline_results(df):
+    """Results of baseline_run_model() as a dataframe sorted by regine."""
+    res_df = model.model_to_dataframe(baseline_run_model(df))
+
+    return sort_results(res_df)
+
+
+def sort_results(df, by=("regine",)):
+    """Sort model results so that they can be compared."""
+    return df.sort_values(list(by), ignore_index=True)
+
+
+@pytest.fixture(scope="session")
+def core_fold():
+    return CORE_FOLD
+
+
+@pytest.fixture(scope="session")
+def resa2_db(tmp_path_factory):
+    """Path to a small synthetic RESA2 database for YEARS."""
+    tables = resa2.make_synthetic_data(
+        CORE_FOLD, YEARS[0], YEARS[-1], n_aqu=100, n_ren=200, n_ind=50
+    )
+    path = str(tmp_path_factory.mktemp("resa2") / "resa2.db")
+    resa2.save_tables(tables, path)
+
+    return path
+
+
+@pytest.fixture(scope="session")
+def engine(resa2_db):
+    eng = resa2.connect(resa2_db)
+    yield eng
+    eng.close()
+
+
+@pytest.fixture(scope="session")
+def input_dfs(engine):
+    """Nutrient model inputs for each year in YEARS, built from the synthetic data."""
+    return {year: io.make_input_file(year, engine, CORE_FOLD, None) for year in YEARS}
+
+
+@pytest.fixture(scope="session")
+def input_df(input_dfs):
+    return input_dfs[YEARS[-1]]
+
+
+@pytest.fixture(scope="session")
+def base_res(input_df):
+    """Baseline results for 'input_df'."""
+    return baseline_results(input_df)
+
+
+@pytest.fixture(scope="session")
+def rng():
+    return np.random.default_rng(42)
+
+
+@pytest.fixture(scope="session")
+def stations(input_df):
+    """A few regines with large upstream areas, to use as monitoring stations."""
+    res_df = model.model_to_dataframe(model.run_model(input_df, as_graph=False))
+    res_df = res_df[res_df["regine_ned"].isin(res_df["regine"])]
+    res_df = res_df.sort_values("accum_upstr_area_km2", ascending=False)
+
+    return list(res_df["regine"].iloc[[0, 5, 10, 50, 100, 500]])
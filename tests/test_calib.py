@@ -0,0 +1,352 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from teotil2 import calib
+
+from .conftest import YEARS
+
+PAR_LIST = ["tot-n", "tot-p"]
+
+
+@pytest.fixture(scope="module")
+def calib_net(input_df, stations):
+    return calib.build_calib_network(input_df, set(stations))
+
+
+@pytest.fixture(scope="module")
+def in_data(calib_net, rng):
+    """Dict of random calibration inputs {(regine, year): {field: value}}, in the format
+    originally returned by build_input_dict().
+    """
+    g, nd_list = calib_net
+    fields = calib._input_fields(PAR_LIST)
+    in_data = {}
+    for nd in nd_list:
+        for year in YEARS:
+            vals = rng.uniform(0, 10, len(fields))
+            vals[1 : len(PAR_LIST) + 1] = rng.uniform(0.5, 1, len(PAR_LIST))
+            in_data[(nd, year)] = dict(zip(fields, vals))
+
+    return in_data
+
+
+@pytest.fixture(scope="module")
+def cal_pars():
+    return {
+        "b_r_tot-n": 0.9,
+        "b_p_tot-n": 1.2,
+        "b_d_tot-n": 0.8,
+        "b_r_tot-p": 1.1,
+        "b_p_tot-p": 0.7,
+        "b_d_tot-p": 1.3,
+    }
+
+
+def fail_read(*args, **kwargs):
+    raise AssertionError("Data should be read from the cache.")
+
+
+def baseline_multi_year(calib_net, in_data, stations, cal_pars):
+    """Results from the original, loop-based calibration model."""
+    g, nd_list = calib_net
+    res_df = calib.run_model_multi_year(
+        g, nd_list, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations, cal_pars
+    )
+
+    return res_df.reset_index(drop=True)
+
+
+@pytest.mark.parametrize("cache", [None, calib.CalibCache()])
+def test_calib_model_matches_baseline(calib_net, in_data, stations, cal_pars, cache):
+    g, nd_list = calib_net
+    cm = calib.CalibModel(
+        g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations, cache=cache
+    )
+    for pars in [cal_pars, None]:
+        base_df = baseline_multi_year(calib_net, in_data, stations, pars)
+        pd.testing.assert_frame_equal(
+            cm.run(pars), base_df, check_dtype=False, check_exact=False, rtol=1e-10
+        )
+
+
+def test_fit_source_factors(calib_net, in_data, stations, cal_pars):
+    g, nd_list = calib_net
+    cm = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations)
+    obs_df = cm.run(cal_pars)
+    b_r_pars = {key: val for key, val in cal_pars.items() if key.startswith("b_r_")}
+    for pars in [cal_pars, b_r_pars]:
+        fitted = cm.fit_source_factors(obs_df, pars)
+        assert set(fitted) == set(cal_pars)
+        for key, val in cal_pars.items():
+            assert fitted[key] == pytest.approx(val, rel=1e-8)
+
+    # Only 'b_r' is used by get_basis()
+    for basis, base_basis in zip(cm.get_basis(b_r_pars), cm.get_basis(cal_pars)):
+        assert (basis == base_basis).all()
+
+
+def test_packed_inputs_mapping(calib_net, in_data):
+    g, nd_list = calib_net
+    packed = calib.pack_input_dict(in_data, nd_list, YEARS, PAR_LIST)
+    assert len(packed) == len(in_data)
+    assert list(packed) == [(nd, year) for year in YEARS for nd in nd_list]
+    for key in [(nd_list[0], YEARS[0]), (nd_list[-1], YEARS[-1])]:
+        assert key in packed
+        assert dict(packed[key]) == pytest.approx(in_data[key])
+    for key in [("missing", YEARS[0]), (nd_list[0], 1900), "missing"]:
+        assert key not in packed
+        assert packed.get(key) is None
+        with pytest.raises(KeyError):
+            packed[key]
+
+    # Pairs with no data are not keys
+    data = packed.data.copy()
+    data[0, 0] = np.nan
+    packed = calib.PackedInputs(packed.regine, YEARS, packed.fields, data)
+    assert len(packed) == len(in_data) - 1
+    with pytest.raises(KeyError):
+        packed[(packed.regine[0], YEARS[0])]
+
+
+def test_run_model_multi_year_packed(calib_net, in_data, stations, cal_pars):
+    g, nd_list = calib_net
+    packed = calib.pack_input_dict(in_data, nd_list, YEARS, PAR_LIST)
+    res_df = calib.run_model_multi_year(
+        g, nd_list, YEARS[0], YEARS[-1], packed, PAR_LIST, stations, cal_pars
+    )
+    base_df = calib.run_model_multi_year(
+        g, nd_list, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations, cal_pars
+    )
+    pd.testing.assert_frame_equal(
+        res_df, base_df, check_dtype=False, check_exact=False, rtol=1e-10
+    )
+
+
+def test_evaluate_parallel(calib_net, in_data, stations, cal_pars, rng):
+    g, nd_list = calib_net
+    cm = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations)
+    obs_df = cm.run(cal_pars)
+    cand_list = [None, cal_pars] + [
+        {key: val * rng.uniform(0.8, 1.2) for key, val in cal_pars.items()}
+        for i in range(4)
+    ]
+    obj, res = calib.evaluate_parallel(cm, cand_list, obs_df, n_workers=2)
+    for idx, pars in enumerate(cand_list):
+        sim = cm.run(pars, as_array=True)
+        np.testing.assert_allclose(res[idx], sim, rtol=1e-12)
+        assert obj[idx] == pytest.approx(
+            calib.sse_objective(sim, cm.align_obs(obs_df)), rel=1e-12
+        )
+    assert obj[1] == pytest.approx(0, abs=1e-12)
+
+
+def test_calib_cache_keys(calib_net, in_data, stations, cal_pars):
+    g, nd_list = calib_net
+    cache = calib.CalibCache()
+    cm = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations, cache)
+    basis = cm.get_basis(cal_pars)
+    assert cm.get_basis(cal_pars) is basis
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Models with different parameters or inputs do not share entries
+    mod_data = {key: dict(vals) for key, vals in in_data.items()}
+    mod_data[(nd_list[0], YEARS[0])]["all_point_tot-p_tonnes"] += 1
+    models = [
+        calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST[::-1], stations),
+        calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST[:1], stations),
+        calib.CalibModel(g, YEARS[0], YEARS[-1], mod_data, PAR_LIST, stations),
+    ]
+    for idx, other in enumerate(models):
+        other.cache = cache
+        other_basis = other.get_basis(cal_pars)
+        assert other_basis is not basis
+        assert (cache.hits, cache.misses) == (1, idx + 2)
+        other.cache = None
+        for arr, base_arr in zip(other_basis, other.get_basis(cal_pars)):
+            np.testing.assert_array_equal(arr, base_arr)
+
+    # Identical models do
+    same = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations, cache)
+    assert same.get_basis(cal_pars) is basis
+    assert cache.hits == 2
+
+    # Least-recently-used entries are evicted at the memory limit
+    size = sum(arr.nbytes for arr in basis)
+    cache = calib.CalibCache(max_bytes=2 * size)
+    cm.cache = cache
+    b_r_list = [{"b_r_tot-n": val, "b_r_tot-p": val} for val in [0.8, 0.9, 1.0]]
+    for pars in b_r_list:
+        cm.get_basis(pars)
+    assert (len(cache), cache.nbytes, cache.misses) == (2, 2 * size, 3)
+    cm.get_basis(b_r_list[-1])
+    assert cache.hits == 1
+    cm.get_basis(b_r_list[0])
+    assert (len(cache), cache.misses) == (2, 4)
+    cm.get_basis(b_r_list[-1])
+    assert cache.hits == 2
+
+
+def test_make_folds(calib_net, in_data, stations, cal_pars):
+    g, nd_list = calib_net
+    cm = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations)
+    obs_df = cm.run(cal_pars)
+
+    # Rows are split as evenly as possible
+    folds = calib.make_folds(obs_df, n_folds=5)
+    assert len(folds) == len(obs_df)
+    counts = np.bincount(folds)
+    assert (len(counts), counts.min(), counts.max()) == (5, 2, 3)
+
+    # Groups are not split between folds, and every group is in a fold
+    for groups, n_folds in [("regine", 4), ("year", None), ("regine", None)]:
+        folds = calib.make_folds(obs_df, n_folds=n_folds, groups=groups)
+        grp_folds = pd.Series(folds).groupby(obs_df[groups].to_numpy()).unique()
+        assert (grp_folds.str.len() == 1).all()
+        assert set(grp_folds.index) == set(obs_df[groups])
+        n_grps = obs_df[groups].nunique()
+        assert len(np.unique(folds)) == (n_grps if n_folds is None else n_folds)
+
+
+@pytest.mark.parametrize("groups", ["regine", "year"])
+def test_cross_validate(calib_net, in_data, stations, cal_pars, rng, groups):
+    g, nd_list = calib_net
+    cm = calib.CalibModel(g, YEARS[0], YEARS[-1], in_data, PAR_LIST, stations)
+    obs_df = cm.run(cal_pars)
+    for col in ["%s_tonnes" % par for par in PAR_LIST]:
+        obs_df[col] *= rng.uniform(0.8, 1.2, len(obs_df))
+    folds = calib.make_folds(obs_df, n_folds=None, groups=groups)
+    b_r_values = [0.8, 1.0, 1.2]
+    cv_df = calib.cross_validate(cm, obs_df, folds, b_r_values, n_workers=2)
+    assert len(cv_df) == len(np.unique(folds)) * len(PAR_LIST) * 2
+    assert set(cv_df["fold"]) == set(folds)
+
+    # Each fold is calibrated without, and validated against, its own observations
+    n_obs = 0
+    for fold in np.unique(folds):
+        fold_df = cv_df.query("fold == @fold").set_index(["dataset", "par"])
+        fit_pars = cm.calibrate(obs_df[folds != fold], b_r_values)
+        sim = cm.run(fit_pars, as_array=True)
+        for dataset, obs in [("cal", folds != fold), ("val", folds == fold)]:
+            scores = calib.skill_scores(
+                sim, cm.align_obs(obs_df[obs]), by_station=False
+            )
+            for idx, par in enumerate(PAR_LIST):
+                row = fold_df.loc[(dataset, par)]
+                for coef in ["b_r", "b_p", "b_d"]:
+                    assert row[coef] == pytest.approx(fit_pars["%s_%s" % (coef, par)])
+                for key, vals in scores.items():
+                    assert row[key] == pytest.approx(vals[idx + 1], nan_ok=True)
+        n_obs += fold_df.loc[("val", PAR_LIST[0]), "n_obs"]
+    assert n_obs == len(obs_df)
+
+
+def test_skill_scores(rng):
+    n_cands, n_stns, n_yrs, n_cols = 3, 4, 10, 2
+    obs = rng.uniform(1, 10, (n_stns, n_yrs, n_cols))
+    sim = obs * rng.uniform(0.5, 1.5, (n_cands, n_stns, n_yrs, n_cols))
+    obs[rng.uniform(size=obs.shape) < 0.3] = np.nan
+    obs[0, :, 1] = np.nan
+    scores = calib.skill_scores(sim, obs)
+    all_scores = calib.skill_scores(sim, obs, by_station=False)
+
+    def naive(s, o):
+        mask = np.isfinite(o)
+        s, o = s[mask], o[mask]
+        if len(o) == 0:
+            return {"n_obs": 0, "bias_pct": np.nan, "nse": np.nan, "r": np.nan}
+        return {
+            "n_obs": len(o),
+            "bias_pct": 100 * (s.sum() - o.sum()) / o.sum(),
+            "nse": 1 - ((s - o) ** 2).sum() / ((o - o.mean()) ** 2).sum(),
+            "r": np.corrcoef(s, o)[0, 1],
+        }
+
+    for cand in range(n_cands):
+        for col in range(n_cols):
+            base = naive(sim[cand, :, :, col], obs[:, :, col])
+            for key, val in base.items():
+                assert all_scores[key][cand, col] == pytest.approx(val)
+            for stn in range(n_stns):
+                base = naive(sim[cand, stn, :, col], obs[stn, :, col])
+                for key, val in base.items():
+                    assert scores[key][cand, stn, col] == pytest.approx(
+                        val, nan_ok=True
+                    )
+
+
+def test_build_input_dict_cache(input_dfs, tmp_path, monkeypatch):
+    data_root = tmp_path / "data"
+    core_fold = data_root / "NOPE" / "NOPE_Annual_Inputs"
+    core_fold.mkdir(parents=True)
+    for year, df in input_dfs.items():
+        df.to_csv(core_fold / ("nope_input_data_%s.csv" % year), index=False)
+    data_root, cache_dir = str(data_root), str(tmp_path / "cache")
+    in_data = calib.build_input_dict(YEARS[0], YEARS[-1], PAR_LIST, data_root)
+    cached = calib.build_input_dict(YEARS[0], YEARS[-1], PAR_LIST, data_root, cache_dir)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+    assert isinstance(cached.data, np.memmap)
+    np.testing.assert_array_equal(cached.data, in_data.data)
+
+    # Cached data are reused without reading the source files
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", fail_read)
+        reused = calib.build_input_dict(
+            YEARS[0], YEARS[-1], PAR_LIST, data_root, cache_dir
+        )
+    assert isinstance(reused.data, np.memmap)
+    assert list(reused) == list(in_data)
+    np.testing.assert_array_equal(reused.data, in_data.data)
+
+    # A new version is added if the source files change
+    df = input_dfs[YEARS[0]].copy()
+    df["q_reg_m3/s"] *= 2
+    df.to_csv(core_fold / ("nope_input_data_%s.csv" % YEARS[0]), index=False)
+    calib.build_input_dict(YEARS[0], YEARS[-1], PAR_LIST, data_root, cache_dir)
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_read_obs_data_cache(tmp_path, monkeypatch, rng):
+    pytest.importorskip("openpyxl")
+    obs_fold = tmp_path / "NOPE" / "NOPE_RID_Calibration_Data"
+    obs_fold.mkdir(parents=True)
+    (tmp_path / "Data").mkdir()
+    obs_df = pd.DataFrame(
+        {
+            "station_id": np.repeat([1, 2, 3], 4),
+            "year": np.tile([2013, 2014, 2015, 2016], 3),
+            "tot-p_tonnes": rng.uniform(0, 10, 12),
+        }
+    )
+    obs_df.loc[5, "tot-p_tonnes"] = np.nan
+    obs_df.to_csv(obs_fold / "rid_all_obs_loads_flows_1990_2016.csv", index=False)
+    stn_df = pd.DataFrame(
+        {
+            "station_id": [1, 2, 3],
+            "nve_vassdrag_nr": ["001.A", "002.B", "003.C"],
+            "rid_group": ["main", "main", "trib"],
+        }
+    )
+    stn_df.to_excel(
+        tmp_path / "Data" / "RID_Sites_List.xlsx", sheet_name="RID_All", index=False
+    )
+
+    cache_dir = tmp_path / "cache"
+    res = calib.read_obs_data(0.5, data_root=str(tmp_path), cache_dir=str(cache_dir))
+    assert len(list(cache_dir.iterdir())) == 1
+    assert len(res[0]) == 11
+    assert (len(res[1]), len(res[2])) == (5, 6)
+    assert set(res[1].index).isdisjoint(res[2].index)
+    assert (
+        res[0]["rid_group"]
+        == res[0]["station_id"].map({1: "main", 2: "main", 3: "trib"})
+    ).all()
+
+    with monkeypatch.context() as m:
+        m.setattr(pd, "read_csv", fail_read)
+        m.setattr(pd, "read_excel", fail_read)
+        cached = calib.read_obs_data(
+            0.5, data_root=str(tmp_path), cache_dir=str(cache_dir)
+        )
+    for df, base_df in zip(cached, res):
+        pd.testing.assert_frame_equal(df, base_df)
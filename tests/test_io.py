@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from teotil2 import io
+
+from .conftest import YEARS
+
+
+def test_make_input_file(input_df):
+    for col in ["regine", "regine_ned", "q_reg_m3/s", "trans_tot-n", "trans_tot-p"]:
+        assert col in input_df.columns
+    assert input_df["regine"].is_unique
+    assert not input_df.isna().any().any()
+    assert (input_df[["aqu_tot-p_tonnes", "ren_tot-p_tonnes"]].sum() > 0).all()
+
+    # Most regines transmit loads, and many have some retention, so that accumulation
+    # through the network is exercised by the model tests
+    trans_df = input_df[["trans_tot-n", "trans_tot-p"]]
+    assert ((trans_df > 0).mean() > 0.99).all()
+    assert ((trans_df < 1).mean() > 0.2).all()
+
+    # Aggregated columns are the sum of their components
+    for par in ["tot-n", "tot-p"]:
+        srcs = ["spr", "aqu", "ren", "ind", "agri_pt"]
+        point_cols = ["%s_%s_tonnes" % (src, par) for src in srcs]
+        np.testing.assert_allclose(
+            input_df["all_point_%s_tonnes" % par], input_df[point_cols].sum(axis=1)
+        )
+        assert (input_df["all_point_%s_tonnes" % par] > 0).any()
+
+
+def test_make_input_files_matches_single_year(engine, core_fold, input_dfs):
+    res = io.make_input_files(YEARS, engine, core_fold, n_workers=1)
+    stacked = io.make_input_files(YEARS, engine, core_fold, stacked=True, n_workers=1)
+    for year in YEARS:
+        pd.testing.assert_frame_equal(
+            res[year], input_dfs[year], check_exact=False, rtol=1e-12
+        )
+        year_df = stacked.query("year == @year").drop(columns="year")
+        pd.testing.assert_frame_equal(
+            year_df.reset_index(drop=True),
+            input_dfs[year],
+            check_exact=False,
+            rtol=1e-12,
+        )
+
+
+def test_make_input_files_parallel(engine, core_fold, input_dfs, tmp_path):
+    out_csv = str(tmp_path / "input_data_{year}.csv")
+    res = io.make_input_files(YEARS, engine, core_fold, out_csv, n_workers=2)
+    stacked_csv = str(tmp_path / "input_data.csv")
+    stacked = io.make_input_files(
+        YEARS, engine, core_fold, stacked_csv, stacked=True, n_workers=2
+    )
+    stacked_df = pd.read_csv(stacked_csv, keep_default_na=False)
+    pd.testing.assert_frame_equal(stacked_df, stacked, check_dtype=False)
+    for year in YEARS:
+        pd.testing.assert_frame_equal(
+            res[year], input_dfs[year], check_exact=False, rtol=1e-12
+        )
+        year_df = pd.read_csv(out_csv.format(year=year), keep_default_na=False)
+        pd.testing.assert_frame_equal(year_df, input_dfs[year], check_dtype=False)
+        year_df = stacked.query("year == @year").drop(columns="year")
+        pd.testing.assert_frame_equal(
+            year_df.reset_index(drop=True),
+            input_dfs[year],
+            check_exact=False,
+            rtol=1e-12,
+        )
+
+
+def test_make_input_file_threads(engine, core_fold, input_df):
+    df = io.make_input_file(YEARS[-1], engine, core_fold, None, n_threads=1)
+    pd.testing.assert_frame_equal(df, input_df, check_exact=False, rtol=1e-12)
+
+
+def test_make_metals_input_file(engine, core_fold):
+    par_list = ["As", "Cd", "Hg", "Zn"]
+    df = io.make_input_file(
+        YEARS[-1], engine, core_fold, None, mode="metals", par_list=par_list
+    )
+    for par in par_list:
+        assert "trans_%s" % par.lower() in df.columns
+    assert not df.isna().any().any()
+    assert (df["ren_zn_tonnes"] > 0).any()
+    for par in par_list:
+        cols = ["%s_%s_tonnes" % (src, par.lower()) for src in ["ind", "ren", "diff"]]
+        np.testing.assert_allclose(
+            df["all_sources_%s_tonnes" % par.lower()], df[cols].sum(axis=1)
+        )
+
+
+def test_cached_frame(tmp_path):
+    cache_dir = str(tmp_path)
+    dfs = {key: pd.DataFrame({"a": [idx]}) for idx, key in enumerate(["v1", "v2"])}
+    for key, df in dfs.items():
+        res = io.cached_frame("test", key, lambda: df, cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(res, df)
+
+    # Other versions are kept, and cached data are used
+    for key, df in dfs.items():
+        res = io.cached_frame("test", key, lambda: None, cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(res, df)
+
+    io.cached_frame("other", "v1", lambda: dfs["v1"], cache_dir=cache_dir)
+    deleted = io.clear_cache(cache_dir, name="test", keep=["v2"])
+    assert len(deleted) == 1
+    assert "test_v1" in deleted[0]
+    res = io.cached_frame("test", "v1", lambda: dfs["v2"], cache_dir=cache_dir)
+    pd.testing.assert_frame_equal(res, dfs["v2"])
+    assert len(io.clear_cache(cache_dir)) == 3
+    assert len(io.clear_cache(cache_dir)) == 0
+
+
+def test_core_data_dtypes(core_fold):
+    codes = {"vassom", "komnr", "fylke", "year"}
+    for name, schema in io.CORE_DATA_SCHEMAS.items():
+        year = YEARS[-1] if "{year}" in schema["file"] else None
+        df = io.read_core_data(core_fold, name, year=year)
+        for col, dtype in df.dtypes.items():
+            if pd.api.types.is_integer_dtype(dtype):
+                assert col in codes, f"'{col}' in '{name}' should be float."
@@ -0,0 +1,280 @@
+import networkx as nx
+import numpy as np
+import pandas as pd
+import pytest
+
+from teotil2 import model
+
+from .conftest import YEARS, baseline_results, baseline_run_model, sort_results
+
+
+def assert_results_equal(res_df, base_df):
+    """Compare model results with baseline results, allowing for differences in the order
+    of floating point operations.
+    """
+    pd.testing.assert_frame_equal(
+        sort_results(res_df), base_df, check_dtype=False, check_exact=False, rtol=1e-10
+    )
+
+
+def test_run_model_matches_baseline(input_df, base_res):
+    res = model.run_model(input_df, as_graph=False)
+    assert_results_equal(model.model_to_dataframe(res), base_res)
+
+
+def test_run_model_graph_matches_baseline(input_df, base_res):
+    g = model.run_model(input_df)
+    assert_results_equal(model.model_to_dataframe(g), base_res)
+
+
+def test_run_model_graph_attributes(input_df, base_res):
+    g = model.run_model(input_df)
+    base_g = baseline_run_model(input_df)
+    nd = input_df["regine"].iloc[0]
+    for stat in ["local", "accum"]:
+        assert type(g.nodes[nd][stat]) is dict
+        assert list(g.nodes[nd][stat]) == list(base_g.nodes[nd][stat])
+    assert g.nodes[nd]["local"] == base_g.nodes[nd]["local"]
+    assert g.nodes[nd]["accum"] == pytest.approx(base_g.nodes[nd]["accum"], rel=1e-10)
+    assert type(g.nodes[nd]["accum"]["q_m3/s"]) is float
+
+    # Node attributes can be modified and the graph re-accumulated
+    g.nodes[nd]["local"]["aqu_tot-p_tonnes"] += 1
+    model.accumulate_loads(g, model._get_acc_cols(input_df))
+    mod_df = input_df.copy()
+    mod_df.loc[mod_df["regine"] == nd, "aqu_tot-p_tonnes"] += 1
+    assert_results_equal(
+        model.model_to_dataframe(g),
+        sort_results(model.model_to_dataframe(model.run_model(mod_df))),
+    )
+
+
+def test_model_result_matches_graph(input_df):
+    res = model.run_model(input_df, as_graph=False)
+    g = model.run_model(input_df)
+    for stat, col in [("accum", "q_m3/s"), ("local", "aqu_tot-p_tonnes")]:
+        vals = [g.nodes[nd][stat][col] for nd in res.regine]
+        assert (res["%s_%s" % (stat, col)] == vals).all()
+
+
+def test_run_model_targets(input_df, base_res, stations):
+    res_df = model.model_to_dataframe(
+        model.run_model(input_df, as_graph=False, targets=stations)
+    )
+    g = baseline_run_model(input_df)
+    upstr = set(stations).union(*[nx.ancestors(g, nd) for nd in stations])
+    assert set(res_df["regine"]) == upstr
+
+    base_df = base_res[base_res["regine"].isin(upstr)].reset_index(drop=True)
+    assert_results_equal(res_df, base_df)
+
+
+def test_run_model_years(input_dfs):
+    res_df = model.run_model_years(input_dfs)
+    assert list(res_df["year"].unique()) == YEARS
+    for year, df in input_dfs.items():
+        year_df = res_df.query("year == @year").drop(columns="year")
+        assert_results_equal(year_df, baseline_results(df))
+
+
+def test_run_scenarios(input_df, base_res):
+    regs = input_df["regine"].iloc[::10]
+    scenarios = {
+        "base": {},
+        "cut": {"multiply": {"aqu_tot-p_tonnes": pd.Series(0.5, index=regs)}},
+        "trans": {"replace": {"trans_tot-n": 0.5}},
+    }
+    res_df = model.run_scenarios(input_df, scenarios)
+    assert list(res_df["scenario"].unique()) == list(scenarios)
+
+    cut_df = input_df.copy()
+    cut_df.loc[cut_df["regine"].isin(regs), "aqu_tot-p_tonnes"] *= 0.5
+    trans_df = input_df.copy()
+    trans_df["trans_tot-n"] = 0.5
+    for name, df in [("cut", cut_df), ("trans", trans_df)]:
+        scen_df = res_df.query("scenario == @name").drop(columns="scenario")
+        assert_results_equal(scen_df, baseline_results(df))
+    base_df = res_df.query("scenario == 'base'").drop(columns="scenario")
+    assert_results_equal(base_df, base_res)
+
+
+def test_run_scenarios_invalid(input_df):
+    for col in ["trans_tot-x", "trans_cd", "aqu_tot-x_tonnes"]:
+        with pytest.raises(AssertionError):
+            model.run_scenarios(input_df, {"bad": {"replace": {col: 0.5}}})
+    with pytest.raises(ValueError):
+        model.run_scenarios(input_df, {"bad": {"add": {"trans_tot-n": 0.5}}})
+
+
+def test_incremental_model(input_df):
+    regs = list(input_df["regine"].iloc[[100, 2000, 15000]])
+    loads = pd.DataFrame(
+        {"aqu_tot-p_tonnes": [1.0, 2.0, 3.0], "q_reg_m3/s": [0.5, 0.0, 1.0]},
+        index=regs,
+    )
+    trans = pd.DataFrame({"trans_tot-n": [0.2, 0.9]}, index=regs[1:])
+
+    im = model.IncrementalModel(input_df)
+    im.update(loads=loads)
+    im.update(trans=trans)
+
+    mod_df = input_df.set_index("regine")
+    mod_df.loc[regs, loads.columns] += loads
+    mod_df.loc[regs[1:], "trans_tot-n"] = trans["trans_tot-n"]
+    assert_results_equal(im.to_dataframe(), baseline_results(mod_df.reset_index()))
+
+
+def test_incremental_model_duplicates(input_df):
+    im = model.IncrementalModel(input_df)
+    accum = im.accum.copy()
+    reg = input_df["regine"].iloc[100]
+    loads = pd.DataFrame({"aqu_tot-p_tonnes": [1.0, 2.0]}, index=[reg, reg])
+    with pytest.raises(ValueError):
+        im.update(loads=loads)
+    trans = pd.DataFrame({"trans_tot-p": [0.5, 0.6]}, index=[reg, reg])
+    with pytest.raises(ValueError):
+        im.update(trans=trans)
+    assert (im.accum == accum).all()
+
+
+def test_upstream_nodes(input_df, stations):
+    net = model.get_network(input_df)
+    g = baseline_run_model(input_df)
+    for nd in stations:
+        upstr = set(net.regine[net.upstream_nodes(nd)])
+        assert upstr == nx.ancestors(g, nd) | {nd}
+
+
+def path_products(input_df, upstr, outlet, par_list):
+    """Products of 'trans_{par}' along the path from each regine in 'upstr' down to
+    'outlet', inclusive, found by walking the network one regine at a time. If 'outlet'
+    is None, products are calculated to the network outlet (i.e. the sea).
+    """
+    df = input_df.set_index("regine")
+    down = df["regine_ned"].to_dict()
+    trans = df[["trans_%s" % par for par in par_list]].to_numpy()
+    rows = {nd: idx for idx, nd in enumerate(df.index)}
+    prods = {}
+    for nd in upstr:
+        prod = np.ones(len(par_list))
+        nxt = nd
+        while True:
+            prod = prod * trans[rows[nxt]]
+            if (nxt == outlet) or (down[nxt] not in rows):
+                break
+            nxt = down[nxt]
+        prods[nd] = prod
+
+    return prods
+
+
+def test_delivery_coefficients(input_df, stations):
+    # Include outlets nested inside other outlets' catchments
+    g = nx.DiGraph(zip(input_df["regine"], input_df["regine_ned"]))
+    nested = list(nx.descendants(g, stations[1]) & set(input_df["regine"]))
+    nested = sorted(nested, key=lambda nd: len(nx.ancestors(g, nd)))[:2]
+    assert len(nested) == 2
+    outlets = stations + nested
+    par_list = ["tot-n", "tot-p"]
+    coef_df = model.delivery_coefficients(input_df, outlets)
+    assert set(coef_df["outlet"]) == set(outlets)
+    for out in outlets:
+        out_df = coef_df.query("outlet == @out").set_index("regine")
+        upstr = nx.ancestors(g, out) | {out}
+        assert set(out_df.index) == upstr
+        prods = path_products(input_df, upstr, out, par_list)
+        base = np.array([prods[nd] for nd in out_df.index])
+        np.testing.assert_allclose(
+            out_df[["coef_%s" % par for par in par_list]], base, rtol=1e-12
+        )
+
+    # Results are copied from the cache
+    coef_df["coef_tot-n"] = 0.0
+    cached_df = model.delivery_coefficients(input_df, outlets)
+    assert (cached_df["coef_tot-n"] > 0).any()
+
+    # Attributed loads are local inputs multiplied by the coefficients
+    cols = ["aqu_tot-p_tonnes", "ren_tot-n_tonnes"]
+    att_df = model.attribute_loads(input_df, outlets, cols=cols)
+    local = input_df.set_index("regine").loc[cached_df["regine"], cols].to_numpy()
+    coefs = cached_df[["coef_tot-p", "coef_tot-n"]].to_numpy()
+    np.testing.assert_allclose(att_df[cols], local * coefs, rtol=1e-12)
+    sum_df = model.attribute_loads(
+        input_df, coeffs=cached_df, cols=cols, by_regine=False
+    )
+    sum_df = sum_df.set_index("outlet").loc[outlets]
+    np.testing.assert_allclose(
+        sum_df[cols], att_df.groupby("outlet")[cols].sum().loc[outlets], rtol=1e-12
+    )
+
+
+def test_delivery_ratios(input_df, stations):
+    par_list = ["tot-n", "tot-p"]
+    res_df = model.delivery_ratios(input_df)
+    assert list(res_df.columns) == ["regine"] + ["deliv_%s_frac" % i for i in par_list]
+    assert set(res_df["regine"]) == set(input_df["regine"])
+    prods = path_products(input_df, res_df["regine"], None, par_list)
+    base = np.array([prods[nd] for nd in res_df["regine"]])
+    np.testing.assert_allclose(res_df.iloc[:, 1:], base, rtol=1e-12)
+    assert ((base > 0) & (base < 1)).any()
+
+    # Products stop at the nearest outlet downstream
+    net = model.get_network(input_df)
+    trans = input_df[["trans_%s" % par for par in par_list]].to_numpy()
+    trans = trans[net.align(input_df["regine"])]
+    is_outlet = np.isin(net.regine, stations)
+    prod, nearest = model._downstream_products(net, trans, is_outlet)
+    down = input_df.set_index("regine")["regine_ned"].to_dict()
+    upstr = {nd: [] for nd in stations}
+    near = {}
+    for idx, nd in enumerate(net.regine):
+        path = [nd]
+        while (path[-1] in down) and (path[-1] not in near) and (path[-1] not in upstr):
+            path.append(down[path[-1]])
+        out = path[-1] if path[-1] in upstr else near.get(path[-1])
+        near.update({nxt: out for nxt in path if nxt not in upstr})
+        if out is None:
+            assert nearest[idx] == -1
+        else:
+            assert net.regine[nearest[idx]] == out
+            upstr[out].append(idx)
+    for out, rows in upstr.items():
+        prods = path_products(input_df, net.regine[rows], out, par_list)
+        base = np.array([prods[nd] for nd in net.regine[rows]])
+        np.testing.assert_allclose(prod[rows], base, rtol=1e-12)
+
+
+def test_network_cache(input_df, tmp_path, monkeypatch, rng):
+    monkeypatch.setattr(model, "_NETWORK_CACHE", {})
+    cache_dir = str(tmp_path)
+    net = model.get_network(input_df, cache_dir=cache_dir)
+    npz_path = tmp_path / ("network_%s.npz" % net.key)
+    assert [path.name for path in tmp_path.iterdir()] == [npz_path.name]
+
+    # Networks are loaded from disk, not compiled again
+    def fail(*args, **kwargs):
+        raise AssertionError("Network should be loaded from the cache.")
+
+    monkeypatch.setattr(model, "_NETWORK_CACHE", {})
+    monkeypatch.setattr(model, "compile_network", fail)
+    for loaded in [
+        model.get_network(input_df, cache_dir),
+        model.Network.load(npz_path),
+    ]:
+        assert (loaded.key, loaded.is_tree) == (net.key, net.is_tree)
+        for name in model.Network._arrays:
+            np.testing.assert_array_equal(getattr(loaded, name), getattr(net, name))
+        local = rng.uniform(0, 1, (len(net), 3))
+        trans = rng.uniform(0.5, 1, (len(net), 3))
+        np.testing.assert_array_equal(
+            model.accumulate_arrays(loaded, local, trans),
+            model.accumulate_arrays(net, local, trans),
+        )
+    monkeypatch.undo()
+
+    # The key depends on the links, but not the row order
+    df = input_df.sample(frac=1, random_state=1)
+    assert model.network_key(df["regine"], df["regine_ned"]) == net.key
+    df = input_df.copy()
+    df.loc[df.index[100], "regine_ned"] = df["regine_ned"].iloc[200]
+    assert model.network_key(df["regine"], df["regine_ned"]) != net.key
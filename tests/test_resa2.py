@@ -0,0 +1,29 @@
+import os
+
+import pandas as pd
+
+from teotil2 import resa2
+
+from .conftest import YEARS
+
+
+def test_oracle_functions(engine):
+    df = pd.read_sql(
+        "SELECT TO_CHAR(TO_DATE('2016-03-01', 'YYYY-MM-DD'), 'YYYY') AS yr, "
+        "TO_NUMBER('1.5') AS num FROM resa2.rid_punktkilder_outpar_def LIMIT 1",
+        engine,
+    )
+    assert list(df.columns) == ["yr", "num"]
+    assert df.iloc[0].tolist() == ["2016", 1.5]
+
+
+def test_benchmark_input_files(engine, core_fold, tmp_path):
+    out_csv = str(tmp_path / "bench.csv")
+    for idx in range(2):
+        df = resa2.benchmark_input_files(
+            engine, core_fold, YEARS, n_repeats=1, out_csv=out_csv
+        )
+        assert list(df["method"]) == ["make_input_file", "make_input_files"]
+        assert (df["seconds"] > 0).all()
+    assert len(pd.read_csv(out_csv)) == 4
+    assert os.listdir(tmp_path) == ["bench.csv"]